@@ -0,0 +1,408 @@
+"""Interchangeable model backends: PyTorch, dynamically quantized int8 PyTorch and ONNX Runtime.
+
+Every backend shares the same preprocessing and postprocessing and only differs in how it turns a
+batch of pixel values into logits, so switching backends never changes the response format.
+
+Loading happens in two steps. The constructor loads the weights on the CPU, memory-mapped from a
+safetensors file, which is safe to do in a gunicorn master before it forks. `to_device()` then
+moves the model to its device once per worker, since CUDA can't be used in a forked child.
+"""
+
+import logging
+import os
+import tempfile
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "pytorch")
+ONNX_MODEL_FILENAME = "model.onnx"
+SAFETENSORS_FILENAME = "model.safetensors"
+PYTORCH_WEIGHTS_FILENAME = "pytorch_model.bin"
+# Where ONNX graphs go when they can't be exported next to a checkpoint on a read-only volume
+ONNX_CACHE_DIR = os.getenv("ONNX_CACHE_DIR", os.path.join(tempfile.gettempdir(), "onnx-models"))
+# ConvNeXt's processor crops below this size and squashes the image to a square at or above it
+CONVNEXT_CROP_BELOW = 384
+
+
+class UnsupportedModel(ValueError):
+    """Raised for a checkpoint whose image preprocessing the backends can't reproduce."""
+
+
+class ImageResizer(NamedTuple):
+    """Brings images to the model's input size the way its image processor does.
+
+    Images are either resized to `resize_size`, or scaled so their shortest edge is
+    `shortest_edge`, keeping the aspect ratio. Anything bigger than `input_size` is then center
+    cropped to it. Sizes are (width, height). It pickles, so decode processes can resize too.
+    """
+
+    resize_size: Optional[Tuple[int, int]]
+    shortest_edge: Optional[int]
+    input_size: Tuple[int, int]
+    resample: int
+
+    @classmethod
+    def from_processor(cls, processor: Any) -> "ImageResizer":
+        """The resize and center crop a Hugging Face image processor applies.
+
+        Covers processors with a fixed `size`, optionally followed by a `crop_size` center crop,
+        and ones that scale the `shortest_edge` and then crop: to `crop_size`, like CLIP's, or to
+        the shortest edge after scaling it up by `1 / crop_pct`, like ResNet's and ConvNeXt's.
+        """
+        size = processor.size
+        crop = processor.crop_size if getattr(processor, "do_center_crop", False) else None
+        crop_size = (crop["width"], crop["height"]) if crop else None
+        if "width" in size and "height" in size:
+            resize_size = (size["width"], size["height"])
+            return cls(resize_size, None, crop_size or resize_size, processor.resample)
+        if "shortest_edge" in size:
+            edge = size["shortest_edge"]
+            if crop_size is not None:
+                return cls(None, edge, crop_size, processor.resample)
+            if hasattr(processor, "crop_pct"):
+                if edge >= CONVNEXT_CROP_BELOW:
+                    return cls((edge, edge), None, (edge, edge), processor.resample)
+                crop_pct = processor.crop_pct or 224 / 256
+                return cls(None, int(edge / crop_pct), (edge, edge), processor.resample)
+        raise UnsupportedModel(
+            f"Unsupported image processor size {size}: expected a width and height, or a "
+            "shortest edge with a center crop, so every image comes out the same size"
+        )
+
+    @property
+    def decode_size(self) -> int:
+        """Smallest side a decoded image can have without being upscaled by the resize."""
+        if self.resize_size is not None:
+            return max(self.resize_size)
+        return self.shortest_edge
+
+    def __call__(self, image: Image.Image) -> Image.Image:
+        """Resize and center crop one image to `input_size`.
+
+        Images that already have that size are taken as resized, e.g. by a decode process, and
+        returned as they are.
+        """
+        if image.size == self.input_size:
+            return image
+        if self.resize_size is not None:
+            image = image.resize(self.resize_size, resample=self.resample)
+        else:
+            scale = self.shortest_edge / min(image.size)
+            resized = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+            image = image.resize(resized, resample=self.resample)
+        if image.size != self.input_size:
+            width, height = self.input_size
+            left, top = (image.width - width) // 2, (image.height - height) // 2
+            image = image.crop((left, top, left + width, top + height))
+        return image
+
+
+class Backend:
+    """Turns batches of (image, top_k) items into top-k predictions using the PyTorch model."""
+
+    name = "pytorch"
+
+    def __init__(self, model_path: str, device: str):
+        from transformers import AutoConfig
+        from transformers import AutoImageProcessor
+
+        self.model_path = model_path
+        self.device = device
+        self.on_device = False
+        self.image_processor = AutoImageProcessor.from_pretrained(model_path)
+        self.resizer = ImageResizer.from_processor(self.image_processor)
+        self.image_size = self.resizer.input_size
+        config = AutoConfig.from_pretrained(model_path)
+        self.labels = [config.id2label[i] for i in range(config.num_labels)]
+        self.model = self.load_model()
+
+        # Rescaling and normalization folded into one multiply-add: (x * rescale - mean) / std
+        processor = self.image_processor
+        self.pixel_scale = np.array(
+            [processor.rescale_factor / std for std in processor.image_std], dtype=np.float32
+        ).reshape(1, 3, 1, 1)
+        self.pixel_shift = np.array(
+            [-mean / std for mean, std in zip(processor.image_mean, processor.image_std)],
+            dtype=np.float32,
+        ).reshape(1, 3, 1, 1)
+
+    def load_model(self) -> torch.nn.Module:
+        """Load the checkpoint on the CPU in eval mode."""
+        return load_pretrained(self.model_path)
+
+    def to_device(self) -> None:
+        """Move the model to its device. Call once per process, after any fork."""
+        if self.on_device:
+            return
+        self.model = self.model.to(self.device)
+        self.pixel_scale_tensor = torch.from_numpy(self.pixel_scale).to(self.device)
+        self.pixel_shift_tensor = torch.from_numpy(self.pixel_shift).to(self.device)
+        self.on_device = True
+
+    def memory_bytes(self) -> int:
+        """Bytes held by the model's weights and buffers."""
+        return sum(tensor_bytes(value) for value in self.model.state_dict().values())
+
+    def resize(self, images: List[Image.Image]) -> np.ndarray:
+        """Resize each image to the model's input size and stack them as one uint8 NHWC array."""
+        return np.stack([np.asarray(self.resizer(image)) for image in images])
+
+    def logits(self, pixels: np.ndarray) -> torch.Tensor:
+        """Run the forward pass on a batch of uint8 NHWC pixels.
+
+        The batch is copied to the device as uint8, a quarter of the bytes of float32, and
+        rescaled and normalized there in one vectorized op.
+        """
+        batch = torch.from_numpy(pixels).to(self.device).permute(0, 3, 1, 2).float()
+        batch = batch.mul_(self.pixel_scale_tensor).add_(self.pixel_shift_tensor)
+        return self.model(pixel_values=batch).logits
+
+    def predict(
+        self, items: List[Tuple[Image.Image, int]], timings: Optional[Dict[str, float]] = None
+    ) -> List[Dict[str, Any]]:
+        """Classify a batch of (image, top_k) items.
+
+        Softmax and top-k are computed once over the whole logits tensor, using the largest top_k in
+        the batch. Each item's result is then sliced down to its own top_k. If `timings` is given,
+        the seconds spent in preprocess, forward and postprocess are stored in it.
+        """
+        start_time = time.perf_counter()
+        pixels = self.resize([image for image, _ in items])
+        max_top_k = max(top_k for _, top_k in items)
+        forward_start = time.perf_counter()
+        with torch.inference_mode():
+            logits = self.logits(pixels)
+            scores, indices = logits.softmax(dim=-1).topk(max_top_k, dim=-1)
+        # Copying the results back waits for the GPU, so it counts towards the forward pass
+        batch_scores, batch_indices = scores.tolist(), indices.tolist()
+        postprocess_start = time.perf_counter()
+
+        predictions = []
+        for (_, top_k), image_scores, image_indices in zip(items, batch_scores, batch_indices):
+            prediction: Dict[str, Any] = {
+                "label": self.labels[image_indices[0]],
+                "score": image_scores[0],
+            }
+            if top_k > 1:
+                prediction["top_k"] = [
+                    {"label": self.labels[index], "score": score}
+                    for index, score in zip(image_indices[:top_k], image_scores[:top_k])
+                ]
+            predictions.append(prediction)
+        if timings is not None:
+            timings["preprocess"] = forward_start - start_time
+            timings["forward"] = postprocess_start - forward_start
+            timings["postprocess"] = time.perf_counter() - postprocess_start
+        return predictions
+
+
+class QuantizedBackend(Backend):
+    """PyTorch model with its linear layers dynamically quantized to int8. CPU only."""
+
+    name = "int8"
+
+    def __init__(self, model_path: str, device: str):
+        if device != "cpu":
+            logger.warning(f"The int8 backend only runs on CPU, ignoring device {device}")
+        super().__init__(model_path, "cpu")
+
+    def load_model(self) -> torch.nn.Module:
+        """Load the checkpoint and quantize its linear layers' weights to int8."""
+        model = load_pretrained(self.model_path)
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class OnnxBackend(Backend):
+    """ONNX Runtime session over a graph exported from the PyTorch checkpoint.
+
+    The graph is exported to `model.onnx` next to the checkpoint the first time it is needed, or
+    read from ONNX_MODEL_PATH if that is set. If that location can't be written to, the graph is
+    exported under ONNX_CACHE_DIR instead. The session is opened by `to_device()`, in each worker.
+    """
+
+    name = "onnx"
+
+    def load_model(self) -> Optional[torch.nn.Module]:
+        """Export the PyTorch model to ONNX if needed. No PyTorch model is kept."""
+        self.onnx_path = os.getenv(
+            "ONNX_MODEL_PATH", os.path.join(self.model_path, ONNX_MODEL_FILENAME)
+        )
+        cache_path = os.path.join(
+            ONNX_CACHE_DIR,
+            os.path.abspath(self.model_path).strip(os.sep).replace(os.sep, "--"),
+            ONNX_MODEL_FILENAME,
+        )
+        if not os.path.exists(self.onnx_path) and os.path.exists(cache_path):
+            self.onnx_path = cache_path
+        if os.path.exists(self.onnx_path):
+            return None
+
+        model = load_pretrained(self.model_path)
+        try:
+            export_onnx(model, self.onnx_path, self.image_size)
+        except OSError as e:
+            logger.warning(f"Can't write {self.onnx_path}, exporting to {cache_path}: {e}")
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            export_onnx(model, cache_path, self.image_size)
+            self.onnx_path = cache_path
+        return None
+
+    def to_device(self) -> None:
+        """Open an ONNX Runtime session, on the GPU if the device and the runtime allow it."""
+        if self.on_device:
+            return
+        import onnxruntime
+
+        providers = ["CPUExecutionProvider"]
+        if (
+            self.device == "cuda"
+            and "CUDAExecutionProvider" in onnxruntime.get_available_providers()
+        ):
+            providers.insert(0, "CUDAExecutionProvider")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # Run as many threads as PyTorch would, so the worker's CPU plan applies to ONNX Runtime too
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.inter_op_num_threads = torch.get_num_interop_threads()
+        self.session = onnxruntime.InferenceSession(
+            self.onnx_path, sess_options=options, providers=providers
+        )
+        logger.info(f"Loaded ONNX model {self.onnx_path} with providers {providers}")
+        self.on_device = True
+
+    def memory_bytes(self) -> int:
+        """Bytes held by the ONNX graph and its external weights, going by their files' sizes."""
+        graph_files = [self.onnx_path, self.onnx_path + ".data"]
+        return sum(os.path.getsize(path) for path in graph_files if os.path.exists(path))
+
+    def logits(self, pixels: np.ndarray) -> torch.Tensor:
+        """Normalize on the CPU with numpy and run the ONNX graph."""
+        batch = (
+            pixels.transpose(0, 3, 1, 2).astype(np.float32) * self.pixel_scale + self.pixel_shift
+        )
+        (logits,) = self.session.run(["logits"], {"pixel_values": batch})
+        return torch.from_numpy(logits)
+
+
+def tensor_bytes(value: Any) -> int:
+    """Bytes held by a state dict value. Quantized layers store theirs as tuples of tensors."""
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, (tuple, list)):
+        return sum(tensor_bytes(item) for item in value)
+    return 0
+
+
+def convert_to_safetensors(model_path: str) -> Optional[str]:
+    """Write the checkpoint's PyTorch weights out as safetensors, once, and return the file's path.
+
+    Checkpoints that only ship `pytorch_model.bin` are converted next to the original. The file is
+    written under a temporary name and renamed, so concurrent workers never read half a file.
+    Returns None if the model directory can't be written to, such as a read-only volume.
+    """
+    from safetensors.torch import save_file
+
+    safetensors_path = os.path.join(model_path, SAFETENSORS_FILENAME)
+    if os.path.exists(safetensors_path):
+        return safetensors_path
+
+    pytorch_path = os.path.join(model_path, PYTORCH_WEIGHTS_FILENAME)
+    logger.info(f"Converting {pytorch_path} to {safetensors_path}")
+    state_dict = torch.load(pytorch_path, map_location="cpu", weights_only=True)
+    # safetensors refuses tensors that share storage, so give each its own copy
+    state_dict = {name: tensor.contiguous().clone() for name, tensor in state_dict.items()}
+    temporary_path = f"{safetensors_path}.{os.getpid()}.tmp"
+    try:
+        save_file(state_dict, temporary_path, metadata={"format": "pt"})
+        os.replace(temporary_path, safetensors_path)
+    except OSError as e:
+        logger.warning(f"Can't write {safetensors_path}, keeping {pytorch_path}: {e}")
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+        return None
+    return safetensors_path
+
+
+def load_pretrained(model_path: str) -> torch.nn.Module:
+    """Load a checkpoint on the CPU with its weights memory-mapped from safetensors.
+
+    The model is built on the meta device, so no memory is allocated or randomly initialized for
+    weights that are about to be replaced, and the memory-mapped tensors are then assigned to it
+    without a copy. Every process that maps the same file shares its pages through the page cache.
+    Models with weights the checkpoint doesn't cover, and `pytorch_model.bin` checkpoints that
+    can't be converted, fall back to a regular load.
+    """
+    from safetensors.torch import load_file
+    from transformers import AutoConfig
+    from transformers import AutoModelForImageClassification
+
+    safetensors_path = convert_to_safetensors(model_path)
+    if safetensors_path is None:
+        return AutoModelForImageClassification.from_pretrained(model_path).eval()
+    state_dict = load_file(safetensors_path)
+    config = AutoConfig.from_pretrained(model_path)
+    with torch.device("meta"):
+        model = AutoModelForImageClassification.from_config(config)
+    model.load_state_dict(state_dict, strict=False, assign=True)
+
+    tensors = list(model.parameters()) + list(model.buffers())
+    if any(tensor.is_meta for tensor in tensors):
+        logger.warning(f"{model_path} doesn't cover every weight, loading it without mmap")
+        model = AutoModelForImageClassification.from_pretrained(model_path)
+    return model.eval()
+
+
+def export_onnx(model: torch.nn.Module, onnx_path: str, image_size: Tuple[int, int]) -> None:
+    """Export an image classification model to ONNX with a dynamic batch dimension.
+
+    The graph and its external weights are written to a temporary directory next to `onnx_path`
+    and moved into place, the graph last, so concurrent workers never open half an export.
+    """
+    logger.info(f"Exporting ONNX model to {onnx_path}")
+    width, height = image_size
+    dummy = torch.zeros(1, 3, height, width)
+    directory = os.path.dirname(os.path.abspath(onnx_path))
+    graph_filename = os.path.basename(onnx_path)
+    with tempfile.TemporaryDirectory(prefix=".onnx-export-", dir=directory) as tempdir:
+        torch.onnx.export(
+            model,
+            (dummy,),
+            os.path.join(tempdir, graph_filename),
+            input_names=["pixel_values"],
+            output_names=["logits"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+            opset_version=17,
+        )
+        # External weights are referenced by file name, so they keep theirs
+        for filename in sorted(os.listdir(tempdir), key=lambda name: name == graph_filename):
+            os.replace(os.path.join(tempdir, filename), os.path.join(directory, filename))
+
+
+BACKENDS = {backend.name: backend for backend in (Backend, QuantizedBackend, OnnxBackend)}
+
+
+def create_backend(name: str, model_path: str, device: str, to_device: bool = True) -> Backend:
+    """Load the backend called `name` for the checkpoint at `model_path`.
+
+    Pass `to_device=False` to leave the model on the CPU until `to_device()` is called, for example
+    in a gunicorn master that forks its workers afterwards.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {name!r}, expected one of {list(BACKENDS)}")
+    backend = BACKENDS[name](model_path, device)
+    if to_device:
+        backend.to_device()
+    return backend
@@ -0,0 +1,290 @@
+"""Score whole food101 parquet shards against the local model, without going through HTTP.
+
+Images are decoded and resized in a process pool, several batches ahead of the model, so the
+forward passes never wait on JPEG decoding. Each shard's predictions go to
+`<output_dir>/<shard>.predictions.parquet` and its accuracy and throughput to
+`<output_dir>/<shard>.stats.parquet`. A shard whose stats file exists is skipped, so an
+interrupted run picks up at the first unfinished shard. When every shard is done, the per-shard
+stats are combined into `<output_dir>/summary.parquet`.
+"""
+
+import argparse
+import glob
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
+from datasets import Features
+from PIL import Image
+
+from backends import Backend
+from backends import ImageResizer
+from backends import create_backend
+from decoding import ImageDecodeError
+from decoding import decode_image
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+DecodedBatch = List[Tuple[Optional[Image.Image], Optional[str]]]
+
+
+def decode_batch(contents: List[bytes], resizer: ImageResizer) -> DecodedBatch:
+    """Decode and resize a batch of images in a worker process.
+
+    Resizing here, with the backend's own resizer, shrinks what is sent back to the main process
+    to the model's input size. The backend then uses the images as they are.
+    """
+    decoded: DecodedBatch = []
+    for data in contents:
+        try:
+            decoded.append((resizer(decode_image(data, resizer.decode_size)), None))
+        except ImageDecodeError as e:
+            decoded.append((None, str(e)))
+    return decoded
+
+
+def output_paths(output_dir: str, shard_path: str) -> Tuple[str, str]:
+    """Predictions and stats file for a shard."""
+    stem = os.path.splitext(os.path.basename(shard_path))[0]
+    return (
+        os.path.join(output_dir, f"{stem}.predictions.parquet"),
+        os.path.join(output_dir, f"{stem}.stats.parquet"),
+    )
+
+
+def write_table(table: pa.Table, path: str) -> None:
+    """Write a parquet file atomically, so a crash never leaves a partial file behind."""
+    tmp_path = f"{path}.tmp"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def label_names(parquet_file: pq.ParquetFile) -> Optional[List[str]]:
+    """Class names for the `label` column, from the datasets metadata stored in the shard."""
+    features = Features.from_arrow_schema(parquet_file.schema_arrow)
+    label = features.get("label")
+    return getattr(label, "names", None)
+
+
+def run_shard(
+    shard_path: str,
+    backend: Backend,
+    pool: ProcessPoolExecutor,
+    output_dir: str,
+    batch_size: int,
+    prefetch: int,
+    top_k: int,
+) -> Dict[str, Any]:
+    """Classify every image in a shard and write its predictions and stats. Returns the stats."""
+    predictions_path, stats_path = output_paths(output_dir, shard_path)
+    parquet_file = pq.ParquetFile(shard_path)
+    names = label_names(parquet_file)
+
+    columns: Dict[str, List[Any]] = {
+        "row": [],
+        "label": [],
+        "predicted_label": [],
+        "score": [],
+        "top_k_labels": [],
+        "top_k_scores": [],
+        "error": [],
+    }
+    pending: Deque[Tuple[Future, List[int]]] = deque()
+    record_batches = parquet_file.iter_batches(batch_size=batch_size, columns=["image", "label"])
+    row = 0
+    decode_wait = inference_time = 0.0
+    start_time = time.perf_counter()
+
+    def submit_next() -> bool:
+        nonlocal row
+        record_batch = next(record_batches, None)
+        if record_batch is None:
+            return False
+        images = record_batch.column("image").to_pylist()
+        labels = record_batch.column("label").to_pylist()
+        contents = [image["bytes"] if image else b"" for image in images]
+        pending.append((pool.submit(decode_batch, contents, backend.resizer), labels))
+        columns["row"].extend(range(row, row + len(contents)))
+        row += len(contents)
+        return True
+
+    # Keep `prefetch` batches decoding in the pool while the model runs the oldest one
+    while len(pending) < prefetch and submit_next():
+        pass
+    while pending:
+        future, labels = pending.popleft()
+        wait_start = time.perf_counter()
+        decoded = future.result()
+        decode_wait += time.perf_counter() - wait_start
+        submit_next()
+
+        items = [(image, top_k) for image, _ in decoded if image is not None]
+        inference_start = time.perf_counter()
+        results = iter(backend.predict(items) if items else [])
+        inference_time += time.perf_counter() - inference_start
+
+        for (image, error), label in zip(decoded, labels):
+            columns["label"].append(names[label] if names is not None else str(label))
+            prediction = next(results) if image is not None else {}
+            top = prediction.get("top_k", [prediction] if prediction else [])
+            columns["predicted_label"].append(prediction.get("label"))
+            columns["score"].append(prediction.get("score"))
+            columns["top_k_labels"].append([entry["label"] for entry in top])
+            columns["top_k_scores"].append([entry["score"] for entry in top])
+            columns["error"].append(error)
+
+    wall_time = time.perf_counter() - start_time
+    columns["correct"] = [
+        predicted == label for predicted, label in zip(columns["predicted_label"], columns["label"])
+    ]
+    write_table(pa.table(columns), predictions_path)
+
+    images = len(columns["row"])
+    errors = sum(error is not None for error in columns["error"])
+    stats = {
+        "shard": os.path.basename(shard_path),
+        "images": images,
+        "errors": errors,
+        "correct": sum(columns["correct"]),
+        "accuracy": sum(columns["correct"]) / (images - errors) if images > errors else 0.0,
+        "wall_seconds": wall_time,
+        "inference_seconds": inference_time,
+        "decode_wait_seconds": decode_wait,
+        "images_per_second": images / wall_time if wall_time else 0.0,
+        "backend": backend.name,
+        "device": backend.device,
+        "batch_size": batch_size,
+    }
+    write_table(pa.Table.from_pylist([stats]), stats_path)
+    return stats
+
+
+def main(
+    data_path: str,
+    output_dir: str,
+    model_path: str,
+    backend_name: str,
+    device: str,
+    batch_size: int,
+    decode_workers: int,
+    prefetch: int,
+    top_k: int,
+    overwrite: bool,
+) -> None:
+    """Run every shard matching `data_path` that hasn't been scored yet, then write the summary."""
+    shards = sorted(glob.glob(data_path))
+    if not shards:
+        raise SystemExit(f"No parquet shards match {data_path}")
+    os.makedirs(output_dir, exist_ok=True)
+    todo = [
+        shard
+        for shard in shards
+        if overwrite or not os.path.exists(output_paths(output_dir, shard)[1])
+    ]
+    logger.info(f"{len(todo)} of {len(shards)} shard(s) to score, {len(shards) - len(todo)} done")
+
+    if todo:
+        # Fork the decode workers before the model touches CUDA, which can't be used after a fork
+        pool = ProcessPoolExecutor(decode_workers, mp_context=multiprocessing.get_context("fork"))
+        pool.submit(os.getpid).result()
+        try:
+            backend = create_backend(backend_name, model_path, device)
+            backend.predict([(Image.new("RGB", backend.image_size), top_k)])  # Warm-up
+            for shard in todo:
+                stats = run_shard(shard, backend, pool, output_dir, batch_size, prefetch, top_k)
+                logger.info(
+                    f"{stats['shard']}: {stats['images']} images, "
+                    f"accuracy {stats['accuracy']:.4f}, {stats['images_per_second']:.1f} images/s, "
+                    f"waited {stats['decode_wait_seconds']:.1f}s on decoding"
+                )
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    summary = pa.concat_tables(
+        [pq.read_table(output_paths(output_dir, shard)[1]) for shard in shards]
+    )
+    write_table(summary, os.path.join(output_dir, "summary.parquet"))
+    images = sum(summary.column("images").to_pylist())
+    errors = sum(summary.column("errors").to_pylist())
+    correct = sum(summary.column("correct").to_pylist())
+    wall_time = sum(summary.column("wall_seconds").to_pylist())
+    logger.info(
+        f"All {len(shards)} shard(s): {images} images, accuracy "
+        f"{correct / max(images - errors, 1):.4f}, {images / wall_time:.1f} images/s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline Batch Inference")
+    parser.add_argument(
+        "--data_path",
+        type=str,
+        default="./food101_data/data/*.parquet",
+        help="Glob of parquet shards to score",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default="./predictions",
+        help="Directory for the predictions and stats parquet files",
+    )
+    parser.add_argument(
+        "--model_path",
+        type=str,
+        default="/workspace/models/nateraw/food",
+        help="Path to the model checkpoint",
+    )
+    parser.add_argument(
+        "--backend", type=str, default="pytorch", help="Inference backend (default: pytorch)"
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="Device to run on",
+    )
+    parser.add_argument("--batch_size", type=int, default=256, help="Batch size (default: 256)")
+    parser.add_argument(
+        "--decode_workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Processes decoding images (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=None,
+        help="Batches decoded ahead of the model (default: one per decode worker)",
+    )
+    parser.add_argument("--top_k", type=int, default=1, help="Labels to keep per image")
+    parser.add_argument(
+        "--overwrite", action="store_true", help="Score shards again even if already done"
+    )
+    args = parser.parse_args()
+
+    main(
+        args.data_path,
+        args.output_dir,
+        args.model_path,
+        args.backend,
+        args.device,
+        args.batch_size,
+        args.decode_workers,
+        args.prefetch or args.decode_workers,
+        args.top_k,
+        args.overwrite,
+    )
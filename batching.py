@@ -0,0 +1,269 @@
+"""Dynamic micro-batching of images from concurrent requests into shared forward passes."""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from concurrent.futures import Executor
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+
+logger = logging.getLogger(__name__)
+
+
+def split_into_chunks(sizes: Sequence[int], max_items: int, max_bytes: int) -> List[List[int]]:
+    """Group consecutive items into chunks of at most `max_items` and `max_bytes` in total.
+
+    `sizes` is the estimated memory for each item. Returns the indices in each chunk, in order. An
+    item bigger than `max_bytes` on its own still gets a chunk, by itself.
+    """
+    chunks: List[List[int]] = []
+    chunk: List[int] = []
+    chunk_bytes = 0
+    for i, size in enumerate(sizes):
+        if chunk and (len(chunk) >= max_items or chunk_bytes + size > max_bytes):
+            chunks.append(chunk)
+            chunk, chunk_bytes = [], 0
+        chunk.append(i)
+        chunk_bytes += size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+class DeadlineExceeded(Exception):
+    """Raised for images whose request's deadline passed before they reached a forward pass."""
+
+
+class BatchResults(list):
+    """The results of one batch, with how long each stage of running it took, in seconds."""
+
+    def __init__(self, results: List[Any], timings: Dict[str, float]):
+        super().__init__(results)
+        self.timings = timings
+
+
+class BatchItem:
+    """A single image waiting for a forward pass, and the future its caller awaits.
+
+    Items are ordered by priority class, lower first, then by deadline, then by arrival.
+    `deadline` is a Unix time.
+    """
+
+    sequence = itertools.count()
+
+    def __init__(
+        self, image: Any, future: asyncio.Future, priority: int, deadline: Optional[float]
+    ):
+        self.image = image
+        self.future = future
+        self.priority = priority
+        self.deadline = deadline
+        self.order = (priority, math.inf if deadline is None else deadline, next(self.sequence))
+        self.enqueued_at = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+
+    def __lt__(self, other: "BatchItem") -> bool:
+        """Whether this item should run before `other`."""
+        return self.order < other.order
+
+
+class BatchScheduler:
+    """Collect images from concurrent requests into batches and fan the results back out.
+
+    A batch is dispatched as soon as `max_batch_size` images are queued, or `max_wait_ms` after the
+    first image of the batch arrived, whichever comes first. `run_batch` is called on `executor`
+    so forward passes never block the event loop, with at most `max_concurrency` batches running
+    at once. While every slot is busy, new images keep queueing and form larger batches.
+    `run_batch` may return BatchResults to report how long the stages of the batch took.
+
+    The queue is ordered by priority class, then earliest deadline, so under load urgent work
+    goes first. Images whose deadline has passed are failed with DeadlineExceeded instead of
+    being run, and images whose caller was cancelled are skipped.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        executor: Optional[Executor] = None,
+        max_concurrency: int = 1,
+        on_batch: Optional[Callable[[int, int], None]] = None,
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        self.on_batch = on_batch
+        self.queue: List[BatchItem] = []
+        self.not_empty = asyncio.Event()
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.task: Optional[asyncio.Task] = None
+        self.in_flight: Set[asyncio.Task] = set()
+        self.batches_run = 0
+        self.images_processed = 0
+        self.images_expired = 0
+        self.last_batch_size = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of images waiting to be batched."""
+        return len(self.queue)
+
+    async def submit(
+        self,
+        images: List[Any],
+        timings: Optional[Dict[str, float]] = None,
+        priority: int = 0,
+        deadline: Optional[float] = None,
+    ) -> List[Any]:
+        """Queue images for classification and wait for their results, in order.
+
+        If `timings` is given, the time the images spent queued and in each stage of their
+        batches is added to it. When they were split across batches, the slowest one counts.
+        Raises DeadlineExceeded if `deadline`, a Unix time, passes before they are run.
+        """
+        loop = asyncio.get_running_loop()
+        items = [BatchItem(image, loop.create_future(), priority, deadline) for image in images]
+        for item in items:
+            heapq.heappush(self.queue, item)
+        self.not_empty.set()
+        try:
+            results = await asyncio.gather(*(item.future for item in items))
+        except BaseException:
+            # Don't run the rest of a request that was cancelled or has already failed
+            for item in items:
+                item.future.cancel()
+            raise
+        if timings is not None:
+            slowest: Dict[str, float] = {}
+            for item in items:
+                for stage, seconds in item.timings.items():
+                    slowest[stage] = max(slowest.get(stage, 0.0), seconds)
+            for stage, seconds in slowest.items():
+                timings[stage] = timings.get(stage, 0.0) + seconds
+        return results
+
+    def start(self) -> None:
+        """Start the background batching loop on the running event loop."""
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """Stop the batching loop and fail anything still queued or running."""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for task in list(self.in_flight):
+            task.cancel()
+        while self.queue:
+            item = heapq.heappop(self.queue)
+            if not item.future.done():
+                item.future.set_exception(RuntimeError("Batch scheduler stopped"))
+
+    async def run(self) -> None:
+        """Form and dispatch batches until cancelled."""
+        while True:
+            await self.slots.acquire()
+            batch = await self.next_batch()
+            if not batch:
+                self.slots.release()
+                continue
+            task = asyncio.create_task(self.dispatch(batch))
+            self.in_flight.add(task)
+            task.add_done_callback(self.finish_dispatch)
+
+    def finish_dispatch(self, task: asyncio.Task) -> None:
+        """Free the concurrency slot held by a finished batch."""
+        self.in_flight.discard(task)
+        self.slots.release()
+
+    async def next_batch(self) -> List[BatchItem]:
+        """Wait for the first image, then up to `max_wait` for the batch to fill."""
+        await self.not_empty.wait()
+        deadline = time.perf_counter() + self.max_wait
+        while len(self.queue) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            self.not_empty.clear()
+            try:
+                await asyncio.wait_for(self.not_empty.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+
+        batch: List[BatchItem] = []
+        now = time.time()
+        while self.queue and len(batch) < self.max_batch_size:
+            item = heapq.heappop(self.queue)
+            # Skip images whose request was cancelled while they were queued
+            if item.future.done():
+                continue
+            if item.deadline is not None and item.deadline <= now:
+                self.images_expired += 1
+                item.future.set_exception(DeadlineExceeded("Deadline passed while queued"))
+                continue
+            batch.append(item)
+        if not self.queue:
+            self.not_empty.clear()
+        return batch
+
+    async def dispatch(self, batch: List[BatchItem]) -> None:
+        """Run one forward pass over the batch and resolve each caller's future."""
+        self.batches_run += 1
+        self.images_processed += len(batch)
+        self.last_batch_size = len(batch)
+        if self.on_batch is not None:
+            self.on_batch(len(batch), self.queue_depth)
+
+        loop = asyncio.get_running_loop()
+        dispatched_at = time.perf_counter()
+        try:
+            results = await loop.run_in_executor(
+                self.executor, self.run_batch, [item.image for item in batch]
+            )
+        except Exception as e:
+            logger.error(f"Error running batch of {len(batch)} image(s): {e}")
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+        except asyncio.CancelledError:
+            # The scheduler is stopping, so the callers would otherwise wait forever
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(RuntimeError("Batch scheduler stopped"))
+            raise
+
+        batch_timings = results.timings if isinstance(results, BatchResults) else {}
+        for item, result in zip(batch, results):
+            item.timings = {"queue_wait": dispatched_at - item.enqueued_at, **batch_timings}
+            if not item.future.done():
+                item.future.set_result(result)
+
+    def stats(self) -> Dict[str, float]:
+        """Queue depth and batch size statistics for tuning throughput against latency."""
+        return {
+            "queue_depth": self.queue_depth,
+            "batches_run": self.batches_run,
+            "images_processed": self.images_processed,
+            "images_expired": self.images_expired,
+            "last_batch_size": self.last_batch_size,
+            "avg_batch_size": self.images_processed / self.batches_run if self.batches_run else 0.0,
+            "batches_in_flight": len(self.in_flight),
+            "max_concurrency": self.max_concurrency,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+        }
@@ -0,0 +1,290 @@
+"""Measure throughput and latency of the inference stack under a configurable load.
+
+Two kinds of load are supported:
+
+- Closed loop (`--concurrency N`): N clients each send a request as soon as their last one
+  finishes. This finds the maximum throughput.
+- Open loop (`--rate R`): requests arrive as a Poisson process at R per second, whether or not
+  earlier ones have finished. This shows how latency grows with load. Latency is measured from
+  when each request was due to be sent, so a backed-up client doesn't hide queueing.
+
+Use `fake_inference.py` as the upstream to benchmark the proxy without a GPU:
+
+    FAKE_SERVICE_TIME_MS=20 uvicorn fake_inference:app --port 8001 &
+    INFERENCE_ENDPOINTS=http://127.0.0.1:8001/classify/ uvicorn proxy:app --port 8000 &
+    python benchmark.py --mode local --concurrency 32 --duration 30
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+from collections import Counter
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import httpx
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+# httpx logs every request at INFO, which would drown out the results
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+API_ENDPOINTS = {
+    "local": "http://127.0.0.1:8000/classify/",
+    "proxy": "http://159.89.242.75/classify/",
+    "direct": "https://dmtzq4wskj5l46-8000.proxy.runpod.net/classify/",
+}
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, math.inf]
+
+
+class Result:
+    """Outcome of one request: when it was due, how long it took and its status or error."""
+
+    def __init__(self, due_at: float, latency: float, status: Optional[int], error: Optional[str]):
+        self.due_at = due_at
+        self.latency = latency
+        self.status = status
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        """Whether the request got a 2xx response."""
+        return self.status is not None and 200 <= self.status < 300
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    """The q-th percentile of an already sorted list, by the nearest-rank method."""
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def latency_histogram(latencies: List[float]) -> List[Tuple[float, int]]:
+    """Count latencies, in seconds, into HISTOGRAM_BUCKETS_MS."""
+    counts = [0] * len(HISTOGRAM_BUCKETS_MS)
+    for latency in latencies:
+        for i, bound in enumerate(HISTOGRAM_BUCKETS_MS):
+            if latency * 1000 <= bound:
+                counts[i] += 1
+                break
+    return list(zip(HISTOGRAM_BUCKETS_MS, counts))
+
+
+def summarize(results: List[Result], duration: float, images_per_request: int) -> Dict[str, Any]:
+    """Throughput, latency percentiles of successful requests, and error counts."""
+    latencies = sorted(result.latency for result in results if result.ok)
+    successes = len(latencies)
+    return {
+        "requests": len(results),
+        "successes": successes,
+        "errors": dict(
+            Counter(str(result.status or result.error) for result in results if not result.ok)
+        ),
+        "duration_seconds": duration,
+        "requests_per_second": successes / duration if duration else 0.0,
+        "images_per_second": successes * images_per_request / duration if duration else 0.0,
+        "latency_ms": {
+            "mean": sum(latencies) / successes * 1000 if successes else 0.0,
+            "p50": percentile(latencies, 50) * 1000,
+            "p95": percentile(latencies, 95) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+            "max": latencies[-1] * 1000 if latencies else 0.0,
+        },
+        "histogram": [
+            {"le_ms": bound, "count": count} for bound, count in latency_histogram(latencies)
+        ],
+    }
+
+
+class LoadGenerator:
+    """Sends identical classification requests and records each one's latency."""
+
+    def __init__(
+        self,
+        url: str,
+        image: bytes,
+        images_per_request: int,
+        headers: Dict[str, str],
+        timeout: float,
+        max_connections: int,
+    ):
+        self.url = url
+        self.files = [
+            ("files", (f"image_{i}.jpg", image, "image/jpeg")) for i in range(images_per_request)
+        ]
+        self.headers = headers
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_connections, max_keepalive_connections=max_connections
+            ),
+        )
+        self.results: List[Result] = []
+        self.recording = False
+
+    async def send(self, due_at: float) -> None:
+        """Send one request, timing it from `due_at`, and record it unless still warming up."""
+        status = error = None
+        try:
+            response = await self.client.post(self.url, files=self.files, headers=self.headers)
+            status = response.status_code
+        except httpx.HTTPError as e:
+            error = type(e).__name__
+        if self.recording:
+            self.results.append(Result(due_at, time.perf_counter() - due_at, status, error))
+
+    async def closed_loop(self, concurrency: int, until: float) -> None:
+        """Run `concurrency` clients back to back until `until`."""
+
+        async def client() -> None:
+            while time.perf_counter() < until:
+                await self.send(time.perf_counter())
+
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+
+    async def open_loop(self, rate: float, until: float) -> None:
+        """Start requests at Poisson-distributed times averaging `rate` per second until `until`."""
+        tasks = set()
+        due_at = time.perf_counter()
+        while due_at < until:
+            await asyncio.sleep(max(0.0, due_at - time.perf_counter()))
+            task = asyncio.create_task(self.send(due_at))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            due_at += random.expovariate(rate)
+        await asyncio.gather(*tasks)
+
+    async def run(
+        self, concurrency: int, rate: Optional[float], warmup: float, duration: float
+    ) -> float:
+        """Warm up, then generate load for `duration` seconds. Returns the measured duration."""
+        load = (
+            (lambda until: self.open_loop(rate, until))
+            if rate
+            else (lambda until: self.closed_loop(concurrency, until))
+        )
+        try:
+            if warmup > 0:
+                await load(time.perf_counter() + warmup)
+            self.recording = True
+            start_time = time.perf_counter()
+            await load(start_time + duration)
+            return time.perf_counter() - start_time
+        finally:
+            await self.client.aclose()
+
+
+def report(summary: Dict[str, Any]) -> None:
+    """Log the summary as a table with a text histogram."""
+    latency = summary["latency_ms"]
+    logger.info(
+        f"{summary['successes']}/{summary['requests']} requests succeeded in "
+        f"{summary['duration_seconds']:.1f}s: {summary['requests_per_second']:.1f} requests/s, "
+        f"{summary['images_per_second']:.1f} images/s"
+    )
+    if summary["errors"]:
+        logger.info(f"Errors: {summary['errors']}")
+    logger.info(
+        f"Latency (ms): mean {latency['mean']:.1f}, p50 {latency['p50']:.1f}, "
+        f"p95 {latency['p95']:.1f}, p99 {latency['p99']:.1f}, max {latency['max']:.1f}"
+    )
+    peak = max((bucket["count"] for bucket in summary["histogram"]), default=0)
+    for bucket in summary["histogram"]:
+        label = "+Inf" if math.isinf(bucket["le_ms"]) else f"{bucket['le_ms']:g}"
+        bar = "#" * round(40 * bucket["count"] / peak) if peak else ""
+        logger.info(f"  <= {label:>6} ms {bucket['count']:>7} {bar}")
+
+
+def main(
+    url: str,
+    inference_endpoint: Optional[str],
+    image_path: str,
+    images_per_request: int,
+    concurrency: int,
+    rate: Optional[float],
+    warmup: float,
+    duration: float,
+    timeout: float,
+    output: Optional[str],
+) -> Dict[str, Any]:
+    """Run the benchmark, log the results and optionally save them as JSON."""
+    with open(image_path, "rb") as f:
+        image = f.read()
+    headers = {"X-Inference-Endpoint": inference_endpoint} if inference_endpoint else {}
+    load = f"{rate} requests/s" if rate else f"{concurrency} concurrent clients"
+    logger.info(
+        f"Benchmarking {url} with {load} and {images_per_request} image(s) per request "
+        f"for {duration}s after {warmup}s of warm-up"
+    )
+
+    # An open loop needs a connection per outstanding request, not one per client
+    max_connections = max(concurrency, 1000 if rate else 0)
+    generator = LoadGenerator(url, image, images_per_request, headers, timeout, max_connections)
+    measured = asyncio.run(generator.run(concurrency, rate, warmup, duration))
+    summary = summarize(generator.results, measured, images_per_request)
+    report(summary)
+    if output:
+        with open(output, "w") as f:
+            json.dump(summary, f, indent=2, default=str)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inference Benchmark")
+    parser.add_argument(
+        "--mode", choices=list(API_ENDPOINTS.keys()), default="local", help="API endpoint to use"
+    )
+    parser.add_argument("--url", type=str, help="Classify URL to use instead of --mode's")
+    parser.add_argument(
+        "--inference_endpoint",
+        type=str,
+        help="X-Inference-Endpoint header to send, for a proxy without INFERENCE_ENDPOINTS",
+    )
+    parser.add_argument(
+        "--image", type=str, default="tests/french_toast.jpeg", help="Image to send"
+    )
+    parser.add_argument(
+        "--images_per_request", type=int, default=1, help="Images per request (default: 1)"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Concurrent clients in closed-loop mode (default: 8)",
+    )
+    parser.add_argument(
+        "--rate", type=float, help="Requests per second in open-loop mode, instead of concurrency"
+    )
+    parser.add_argument("--warmup", type=float, default=5.0, help="Seconds of warm-up")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to measure")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Request timeout in seconds")
+    parser.add_argument("--output", type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    # Like api_call.py, the proxy is pointed at the GPU server unless told otherwise
+    inference_endpoint = args.inference_endpoint
+    if inference_endpoint is None and args.mode == "proxy" and not args.url:
+        inference_endpoint = API_ENDPOINTS["direct"]
+
+    main(
+        args.url or API_ENDPOINTS[args.mode],
+        inference_endpoint,
+        args.image,
+        args.images_per_request,
+        args.concurrency,
+        args.rate,
+        args.warmup,
+        args.duration,
+        args.timeout,
+        args.output,
+    )
@@ -0,0 +1,197 @@
+"""Compare inference throughput on a CPU node across gunicorn worker and thread splits.
+
+Each split is `<workers>` or `<workers>x<threads>`, e.g. `2x4` for two workers with four intra-op
+threads each. Without `x<threads>`, the CPU planner sizes the threads to each worker's cores. For
+each split, the inference server is started under gunicorn on the CPU, benchmarked with
+benchmark.py's closed-loop load once it is ready, and stopped. A table of the results comes last:
+
+    python benchmark_cpu_splits.py --splits 1,2,4,2x8 --concurrency 32 --duration 30
+
+`--compare_unplanned` also runs each worker count with CPU_PLAN=false, where every worker keeps
+PyTorch's default of one thread per core, to show what oversubscribing the cores costs.
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import httpx
+
+import benchmark
+
+logger = logging.getLogger(__name__)
+
+READY_TIMEOUT = 300
+
+
+def parse_split(split: str) -> Tuple[int, Optional[int]]:
+    """Workers and intra-op threads per worker from `<workers>[x<threads>]`."""
+    workers, _, threads = split.lower().partition("x")
+    return int(workers), int(threads) if threads else None
+
+
+def start_server(
+    workers: int, threads: Optional[int], planned: bool, port: int, log_path: str
+) -> subprocess.Popen:
+    """Start the inference server under gunicorn with the split, on the CPU only."""
+    env = os.environ.copy()
+    # Every request sends the same image, which would otherwise be served from the cache
+    env.update(
+        {
+            "CUDA_VISIBLE_DEVICES": "",
+            "CPU_PLAN": "true" if planned else "false",
+            "PREDICTION_CACHE_MAX_ENTRIES": "0",
+        }
+    )
+    if threads is not None:
+        env["INTRA_OP_THREADS"] = str(threads)
+    with open(log_path, "ab") as log:
+        return subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "gunicorn",
+                "--config",
+                "gunicorn_inference.conf.py",
+                "inference:app",
+                "--worker-class",
+                "uvicorn.workers.UvicornWorker",
+                "--workers",
+                str(workers),
+                "--bind",
+                f"127.0.0.1:{port}",
+            ],
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+
+
+def wait_until_ready(server: subprocess.Popen, port: int, workers: int) -> None:
+    """Poll the readiness probe until every worker has answered that it is ready.
+
+    Each probe lands on any one worker, so this waits until as many worker PIDs as there are
+    workers have answered 200.
+    """
+    deadline = time.monotonic() + READY_TIMEOUT
+    ready_workers = set()
+    while len(ready_workers) < workers:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with {server.returncode} before it was ready")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Server was not ready after {READY_TIMEOUT}s")
+        try:
+            response = httpx.get(f"http://127.0.0.1:{port}/readyz", timeout=1)
+            if response.status_code == 200:
+                ready_workers.add(response.json()["worker"])
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+
+
+def stop_server(server: subprocess.Popen) -> None:
+    """Stop gunicorn and its workers, forcefully if they don't exit in time."""
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def run_split(split: str, planned: bool, args: argparse.Namespace) -> Dict[str, Any]:
+    """Benchmark one split and return its summary, labelled with the split."""
+    workers, threads = parse_split(split)
+    label = split if planned else f"{workers} unplanned"
+    logger.info(f"Starting {label}")
+    server = start_server(workers, threads, planned, args.port, args.server_log)
+    try:
+        wait_until_ready(server, args.port, workers)
+        summary = benchmark.main(
+            f"http://127.0.0.1:{args.port}/classify/",
+            None,
+            args.image,
+            args.images_per_request,
+            args.concurrency,
+            None,
+            args.warmup,
+            args.duration,
+            args.timeout,
+            None,
+        )
+    finally:
+        stop_server(server)
+    return {"split": label, "workers": workers, "threads": threads, **summary}
+
+
+def report(results: List[Dict[str, Any]]) -> None:
+    """Log throughput and latency per split, side by side."""
+    logger.info(f"{'split':<14} {'images/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for result in results:
+        latency = result["latency_ms"]
+        errors = sum(result["errors"].values())
+        logger.info(
+            f"{result['split']:<14} {result['images_per_second']:>9.1f} "
+            f"{latency['p50']:>8.1f} {latency['p99']:>8.1f} {errors:>7}"
+        )
+
+
+def main(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Benchmark every split, log the comparison and optionally save it as JSON."""
+    logger.info(f"{len(os.sched_getaffinity(0))} core(s) available")
+    results = []
+    for split in args.splits.split(","):
+        results.append(run_split(split, True, args))
+    if args.compare_unplanned:
+        for workers in sorted({parse_split(split)[0] for split in args.splits.split(",")}):
+            results.append(run_split(str(workers), False, args))
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU worker and thread split benchmark")
+    parser.add_argument(
+        "--splits",
+        type=str,
+        default="1,2,4",
+        help="Comma separated <workers>[x<threads>] splits to compare (default: 1,2,4)",
+    )
+    parser.add_argument(
+        "--compare_unplanned",
+        action="store_true",
+        help="Also run each worker count with CPU_PLAN=false",
+    )
+    parser.add_argument("--port", type=int, default=8010, help="Port to run the server on")
+    parser.add_argument(
+        "--server_log",
+        type=str,
+        default="cpu_splits_server.log",
+        help="File to append the server's output to",
+    )
+    parser.add_argument(
+        "--image", type=str, default="tests/french_toast.jpeg", help="Image to send"
+    )
+    parser.add_argument(
+        "--images_per_request", type=int, default=1, help="Images per request (default: 1)"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=16, help="Concurrent clients (default: 16)"
+    )
+    parser.add_argument("--warmup", type=float, default=5.0, help="Seconds of warm-up per split")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds to measure per split")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Request timeout in seconds")
+    parser.add_argument("--output", type=str, help="Write the results to this JSON file")
+    main(parser.parse_args())
@@ -0,0 +1,131 @@
+"""Check that the faster backends agree with the PyTorch model on the food101 validation set."""
+
+import argparse
+import logging
+import sys
+import time
+from typing import List
+from typing import Tuple
+
+import torch
+from datasets import Image as ImageFeature
+from datasets import load_dataset
+from PIL import Image
+
+from backends import Backend
+from backends import create_backend
+from decoding import decode_image
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+
+def classify_all(
+    backend: Backend, images: List[Image.Image], batch_size: int
+) -> Tuple[List[str], float]:
+    """Top-1 label for every image, and the throughput in images per second."""
+    backend.predict([(images[0], 1)])  # Warm-up
+
+    labels = []
+    start_time = time.perf_counter()
+    for i in range(0, len(images), batch_size):
+        batch = [(image, 1) for image in images[i : i + batch_size]]
+        labels.extend(prediction["label"] for prediction in backend.predict(batch))
+    return labels, len(images) / (time.perf_counter() - start_time)
+
+
+def main(
+    data_path: str,
+    model_path: str,
+    backends: List[str],
+    num_images: int,
+    batch_size: int,
+    device: str,
+    min_agreement: float,
+) -> bool:
+    """Compare each backend's top-1 predictions against the PyTorch reference."""
+    dataset = load_dataset("parquet", data_files={"validation": data_path})["validation"]
+    # Decode with the same code path as the inference server, not the datasets library
+    dataset = dataset.cast_column("image", ImageFeature(decode=False))
+    dataset = dataset.select(range(min(num_images, len(dataset))))
+    images = [decode_image(example["image"]["bytes"]) for example in dataset]
+    true_labels = [dataset.features["label"].int2str(label) for label in dataset["label"]]
+    logger.info(f"Loaded {len(images)} validation images from {data_path}")
+
+    reference, reference_speed = classify_all(
+        create_backend("pytorch", model_path, device), images, batch_size
+    )
+    reference_accuracy = sum(a == b for a, b in zip(reference, true_labels)) / len(images)
+    logger.info(
+        f"pytorch: accuracy {reference_accuracy:.4f}, {reference_speed:.1f} images/s (reference)"
+    )
+
+    all_passed = True
+    for name in backends:
+        predictions, speed = classify_all(
+            create_backend(name, model_path, device), images, batch_size
+        )
+        agreement = sum(a == b for a, b in zip(predictions, reference)) / len(images)
+        accuracy = sum(a == b for a, b in zip(predictions, true_labels)) / len(images)
+        passed = agreement >= min_agreement
+        all_passed = all_passed and passed
+        logger.info(
+            f"{name}: top-1 agreement {agreement:.4f}, accuracy {accuracy:.4f}, "
+            f"{speed:.1f} images/s ({speed / reference_speed:.2f}x), "
+            f"{'PASS' if passed else 'FAIL'}"
+        )
+
+    return all_passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backend Accuracy Check")
+    parser.add_argument(
+        "--data_path",
+        type=str,
+        default="./food101_data/data/validation-*.parquet",
+        help="Path to validation data",
+    )
+    parser.add_argument(
+        "--model_path",
+        type=str,
+        default="/workspace/models/nateraw/food",
+        help="Path to the model checkpoint",
+    )
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=["int8", "onnx"],
+        help="Backends to compare against the pytorch backend (default: int8 onnx)",
+    )
+    parser.add_argument(
+        "--num_images",
+        type=int,
+        default=1000,
+        help="Number of validation images to compare on (default: 1000)",
+    )
+    parser.add_argument("--batch_size", type=int, default=32, help="Batch size (default: 32)")
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="Device to run on",
+    )
+    parser.add_argument(
+        "--min_agreement",
+        type=float,
+        default=0.99,
+        help="Lowest top-1 agreement with pytorch that counts as a pass (default: 0.99)",
+    )
+    args = parser.parse_args()
+
+    passed = main(
+        args.data_path,
+        args.model_path,
+        args.backends,
+        args.num_images,
+        args.batch_size,
+        args.device,
+        args.min_agreement,
+    )
+    sys.exit(0 if passed else 1)
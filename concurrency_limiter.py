@@ -0,0 +1,215 @@
+"""Adaptive concurrency limiting and load shedding for requests forwarded to the inference servers.
+
+The limiter caps how many requests are forwarded at once, and the cap adapts with AIMD. It grows
+by one every `limit` requests that finish quickly while the limit is in use. It shrinks by a
+constant factor when requests fail upstream or take much longer than the baseline. The baseline
+is the fastest request seen recently, i.e. the latency without queueing. Requests over the limit
+wait in a short, bounded queue. Once that is full, or a request has waited too long, requests are
+rejected immediately instead of piling up until the upstream timeout.
+"""
+
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any
+from typing import AsyncIterator
+from typing import Deque
+from typing import Dict
+from typing import Optional
+
+from metrics import MetricsAggregator
+
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "true").lower() == "true"
+CONCURRENCY_INITIAL_LIMIT = int(os.getenv("CONCURRENCY_INITIAL_LIMIT", "20"))
+CONCURRENCY_MIN_LIMIT = int(os.getenv("CONCURRENCY_MIN_LIMIT", "4"))
+CONCURRENCY_MAX_LIMIT = int(os.getenv("CONCURRENCY_MAX_LIMIT", "200"))
+CONCURRENCY_LATENCY_TOLERANCE = float(os.getenv("CONCURRENCY_LATENCY_TOLERANCE", "2.0"))
+CONCURRENCY_BACKOFF = float(os.getenv("CONCURRENCY_BACKOFF", "0.9"))
+CONCURRENCY_BASELINE_WINDOW = float(os.getenv("CONCURRENCY_BASELINE_WINDOW", "60.0"))
+CONCURRENCY_MAX_QUEUE = int(os.getenv("CONCURRENCY_MAX_QUEUE", "50"))
+CONCURRENCY_QUEUE_TIMEOUT = float(os.getenv("CONCURRENCY_QUEUE_TIMEOUT", "2.0"))
+
+
+class LimitExceeded(Exception):
+    """Raised instead of admitting a request, with the status and Retry-After to answer with."""
+
+    def __init__(self, status_code: int, reason: str, retry_after: int):
+        super().__init__(f"Proxy is overloaded ({reason}), retry after {retry_after}s")
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Permit:
+    """An admitted request. Set `dropped` if the upstream failed it, to back off the limit."""
+
+    def __init__(self) -> None:
+        self.dropped = False
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD concurrency limit with a bounded FIFO wait queue, for the event loop thread only."""
+
+    def __init__(
+        self,
+        enabled: bool = ADAPTIVE_CONCURRENCY,
+        initial_limit: int = CONCURRENCY_INITIAL_LIMIT,
+        min_limit: int = CONCURRENCY_MIN_LIMIT,
+        max_limit: int = CONCURRENCY_MAX_LIMIT,
+        latency_tolerance: float = CONCURRENCY_LATENCY_TOLERANCE,
+        backoff: float = CONCURRENCY_BACKOFF,
+        baseline_window: float = CONCURRENCY_BASELINE_WINDOW,
+        max_queue: int = CONCURRENCY_MAX_QUEUE,
+        queue_timeout: float = CONCURRENCY_QUEUE_TIMEOUT,
+        metrics_aggregator: Optional[MetricsAggregator] = None,
+    ):
+        self.enabled = enabled
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.baseline_window = baseline_window
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.metrics_aggregator = metrics_aggregator
+
+        self.in_flight = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.window_min_latency = math.inf
+        self.previous_window_min_latency = math.inf
+        self.window_started_at = time.monotonic()
+        self.last_decrease_at = 0.0
+        self.rejected = 0
+
+    @property
+    def baseline_latency(self) -> float:
+        """Fastest request over the last one to two baseline windows, or 0 before any finished."""
+        baseline = min(self.window_min_latency, self.previous_window_min_latency)
+        return 0.0 if math.isinf(baseline) else baseline
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Permit]:
+        """Hold one of the limited slots for the duration of the block.
+
+        Raises LimitExceeded when the wait queue is full or the request waited longer than
+        `queue_timeout` for a slot.
+        """
+        await self.wait_for_slot()
+        permit = Permit()
+        start_time = time.monotonic()
+        try:
+            yield permit
+        except BaseException:
+            # Only failures blamed on the upstream say anything about its capacity
+            self.release(time.monotonic() - start_time, permit.dropped, sample=permit.dropped)
+            raise
+        self.release(time.monotonic() - start_time, permit.dropped)
+
+    async def wait_for_slot(self) -> None:
+        """Take a slot now, or queue for one."""
+        if not self.enabled or (self.in_flight < int(self.limit) and not self.waiters):
+            self.in_flight += 1
+            self.record_state()
+            return
+        if len(self.waiters) >= self.max_queue:
+            raise self.reject(429, "queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.record_state()
+        start_time = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.give_up(waiter)
+            raise self.reject(503, "queue_timeout")
+        except asyncio.CancelledError:
+            self.give_up(waiter)
+            raise
+        if self.metrics_aggregator is not None:
+            self.metrics_aggregator.observe(
+                "proxy.concurrency.queue_wait", time.monotonic() - start_time
+            )
+
+    def give_up(self, waiter: asyncio.Future) -> None:
+        """Leave the queue after timing out or being cancelled."""
+        if waiter.done() and not waiter.cancelled():
+            # The slot was handed over just as the request gave up, so pass it on
+            self.in_flight -= 1
+            self.wake_waiters()
+            self.record_state()
+        else:
+            self.discard(waiter)
+
+    def discard(self, waiter: asyncio.Future) -> None:
+        """Remove a waiter that gave up from the queue."""
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass
+        self.record_state()
+
+    def reject(self, status_code: int, reason: str) -> LimitExceeded:
+        """Count a rejection and build the error, with a Retry-After for the queue to drain."""
+        self.rejected += 1
+        if self.metrics_aggregator is not None:
+            self.metrics_aggregator.increment("proxy.concurrency.rejected", 1, [f"reason:{reason}"])
+        drain_time = self.baseline_latency * (len(self.waiters) + 1) / self.limit
+        return LimitExceeded(status_code, reason, max(1, math.ceil(drain_time)))
+
+    def release(self, latency: float, dropped: bool, sample: bool = True) -> None:
+        """Free a slot, adjust the limit from how the request went, and admit the next waiter."""
+        self.in_flight -= 1
+        if sample:
+            self.adjust_limit(latency, dropped)
+        self.wake_waiters()
+        self.record_state()
+
+    def adjust_limit(self, latency: float, dropped: bool) -> None:
+        """Additive increase on fast requests, multiplicative decrease on slow or failed ones."""
+        now = time.monotonic()
+        if now - self.window_started_at > self.baseline_window:
+            self.previous_window_min_latency = self.window_min_latency
+            self.window_min_latency = math.inf
+            self.window_started_at = now
+        self.window_min_latency = min(self.window_min_latency, latency)
+
+        baseline = self.baseline_latency
+        if dropped or latency > baseline * self.latency_tolerance:
+            # Back off at most once per request duration, not once for every slow request
+            if now - self.last_decrease_at >= latency:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.last_decrease_at = now
+        elif self.in_flight + 1 >= self.limit / 2:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def wake_waiters(self) -> None:
+        """Hand free slots to queued requests, oldest first."""
+        while self.waiters and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def record_state(self) -> None:
+        """Export the limit, requests in flight and queue length as gauges."""
+        if self.metrics_aggregator is None:
+            return
+        self.metrics_aggregator.gauge("proxy.concurrency.limit", self.limit)
+        self.metrics_aggregator.gauge("proxy.concurrency.in_flight", self.in_flight)
+        self.metrics_aggregator.gauge("proxy.concurrency.queued", len(self.waiters))
+
+    def stats(self) -> Dict[str, Any]:
+        """Current limit, usage and rejections."""
+        return {
+            "enabled": self.enabled,
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queued": len(self.waiters),
+            "baseline_latency_ms": self.baseline_latency * 1000,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,191 @@
+"""Split a CPU node's cores between inference workers, and size each worker's threads to its share.
+
+Left alone, PyTorch in every worker runs one intra-op thread per core of the node, so N workers run
+N times as many threads as there are cores and spend their time preempting each other. The planner
+gives each worker its own slice of the cores instead, pins it there and sets PyTorch's thread
+counts to match. Within a slice, some cores are kept for decoding uploads, so decoding doesn't
+compete with the forward pass for the same cores.
+
+Under gunicorn, the master plans every worker's slice and each worker applies its own after the
+fork (see gunicorn_inference.conf.py). A server started on its own plans for a single worker.
+Nothing is planned on a GPU node unless CPU_PLAN=true asks for it.
+"""
+
+import logging
+import math
+import os
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+logger = logging.getLogger(__name__)
+
+# "auto" plans on nodes without a GPU, where the forward pass runs on the cores. "true" plans on
+# GPU nodes too.
+CPU_PLAN = os.getenv("CPU_PLAN", "auto").lower()
+CPU_AFFINITY = os.getenv("CPU_AFFINITY", "true").lower() == "true"
+# 0 runs one intra-op thread per inference core
+INTRA_OP_THREADS = int(os.getenv("INTRA_OP_THREADS", "0"))
+INTER_OP_THREADS = int(os.getenv("INTER_OP_THREADS", "1"))
+# Cores of each worker's slice kept for decoding. Unset keeps a quarter of them, 0 shares them all.
+DECODE_CORES = int(os.environ["DECODE_CORES"]) if os.getenv("DECODE_CORES") else None
+
+CGROUP_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+
+
+class WorkerPlan(NamedTuple):
+    """The cores one worker runs on and how many threads it runs."""
+
+    slot: int
+    cores: Tuple[int, ...]
+    inference_cores: Tuple[int, ...]
+    decode_cores: Tuple[int, ...]
+    intra_op_threads: int
+    inter_op_threads: int
+    pinned: bool
+
+    def describe(self) -> str:
+        """One line summary for the startup log."""
+        if self.pinned:
+            cores = (
+                f"cores {format_cores(self.cores)} "
+                f"(inference {format_cores(self.inference_cores)}, "
+                f"decode {format_cores(self.decode_cores)})"
+            )
+        else:
+            cores = f"{len(self.cores)} core(s), not pinned"
+        return (
+            f"CPU plan for worker {self.slot}: {cores}, {self.intra_op_threads} intra-op and "
+            f"{self.inter_op_threads} inter-op thread(s)"
+        )
+
+
+# The plan this process applied, if any
+applied_plan: Optional[WorkerPlan] = None
+
+
+def enabled() -> bool:
+    """Whether to plan: CPU_PLAN=true, or CPU_PLAN=auto and PyTorch sees no GPU to run on."""
+    if CPU_PLAN != "auto":
+        return CPU_PLAN == "true"
+    import torch
+
+    return not torch.cuda.is_available()
+
+
+def format_cores(cores: Iterable[int]) -> str:
+    """Cores as a cpuset-style list of ranges, e.g. `0-3,8`."""
+    ranges: List[List[int]] = []
+    for core in sorted(cores):
+        if ranges and core == ranges[-1][1] + 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ",".join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+def available_cores() -> List[int]:
+    """The cores this process may run on, as restricted by its cpuset."""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def cpu_quota(path: str = CGROUP_CPU_MAX) -> Optional[float]:
+    """Cores' worth of CPU time the container's cgroup may use, or None without a limit."""
+    try:
+        with open(path) as f:
+            quota, period = f.read().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        return None
+
+
+def plan_workers(
+    workers: int,
+    cores: List[int],
+    quota: Optional[float] = None,
+    decode_cores: Optional[int] = DECODE_CORES,
+    intra_op_threads: int = INTRA_OP_THREADS,
+    inter_op_threads: int = INTER_OP_THREADS,
+    affinity: bool = CPU_AFFINITY,
+) -> List[WorkerPlan]:
+    """Split the cores evenly between the workers, then each worker's between inference and decode.
+
+    A CPU quota below the number of cores means the container's share of time is spread over cores
+    that other containers run on too. Then only as many cores as the quota allows are planned for,
+    and nothing is pinned. With more workers than cores, workers share cores.
+    """
+    usable = len(cores)
+    pinned = affinity
+    if quota is not None and quota < len(cores):
+        usable = max(1, math.floor(quota))
+        pinned = False
+
+    plans = []
+    for slot in range(workers):
+        # Any remainder goes to the later workers, one core each
+        start = slot * usable // workers
+        end = max(start + 1, (slot + 1) * usable // workers)
+        worker_cores = tuple(cores[i % len(cores)] for i in range(start, end))
+        if decode_cores is None:
+            decode = max(1, len(worker_cores) // 4) if len(worker_cores) > 1 else 0
+        else:
+            decode = min(decode_cores, len(worker_cores) - 1)
+        inference = worker_cores[: len(worker_cores) - decode]
+        plans.append(
+            WorkerPlan(
+                slot=slot,
+                cores=worker_cores,
+                inference_cores=inference,
+                decode_cores=worker_cores[len(inference) :] or worker_cores,
+                intra_op_threads=intra_op_threads or len(inference),
+                inter_op_threads=inter_op_threads,
+                pinned=pinned,
+            )
+        )
+    return plans
+
+
+def apply(plan: WorkerPlan) -> None:
+    """Pin this process to the plan's cores and set PyTorch's thread counts to match.
+
+    Threads started afterwards inherit the pinning. Thread pools narrow theirs further with
+    `pin_thread`.
+    """
+    global applied_plan
+    import torch
+
+    if plan.pinned:
+        os.sched_setaffinity(0, plan.cores)
+    torch.set_num_threads(plan.intra_op_threads)
+    try:
+        torch.set_num_interop_threads(plan.inter_op_threads)
+    except RuntimeError as e:
+        # Only possible before the first inter-op work, and inherited across forks
+        logger.warning(f"Keeping {torch.get_num_interop_threads()} inter-op thread(s): {e}")
+    applied_plan = plan
+
+
+def current_plan() -> Optional[WorkerPlan]:
+    """The plan this process applied. Outside gunicorn, plans for and applies a lone worker."""
+    if applied_plan is None and enabled():
+        [plan] = plan_workers(1, available_cores(), cpu_quota())
+        logger.info(plan.describe())
+        apply(plan)
+    return applied_plan
+
+
+def pin_thread(role: str) -> None:
+    """Pin the calling thread to the applied plan's `inference` or `decode` cores.
+
+    Meant as a thread pool initializer. Threads started by the pinned thread, like PyTorch's
+    intra-op threads, inherit its cores.
+    """
+    plan = applied_plan
+    if plan is None or not plan.pinned:
+        return
+    os.sched_setaffinity(0, plan.decode_cores if role == "decode" else plan.inference_cores)
@@ -0,0 +1,87 @@
+"""Image decoding that rejects bad uploads early and only decodes the pixels the model needs."""
+
+import io
+import os
+import time
+from typing import Tuple
+
+from PIL import Image
+from PIL import UnidentifiedImageError
+
+# Draft size for callers that don't pass their model's. The food model resizes every image to
+# 224x224, so there is no point decoding more pixels than that.
+DECODE_TARGET_SIZE = int(os.getenv("DECODE_TARGET_SIZE", "224"))
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(50_000_000)))
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+
+class ImageDecodeError(ValueError):
+    """Raised when an upload is empty, too large, or not a readable image."""
+
+
+def decode_image(contents: bytes, target_size: int = DECODE_TARGET_SIZE) -> Image.Image:
+    """Decode image bytes into an RGB image no smaller than `target_size` on either side.
+
+    JPEGs are decoded in draft mode, which lets libjpeg scale by 1/2, 1/4 or 1/8 while decoding.
+    A 12 megapixel phone photo then costs about as much as a 0.2 megapixel one. Size limits are
+    checked against the header before any pixel data is decoded.
+    """
+    if not contents:
+        raise ImageDecodeError("Empty file")
+    if len(contents) > MAX_IMAGE_BYTES:
+        raise ImageDecodeError(f"File is larger than the {MAX_IMAGE_BYTES} byte limit")
+
+    try:
+        image = Image.open(io.BytesIO(contents))
+        if image.width * image.height > MAX_IMAGE_PIXELS:
+            raise ImageDecodeError(
+                f"Image is {image.width}x{image.height}, over the {MAX_IMAGE_PIXELS} pixel limit"
+            )
+        image.draft("RGB", (target_size, target_size))
+        return image.convert("RGB")
+    except ImageDecodeError:
+        raise
+    except UnidentifiedImageError:
+        raise ImageDecodeError("Unrecognised image format")
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageDecodeError(f"Could not decode image: {e}")
+
+
+def decoded_bytes(contents: bytes, target_size: int = DECODE_TARGET_SIZE) -> int:
+    """Estimate how much memory `decode_image` will need for the image, from its header alone.
+
+    Returns 0 for uploads that can't be opened, since decoding them fails before allocating pixels.
+    """
+    try:
+        image = Image.open(io.BytesIO(contents))
+        image.draft("RGB", (target_size, target_size))
+    except Exception:
+        return 0
+    return image.width * image.height * 3
+
+
+def downscale_image(contents: bytes, max_side: int, quality: int) -> Tuple[bytes, bool, float]:
+    """Shrink an image so neither side exceeds `max_side` and re-encode it as a JPEG.
+
+    Returns the bytes to send on, whether they were re-encoded, and the CPU seconds spent. Images
+    that are already small enough, can't be decoded, or would come out larger are returned
+    unchanged, so the inference server still sees, and reports on, the original upload.
+    """
+    start_time = time.thread_time()
+    try:
+        image = decode_image(contents, max_side)
+    except ImageDecodeError:
+        return contents, False, time.thread_time() - start_time
+    # Draft mode never decodes below the requested size, so this only holds for small originals
+    if max(image.size) <= max_side and contents.startswith(JPEG_MAGIC):
+        return contents, False, time.thread_time() - start_time
+
+    image.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality)
+    resized = output.getvalue()
+    if len(resized) >= len(contents):
+        return contents, False, time.thread_time() - start_time
+    return resized, True, time.thread_time() - start_time
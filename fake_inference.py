@@ -0,0 +1,101 @@
+"""Stand-in for the inference server that answers with a fixed prediction after a set delay.
+
+It needs no GPU, model or dataset, so it can be used to exercise the proxy's load balancing and
+health checking locally, e.g. `FAKE_SERVICE_TIME_MS=50 uvicorn fake_inference:app --port 8001`.
+
+The delay is `FAKE_SERVICE_TIME_MS` per request plus `FAKE_SERVICE_TIME_PER_IMAGE_MS` per image,
+stretched by up to `FAKE_SERVICE_TIME_JITTER` either way. With `FAKE_CONCURRENCY` set, only that
+many requests are served at once and the rest queue, like forward passes sharing one GPU.
+Like the real server, it echoes X-Request-ID and reports its time in a Server-Timing header.
+"""
+
+import asyncio
+import os
+import random
+import time
+from typing import Optional
+
+from fastapi import FastAPI
+from fastapi import HTTPException
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from starlette.datastructures import UploadFile
+
+from metrics import StageTimer
+from tracing import REQUEST_ID_HEADER
+from tracing import request_id
+
+FAKE_SERVICE_TIME_MS = float(os.getenv("FAKE_SERVICE_TIME_MS", "20"))
+FAKE_SERVICE_TIME_PER_IMAGE_MS = float(os.getenv("FAKE_SERVICE_TIME_PER_IMAGE_MS", "0"))
+FAKE_SERVICE_TIME_JITTER = float(os.getenv("FAKE_SERVICE_TIME_JITTER", "0"))
+FAKE_CONCURRENCY = int(os.getenv("FAKE_CONCURRENCY", "0"))
+
+
+def create_app(
+    service_time_ms: float = FAKE_SERVICE_TIME_MS,
+    per_image_ms: float = FAKE_SERVICE_TIME_PER_IMAGE_MS,
+    jitter: float = FAKE_SERVICE_TIME_JITTER,
+    concurrency: int = FAKE_CONCURRENCY,
+) -> FastAPI:
+    """Build a fake inference server.
+
+    `app.state.service_time_ms` and `app.state.ready` can be changed while it runs, to slow it
+    down or fail its readiness probe. `app.state.requests` counts classification requests.
+    """
+    app = FastAPI()
+    app.state.service_time_ms = service_time_ms
+    app.state.per_image_ms = per_image_ms
+    app.state.jitter = jitter
+    slots: Optional[asyncio.Semaphore] = asyncio.Semaphore(concurrency) if concurrency else None
+    app.state.ready = True
+    app.state.requests = 0
+
+    @app.post("/classify/")
+    async def classify(request: Request):
+        """Return the same prediction for every uploaded file."""
+        start_time = time.perf_counter()
+        timer = StageTimer()
+        async with request.form() as form:
+            files = [file for file in form.getlist("files") if isinstance(file, UploadFile)]
+        if not files:
+            raise HTTPException(status_code=400, detail="No files provided for classification.")
+        app.state.requests += 1
+        service_time = app.state.service_time_ms + app.state.per_image_ms * len(files)
+        service_time *= 1 + random.uniform(-app.state.jitter, app.state.jitter)
+        if slots is None:
+            with timer.stage("forward"):
+                await asyncio.sleep(service_time / 1000)
+        else:
+            with timer.stage("queue_wait"):
+                await slots.acquire()
+            try:
+                with timer.stage("forward"):
+                    await asyncio.sleep(service_time / 1000)
+            finally:
+                slots.release()
+        return JSONResponse(
+            {"predictions": [{"label": "french_toast", "score": 1.0} for _ in files]},
+            headers={
+                REQUEST_ID_HEADER: request_id(request.headers),
+                "Server-Timing": timer.server_timing(total=time.perf_counter() - start_time),
+            },
+        )
+
+    @app.get("/livez")
+    async def livez():
+        """Liveness probe."""
+        return {"status": "alive"}
+
+    @app.get("/readyz")
+    async def readyz():
+        """Readiness probe, failing while `app.state.ready` is False."""
+        ready = app.state.ready
+        return JSONResponse(
+            status_code=200 if ready else 503,
+            content={"status": "ready" if ready else "not_ready"},
+        )
+
+    return app
+
+
+app = create_app()
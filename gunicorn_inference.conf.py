@@ -0,0 +1,65 @@
+"""Gunicorn settings for the inference server: `gunicorn --config gunicorn_inference.conf.py`.
+
+It is opt-in, rather than the `gunicorn.conf.py` that gunicorn reads by default, so other apps run
+from this directory, like the proxy, don't get its preloading and CPU planning.
+
+With preloading on, the master imports the app once and loads the model weights memory-mapped on the
+CPU before forking. Workers share those pages copy-on-write instead of each loading their own copy,
+and each worker moves the model to the GPU after the fork.
+
+On a CPU node, the master splits the cores between the workers, and each worker pins itself to its
+slice and sizes its PyTorch threads to it after the fork. See cpu_planner.py.
+"""
+
+import gc
+import itertools
+import os
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+# torch.cuda.is_available() would otherwise initialize the CUDA driver in the master, and a forked
+# worker can't use CUDA after that. NVML answers the same question without touching CUDA.
+os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
+
+
+def when_ready(server) -> None:
+    """Freeze everything the master has allocated before the workers are forked.
+
+    Otherwise the garbage collector in each worker writes to every object's header on its first
+    full collection, which copies the master's pages into each worker one at a time.
+    """
+    gc.freeze()
+
+
+def on_starting(server) -> None:
+    """Plan each worker's share of the CPU cores, and log the plan."""
+    # Imported here, once the app's directory is on the path
+    import cpu_planner
+
+    if not cpu_planner.enabled():
+        return
+    server.cpu_plans = cpu_planner.plan_workers(
+        server.cfg.workers, cpu_planner.available_cores(), cpu_planner.cpu_quota()
+    )
+    for plan in server.cpu_plans:
+        server.log.info(plan.describe())
+
+
+def pre_fork(server, worker) -> None:
+    """Give the worker about to be forked the lowest CPU slot that no live worker holds.
+
+    A worker that replaces one that died takes over its cores.
+    """
+    taken = {getattr(live, "cpu_slot", None) for live in server.WORKERS.values()}
+    worker.cpu_slot = next(slot for slot in itertools.count() if slot not in taken)
+
+
+def post_fork(server, worker) -> None:
+    """Pin the new worker to its slot's cores and set its thread counts."""
+    import cpu_planner
+
+    plans = getattr(server, "cpu_plans", None)
+    if plans:
+        plan = plans[worker.cpu_slot % len(plans)]
+        cpu_planner.apply(plan)
+        server.log.info(f"Worker {worker.pid} took CPU slot {plan.slot}")
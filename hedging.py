@@ -0,0 +1,254 @@
+"""Hedged requests and budgeted retries for forwarding to the inference servers.
+
+Classifying an image has no side effects, so a request can safely be sent more than once. If the
+first attempt has not answered after a high percentile of recent upstream latencies, a hedge is
+sent to a second upstream. The first answer wins and the other attempt is cancelled. Attempts that
+fail with a connection error or a 502, 503 or 504 are retried, except a 504 from the inference
+server dropping a request past its deadline. No hedge or retry is sent once the request's deadline
+has passed. Every hedge and retry spends a token from a retry budget that only refills in
+proportion to normal traffic, so when an upstream is down the proxy can't multiply the load on the
+others.
+"""
+
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from typing import Awaitable
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import httpx
+
+from metrics import MetricsAggregator
+from tracing import deadline_dropped
+from tracing import time_remaining
+
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY_MS = float(os.getenv("HEDGE_MIN_DELAY_MS", "10"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_LATENCY_WINDOW = int(os.getenv("HEDGE_LATENCY_WINDOW", "1000"))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "1"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", "1.0"))
+RETRY_BUDGET_MAX_TOKENS = float(os.getenv("RETRY_BUDGET_MAX_TOKENS", "10"))
+
+RETRYABLE_STATUS_CODES = (502, 503, 504)
+
+Send = Callable[[str], Awaitable[httpx.Response]]
+Alternative = Callable[[List[str]], Optional[str]]
+
+
+def expired(deadline: Optional[float]) -> bool:
+    """Whether the request's deadline has passed, so another attempt would be too late."""
+    remaining = time_remaining(deadline)
+    return remaining is not None and remaining <= 0
+
+
+class RetryBudget:
+    """Token bucket that caps hedges and retries at a fraction of regular requests.
+
+    Each request deposits `ratio` tokens and each hedge or retry withdraws one. The bucket also
+    refills at `min_per_second`, so a proxy with little traffic can still retry, and holds at most
+    `max_tokens`, so a quiet period can't bank an unbounded burst of retries.
+    """
+
+    def __init__(
+        self,
+        ratio: float = RETRY_BUDGET_RATIO,
+        min_per_second: float = RETRY_BUDGET_MIN_PER_SECOND,
+        max_tokens: float = RETRY_BUDGET_MAX_TOKENS,
+    ):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.refilled_at = time.monotonic()
+
+    def refill(self) -> None:
+        """Add the time-based allowance since the last refill."""
+        now = time.monotonic()
+        self.tokens = min(
+            self.max_tokens, self.tokens + (now - self.refilled_at) * self.min_per_second
+        )
+        self.refilled_at = now
+
+    def deposit(self) -> None:
+        """Credit the budget for one regular request."""
+        self.refill()
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """Spend one token on a hedge or retry, if there is one."""
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class LatencyWindow:
+    """The most recent upstream latencies, for estimating a percentile to hedge after."""
+
+    def __init__(self, size: int = HEDGE_LATENCY_WINDOW):
+        self.latencies: Deque[float] = deque(maxlen=size)
+        self.cached_percentile: Optional[Tuple[float, float]] = None
+        self.observed_since_cache = 0
+
+    def observe(self, latency: float) -> None:
+        """Record one successful request's latency."""
+        self.latencies.append(latency)
+        self.observed_since_cache += 1
+
+    def percentile(self, q: float) -> float:
+        """The q-th percentile of the window, re-sorted at most once every 5% of the window."""
+        if (
+            self.cached_percentile is None
+            or self.cached_percentile[0] != q
+            or self.observed_since_cache > self.latencies.maxlen // 20
+        ):
+            ordered = sorted(self.latencies)
+            index = min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1)
+            self.cached_percentile = (q, ordered[max(index, 0)])
+            self.observed_since_cache = 0
+        return self.cached_percentile[1]
+
+
+class Hedger:
+    """Sends one logical request as up to a hedge plus `max_retries` retries, within the budget."""
+
+    def __init__(
+        self,
+        hedge: bool = HEDGE_REQUESTS,
+        percentile: float = HEDGE_PERCENTILE,
+        min_delay: float = HEDGE_MIN_DELAY_MS / 1000,
+        min_samples: int = HEDGE_MIN_SAMPLES,
+        max_retries: int = UPSTREAM_MAX_RETRIES,
+        budget: Optional[RetryBudget] = None,
+        metrics_aggregator: Optional[MetricsAggregator] = None,
+    ):
+        self.hedge = hedge
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.max_retries = max_retries
+        self.budget = budget or RetryBudget()
+        self.latencies = LatencyWindow()
+        self.metrics_aggregator = metrics_aggregator
+        self.counts = {"hedges": 0, "hedge_wins": 0, "retries": 0, "budget_exhausted": 0}
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait for the first attempt before hedging, or None to not hedge."""
+        if not self.hedge or len(self.latencies.latencies) < self.min_samples:
+            return None
+        return max(self.min_delay, self.latencies.percentile(self.percentile))
+
+    def count(self, name: str) -> None:
+        """Count a hedge, hedge win, retry or exhausted budget."""
+        self.counts[name] += 1
+        if self.metrics_aggregator is not None:
+            self.metrics_aggregator.increment(f"proxy.{name}")
+
+    async def send(
+        self,
+        endpoint: str,
+        send: Send,
+        alternative: Alternative,
+        deadline: Optional[float] = None,
+    ) -> Tuple[str, httpx.Response]:
+        """Send a request, hedging and retrying it, and return the endpoint that answered.
+
+        `send` makes one attempt against an endpoint. `alternative` returns another endpoint to
+        use, not among the ones already tried, or None if there isn't one. After `deadline`, a Unix
+        time, no more attempts are made. Raises the last httpx.RequestError if every attempt
+        failed to connect.
+        """
+        self.budget.deposit()
+        tried = [endpoint]
+        attempts: Dict[asyncio.Task, Tuple[str, float]] = {}
+        attempts[asyncio.create_task(send(endpoint))] = (endpoint, time.monotonic())
+        hedge_delay = self.hedge_delay()
+        hedge_task: Optional[asyncio.Task] = None
+        retries = 0
+        last_error: Optional[httpx.RequestError] = None
+        last_failure: Optional[Tuple[str, httpx.Response]] = None
+        try:
+            while attempts:
+                done, _ = await asyncio.wait(
+                    attempts, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # The first attempt is slower than usual, hedge once to another upstream
+                    hedge_delay = None
+                    if expired(deadline):
+                        continue
+                    hedge_endpoint = alternative(tried)
+                    if hedge_endpoint is None:
+                        continue
+                    if not self.budget.withdraw():
+                        self.count("budget_exhausted")
+                        continue
+                    self.count("hedges")
+                    tried.append(hedge_endpoint)
+                    hedge_task = asyncio.create_task(send(hedge_endpoint))
+                    attempts[hedge_task] = (hedge_endpoint, time.monotonic())
+                    continue
+
+                for task in done:
+                    attempt_endpoint, started_at = attempts.pop(task)
+                    try:
+                        response = task.result()
+                    except httpx.RequestError as e:
+                        last_error = e
+                        continue
+                    if response.status_code in RETRYABLE_STATUS_CODES and not deadline_dropped(
+                        response.status_code, response.headers
+                    ):
+                        last_failure = (attempt_endpoint, response)
+                        continue
+                    if response.status_code < 400:
+                        self.latencies.observe(time.monotonic() - started_at)
+                    if task is hedge_task:
+                        self.count("hedge_wins")
+                    return attempt_endpoint, response
+
+                if attempts:
+                    continue
+                # Every attempt so far failed in a way another attempt might not
+                if retries >= self.max_retries or expired(deadline):
+                    break
+                if not self.budget.withdraw():
+                    self.count("budget_exhausted")
+                    break
+                self.count("retries")
+                retries += 1
+                retry_endpoint = alternative(tried) or tried[-1]
+                tried.append(retry_endpoint)
+                attempts[asyncio.create_task(send(retry_endpoint))] = (
+                    retry_endpoint,
+                    time.monotonic(),
+                )
+        finally:
+            for task in attempts:
+                task.cancel()
+            await asyncio.gather(*attempts, return_exceptions=True)
+
+        if last_failure is not None:
+            return last_failure
+        assert last_error is not None
+        raise last_error
+
+    def stats(self) -> Dict[str, float]:
+        """Hedge and retry counters, the current hedge delay and the tokens left in the budget."""
+        hedge_delay = self.hedge_delay()
+        return {
+            **self.counts,
+            "hedge_delay_ms": hedge_delay * 1000 if hedge_delay is not None else 0.0,
+            "retry_budget_tokens": self.budget.tokens,
+        }
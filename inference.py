@@ -1,32 +1,74 @@
-"""AI Image classification API with batch processing. Works on both GPU and CPU."""
+"""AI Image classification API with batch processing. Works on both GPU and CPU.
 
-import io
+Several models can be served side by side from MODELS_DIR. Requests pick one by the path, as in
+`/models/nateraw/food/classify/`, or by the X-Model header, and get DEFAULT_MODEL otherwise.
+"""
+
+import asyncio
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextlib import contextmanager
 from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Tuple
 
 import torch
-from datadog_api_client import ApiClient
 from datadog_api_client import Configuration
-from datadog_api_client.v2.api.metrics_api import MetricsApi
-from datadog_api_client.v2.model.metric_intake_type import MetricIntakeType
-from datadog_api_client.v2.model.metric_payload import MetricPayload
-from datadog_api_client.v2.model.metric_point import MetricPoint
-from datadog_api_client.v2.model.metric_series import MetricSeries
 from ddtrace import patch_all
 from ddtrace.profiling import Profiler
 from fastapi import FastAPI
 from fastapi import File
 from fastapi import HTTPException
+from fastapi import Query
+from fastapi import Request
+from fastapi import Response
 from fastapi import UploadFile
-from nvitop import Device
-from nvitop import ResourceMetricCollector
+from fastapi.responses import JSONResponse
 from PIL import Image
 from pydantic import BaseModel
-from transformers import pipeline
+
+import cpu_planner
+from backends import INFERENCE_BACKEND
+from backends import Backend
+from backends import UnsupportedModel
+from backends import create_backend
+from batching import BatchResults
+from batching import BatchScheduler
+from batching import DeadlineExceeded
+from batching import split_into_chunks
+from decoding import ImageDecodeError
+from decoding import decode_image
+from decoding import decoded_bytes
+from metrics import PROMETHEUS_CONTENT_TYPE
+from metrics import MetricsAggregator
+from metrics import RequestTimingMiddleware
+from metrics import StageTimer
+from metrics import count_buckets
+from metrics import create_sink
+from metrics import received_at
+from model_registry import ModelNotFound
+from model_registry import ModelRegistry
+from model_registry import ModelUnavailable
+from model_registry import ResidentModel
+from prediction_cache import PredictionCache
+from prediction_cache import cache_key
+from streaming import DuplexStreamingResponse
+from streaming import StreamImage
+from streaming import iter_stream_images
+from streaming import stream_predictions
+from tracing import DEADLINE_DROPPED_HEADER
+from tracing import MODEL_HEADER
+from tracing import PRIORITIES
+from tracing import REQUEST_ID_HEADER
+from tracing import parse_deadline
+from tracing import parse_priority
+from tracing import request_id
+from tracing import time_remaining
 
 # Configure logging
 logging.basicConfig(
@@ -37,27 +79,45 @@ logger = logging.getLogger(__name__)
 patch_all()
 
 # Configuration
-MODEL_PATH = "/workspace/models/nateraw/food"
+MODELS_DIR = os.getenv("MODELS_DIR", "/workspace/models")
+# Served when a request doesn't name a model, and loaded at startup
+DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "nateraw/food").strip("/")
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 DD_ENV = os.getenv("DD_ENV", "production")
 DD_SERVICE = os.getenv("DD_SERVICE", "inference")
 DD_VERSION = os.getenv("DD_VERSION", "1.0.0")
 DD_SITE = os.getenv("DD_SITE", "us5.datadoghq.com")
 DD_API_KEY = os.getenv("DD_API_KEY")
-
-# Initialize FastAPI
-app = FastAPI()
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "32"))
+MAX_BATCH_WAIT_MS = float(os.getenv("MAX_BATCH_WAIT_MS", "5"))
+INFERENCE_CONCURRENCY = int(os.getenv("INFERENCE_CONCURRENCY", "1"))
+# Unset runs one decode thread per decode core of the worker's CPU plan, or 4 without a plan
+DECODE_WORKERS = int(os.environ["DECODE_WORKERS"]) if os.getenv("DECODE_WORKERS") else None
+REQUEST_CHUNK_SIZE = int(os.getenv("REQUEST_CHUNK_SIZE", str(MAX_BATCH_SIZE)))
+DECODE_MEMORY_BUDGET_MB = float(os.getenv("DECODE_MEMORY_BUDGET_MB", "256"))
+READY_MAX_QUEUE_DEPTH = int(os.getenv("READY_MAX_QUEUE_DEPTH", str(MAX_BATCH_SIZE * 8)))
+# Histogram buckets for batch sizes and chunk counts, which are counts rather than latencies
+COUNT_BUCKETS = count_buckets(MAX_BATCH_SIZE)
 
 # Initialize Datadog
 Profiler().start()
 dd_config = Configuration()
 dd_config.server_variables["site"] = DD_SITE
 dd_config.api_key["apiKeyAuth"] = DD_API_KEY
+metrics_aggregator = MetricsAggregator()
 
-# Initialize model
-logger.info(f"Initializing model from {MODEL_PATH} on device {DEVICE}")
-food_classifier = pipeline("image-classification", model=MODEL_PATH, device=DEVICE)
-logger.info("Model initialization complete")
+# Time spent in each startup stage, in seconds, logged once the worker is ready
+startup_timings: Dict[str, float] = {}
+
+
+@contextmanager
+def startup_stage(name: str) -> Iterator[None]:
+    """Record how long a startup stage takes."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - start_time
 
 
 # Pydantic models for request and response
@@ -67,40 +127,26 @@ class ClassificationRequest(BaseModel):
     images: List[UploadFile]
 
 
-class PredictionResponse(BaseModel):
-    """Format for an individual prediction."""
+class LabelScore(BaseModel):
+    """A single label and its probability."""
 
     label: str
     score: float
 
 
+class PredictionResponse(BaseModel):
+    """Format for an individual prediction, or the reason the image couldn't be classified."""
+
+    label: Optional[str] = None
+    score: Optional[float] = None
+    top_k: Optional[List[LabelScore]] = None
+    error: Optional[str] = None
+
+
 class ClassificationResponse(BaseModel):
     """Final response format for a series of images."""
 
-    predictions: List[List[PredictionResponse]]
-
-
-def send_metric(
-    metric_name: str, value: float, metric_type: MetricIntakeType, tags: Optional[List[str]] = None
-) -> None:
-    """Send a metric to Datadog."""
-    with ApiClient(dd_config) as api_client:
-        api_instance = MetricsApi(api_client)
-        metric = MetricPayload(
-            series=[
-                MetricSeries(
-                    metric=metric_name,
-                    type=metric_type,
-                    points=[MetricPoint(timestamp=int(time.time()), value=value)],
-                    tags=tags or [],
-                )
-            ]
-        )
-        try:
-            api_instance.submit_metrics(body=metric)
-            logger.info(f"Sent metric {metric_name} with value {value} to Datadog")
-        except Exception as e:
-            logger.error(f"Error sending metric to Datadog: {e}")
+    predictions: List[PredictionResponse]
 
 
 class GPULogging:
@@ -108,6 +154,8 @@ class GPULogging:
 
     def collect_gpu_metrics(self, metrics: Dict[str, float]) -> bool:
         """Collect metrics from the GPU."""
+        from nvitop import Device
+
         for gpu in Device.all():
             metric_mappings = {
                 "memory_percent": "memory_percent (%)",
@@ -122,15 +170,9 @@ class GPULogging:
             for metric_name, metric_key in metric_mappings.items():
                 full_metric_key = f"metrics-daemon/gpu:{gpu.index}/{metric_key}/mean"
                 if full_metric_key in metrics:
-                    try:
-                        send_metric(
-                            f"inference.{metric_name}",
-                            metrics[full_metric_key],
-                            MetricIntakeType.GAUGE,
-                            [f"gpu:{gpu.index}"],
-                        )
-                    except Exception as e:
-                        logger.error(f"Error sending metric {metric_name} to Datadog: {e}")
+                    metrics_aggregator.gauge(
+                        f"inference.{metric_name}", metrics[full_metric_key], [f"gpu:{gpu.index}"]
+                    )
                 else:
                     logger.warning(f"Metric {metric_name} not available for GPU {gpu.index}")
 
@@ -142,67 +184,573 @@ class GPULogging:
             logger.warning("No GPU found. Not logging.")
             return
         else:
+            from nvitop import Device
+            from nvitop import ResourceMetricCollector
+
             ResourceMetricCollector(Device.all()).daemonize(
                 on_collect=self.collect_gpu_metrics,
                 interval=1,
             )
 
 
-# Initialize GPU Monitor
+# Initialize GPU Monitor. It runs on a thread, so it is started per worker in the lifespan handler
 gpu_monitor = GPULogging()
-gpu_monitor.start_gpu_metrics_monitor()
+
+
+def create_decode_executor(workers: int) -> ThreadPoolExecutor:
+    """Thread pool for decoding uploads, its threads pinned to the plan's decode cores."""
+    return ThreadPoolExecutor(
+        max_workers=workers,
+        thread_name_prefix="decode",
+        initializer=cpu_planner.pin_thread,
+        initargs=("decode",),
+    )
+
+
+def decode_workers(plan: Optional[cpu_planner.WorkerPlan]) -> int:
+    """DECODE_WORKERS if set, else one thread per decode core of the worker's plan, else 4."""
+    if DECODE_WORKERS is not None:
+        return DECODE_WORKERS
+    return len(plan.decode_cores) if plan is not None else 4
+
+
+# Decoding and forward passes run on dedicated threads so the event loop stays free to answer
+# health checks while the model is busy. Models loaded after startup are read on their own thread.
+# On a CPU node, each pool's threads are pinned to their own cores of the worker's CPU plan. The
+# decode pool is sized to the plan, so the lifespan handler replaces it once there is one.
+decode_executor = create_decode_executor(decode_workers(None))
+inference_executor = ThreadPoolExecutor(
+    max_workers=INFERENCE_CONCURRENCY,
+    thread_name_prefix="inference",
+    initializer=cpu_planner.pin_thread,
+    initargs=("inference",),
+)
+load_executor = ThreadPoolExecutor(
+    max_workers=1,
+    thread_name_prefix="model-load",
+    initializer=cpu_planner.pin_thread,
+    initargs=("inference",),
+)
+
+SERVICE_TAGS = [f"env:{DD_ENV}"]
+
+# Initialize prediction cache. It is shared by every model, with the model in each key.
+prediction_cache = PredictionCache(metrics_aggregator, tags=SERVICE_TAGS)
+
+
+class ServedModel:
+    """A model's backend and the batch scheduler that groups its images into forward passes.
+
+    Every resident model has its own scheduler, and all of them run on the inference executor.
+    """
+
+    def __init__(self, name: str, path: str, backend: Backend):
+        self.name = name
+        self.path = path
+        self.backend = backend
+        # Identifies the model and backend in cache keys, since int8 and fp32 scores differ slightly
+        self.identity = f"{path}:{backend.name}"
+        self.metric_tags = [f"env:{DD_ENV}", f"model:{path}", f"backend:{backend.name}"]
+        self.memory_bytes = backend.memory_bytes()
+        self.batch_scheduler = BatchScheduler(
+            self.run_batch,
+            max_batch_size=MAX_BATCH_SIZE,
+            max_wait_ms=MAX_BATCH_WAIT_MS,
+            executor=inference_executor,
+            max_concurrency=INFERENCE_CONCURRENCY,
+            on_batch=self.record_batch_metrics,
+        )
+
+    def run_batch(self, items: List[Tuple[Image.Image, int]]) -> BatchResults:
+        """Run one forward pass over a batch of (image, top_k) items, timing each stage of it."""
+        timings: Dict[str, float] = {}
+        return BatchResults(self.backend.predict(items, timings), timings)
+
+    def record_batch_metrics(self, batch_size: int, queue_depth: int) -> None:
+        """Record the size of a dispatched batch and how many images are still queued."""
+        metrics_aggregator.observe(
+            "inference.batch_size", batch_size, self.metric_tags, COUNT_BUCKETS
+        )
+        metrics_aggregator.gauge("inference.queue_depth", queue_depth, self.metric_tags)
+
+    async def warm_up(self) -> None:
+        """Run a synthetic image through the model, so the first real request doesn't pay for it."""
+        await self.batch_scheduler.submit([(Image.new("RGB", self.backend.image_size), 1)])
+
+
+async def load_model(name: str, path: str) -> ServedModel:
+    """Load a model the first time a request asks for it, and warm it up before it is used."""
+    loop = asyncio.get_running_loop()
+    logger.info(f"Loading {INFERENCE_BACKEND} backend from {path}")
+    backend = await loop.run_in_executor(
+        load_executor, create_backend, INFERENCE_BACKEND, path, DEVICE
+    )
+    served = ServedModel(name, path, backend)
+    served.batch_scheduler.start()
+    try:
+        await served.warm_up()
+    except BaseException:
+        await served.batch_scheduler.stop()
+        raise
+    return served
+
+
+async def unload_model(served: ServedModel) -> None:
+    """Stop an evicted model's scheduler. Its memory is freed once the last request lets go of it.
+
+    On the GPU, PyTorch keeps the freed memory cached and reuses it for the next model it loads.
+    """
+    await served.batch_scheduler.stop()
+
+
+registry = ModelRegistry(
+    MODELS_DIR, load_model, unload_model, metrics_aggregator=metrics_aggregator, tags=SERVICE_TAGS
+)
+
+# Initialize the default model. The weights are loaded on the CPU here, memory-mapped, so that a
+# gunicorn master started with --preload loads them once and its workers share the pages. Each
+# worker moves the model to the device in the lifespan handler, after the fork. It is pinned, so
+# it is never evicted to make room for other models.
+MODEL_PATH = registry.path(DEFAULT_MODEL)
+logger.info(f"Initializing {INFERENCE_BACKEND} backend from {MODEL_PATH}")
+with startup_stage("load"):
+    default_model = ServedModel(
+        DEFAULT_MODEL,
+        MODEL_PATH,
+        create_backend(INFERENCE_BACKEND, MODEL_PATH, DEVICE, to_device=False),
+    )
+registry.add(DEFAULT_MODEL, MODEL_PATH, default_model, startup_timings["load"])
+logger.info("Model initialization complete")
+
+
+async def warm_up(app: FastAPI) -> None:
+    """Move the model to its device and run a synthetic batch through it, then report ready.
+
+    The first forward pass pays for CUDA context creation, kernel selection and allocator growth.
+    Doing it here means the first real request doesn't.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        with startup_stage("to_device"):
+            await loop.run_in_executor(inference_executor, default_model.backend.to_device)
+        with startup_stage("warm_up"):
+            await default_model.warm_up()
+    except Exception as e:
+        logger.error(f"Model warm-up failed: {e}")
+        return
+    app.state.model_warmed = True
+    startup_timings["total"] = sum(startup_timings.values())
+    logger.info(
+        f"Worker {os.getpid()} ready on {DEVICE}: "
+        + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in startup_timings.items())
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the batch schedulers and metrics flusher for the lifetime of the app."""
+    global decode_executor
+    app.state.model_warmed = False
+    # Before any pool starts a thread, so the threads are pinned to the plan's cores
+    decode_executor = create_decode_executor(decode_workers(cpu_planner.current_plan()))
+    metrics_aggregator.start(create_sink(dd_config))
+    gpu_monitor.start_gpu_metrics_monitor()
+    default_model.batch_scheduler.start()
+    warm_up_task = asyncio.create_task(warm_up(app))
+    yield
+    warm_up_task.cancel()
+    await registry.aclose()
+    await metrics_aggregator.stop()
+    decode_executor.shutdown(wait=False, cancel_futures=True)
+    inference_executor.shutdown(wait=False, cancel_futures=True)
+    load_executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Initialize FastAPI
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestTimingMiddleware)
+
+
+def cache_keys(contents: List[bytes], top_k: int, model_identity: str) -> List[str]:
+    """Content-addressed cache keys for a request's images."""
+    return [cache_key(data, f"{model_identity}:top_k={top_k}") for data in contents]
+
+
+def model_name(request: Request) -> str:
+    """The model a request asked for, in its path or X-Model header, or DEFAULT_MODEL."""
+    name = request.path_params.get("model") or request.headers.get(MODEL_HEADER) or DEFAULT_MODEL
+    return name.strip("/")
+
+
+async def acquire_model(name: str) -> ResidentModel:
+    """Get a model ready for a request, loading it if needed. Release it with `registry.release()`.
+
+    An unknown model is a 404, and one whose preprocessing can't be reproduced is a 400. A model
+    that can't be loaded yet because every resident model is busy is a 503 with Retry-After, so
+    the client backs off instead of failing over to no one.
+    """
+    try:
+        return await registry.acquire(name)
+    except ModelNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except UnsupportedModel as e:
+        raise HTTPException(status_code=400, detail=f"Can't serve model {name}: {e}")
+    except ModelUnavailable as e:
+        logger.warning(str(e))
+        metrics_aggregator.increment("inference.model.unavailable", 1, SERVICE_TAGS)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except Exception as e:
+        logger.error(f"Failed to load model {name}: {e}")
+        metrics_aggregator.increment("inference.model.load_errors", 1, SERVICE_TAGS)
+        raise HTTPException(status_code=503, detail=f"Failed to load model {name}")
+
+
+def should_bypass_cache(request: Request) -> bool:
+    """Whether the client asked for fresh predictions rather than cached ones."""
+    bypass = request.headers.get("X-Cache-Bypass", "").lower() in ("1", "true", "yes")
+    return bypass or "no-cache" in request.headers.get("Cache-Control", "")
+
+
+def decode_chunk(contents: List[bytes], chunk: List[int], target_size: int) -> asyncio.Future:
+    """Start decoding a chunk of a request's images, returning decode errors rather than raising.
+
+    Images are decoded no smaller than `target_size` on either side, the model's decode size.
+    """
+    loop = asyncio.get_running_loop()
+    return asyncio.gather(
+        *(
+            loop.run_in_executor(decode_executor, decode_image, contents[i], target_size)
+            for i in chunk
+        ),
+        return_exceptions=True,
+    )
+
+
+def check_deadline(deadline: Optional[float], stage: str) -> None:
+    """Raise DeadlineExceeded if the request's deadline passed before the given stage."""
+    remaining = time_remaining(deadline)
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded(f"Deadline passed {-remaining * 1000:.0f}ms before {stage}")
+
+
+async def cancel_on_disconnect(request: Request, task: asyncio.Task) -> None:
+    """Cancel the task handling a request if its client disconnects before it is answered.
+
+    Only started once the body has been read, so the next message from the server can only be
+    the disconnect. Cancelling the handler cancels its decodes and drops its queued images.
+    """
+    message = await request.receive()
+    if message["type"] == "http.disconnect":
+        request.state.disconnected = True
+        task.cancel()
 
 
 @app.post("/classify/")
-async def classify(files: List[UploadFile] = File(...)):
-    """Classify food in one or multiple uploaded images."""
-    logger.info(f"Received classification request for {len(files)} file(s)")
+@app.post("/models/{model:path}/classify/")
+async def classify(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    top_k: int = Query(1, ge=1, description="Number of labels to return per image"),
+):
+    """Classify food in one or multiple uploaded images.
+
+    The response's Server-Timing header breaks the time spent on the request down by stage, so a
+    proxy in front can tell it apart from the time spent on the network.
+
+    The model is the one named in the path or the X-Model header, or DEFAULT_MODEL without either.
+    Images are queued for the model by X-Request-Priority class, then by X-Request-Deadline. A
+    request whose deadline passes before its images are decoded or run, or whose client goes away,
+    is dropped instead of using the GPU for an answer no one will read.
+    """
+    rid = request_id(request.headers)
+    deadline = parse_deadline(request.headers)
+    priority = parse_priority(request.headers)
+    logger.info(
+        f"Received {priority} priority classification request {rid} for {len(files)} file(s)"
+    )
     if not files:
         logger.error("No files provided for classification")
         raise HTTPException(status_code=400, detail="No files provided for classification.")
 
+    model = await acquire_model(model_name(request))
+    served: ServedModel = model.model
+    metric_tags = served.metric_tags
+    task = asyncio.current_task()
+    assert task is not None
+    request.state.disconnected = False
+    disconnect_watcher = asyncio.create_task(cancel_on_disconnect(request, task))
     try:
         start_time = time.time()
-        images = []
-        for file in files:
-            contents = await file.read()
-            image = Image.open(io.BytesIO(contents)).convert("RGB")
-            images.append(image)
-
-        # Perform batch inference
-        results = food_classifier(images, batch_size=len(images))
-
-        # Process results
-        predictions = []
-        for image_results in results:
-            top_prediction = max(image_results, key=lambda x: x["score"])
-            predictions.append(
-                {"label": top_prediction["label"], "score": float(top_prediction["score"])}
+        timer = StageTimer()
+        timer.add("read", time.perf_counter() - received_at(request.scope))
+        top_k = min(top_k, len(served.backend.labels))
+        decode_size = served.backend.resizer.decode_size
+        loop = asyncio.get_running_loop()
+        with timer.stage("read"):
+            contents = [await file.read() for file in files]
+        predictions: List[Dict] = [{}] * len(files)
+
+        # Serve byte-identical images from the cache, so only the misses are decoded and classified
+        keys: List[Optional[str]] = [None] * len(files)
+        misses = list(range(len(files)))
+        if prediction_cache.enabled:
+            keys = list(
+                await loop.run_in_executor(
+                    decode_executor, cache_keys, contents, top_k, served.identity
+                )
+            )
+            if not should_bypass_cache(request):
+                misses = []
+                for i, key in enumerate(keys):
+                    cached = prediction_cache.get(key)
+                    if cached is None:
+                        misses.append(i)
+                    else:
+                        predictions[i] = cached
+
+        # Decode and classify large uploads a chunk at a time, decoding the next chunk while the
+        # current one is in the model, so a single request can't hold every decoded image at once
+        sizes = await loop.run_in_executor(
+            decode_executor, lambda: [decoded_bytes(contents[i], decode_size) for i in misses]
+        )
+        chunks = [
+            [misses[j] for j in chunk]
+            for chunk in split_into_chunks(
+                sizes, REQUEST_CHUNK_SIZE, int(DECODE_MEMORY_BUDGET_MB * 1024 * 1024)
+            )
+        ]
+        images_processed = 0
+        next_chunk = None
+        if chunks:
+            check_deadline(deadline, "decoding")
+            next_chunk = decode_chunk(contents, chunks[0], decode_size)
+        try:
+            for n, chunk in enumerate(chunks):
+                assert next_chunk is not None
+                with timer.stage("decode"):
+                    decoded = await next_chunk
+                next_chunk = None
+                if n + 1 < len(chunks):
+                    check_deadline(deadline, "decoding")
+                    next_chunk = decode_chunk(contents, chunks[n + 1], decode_size)
+
+                # Bad uploads get a per-image error instead of failing the whole request
+                images, positions = [], []
+                for i, result in zip(chunk, decoded):
+                    if isinstance(result, ImageDecodeError):
+                        logger.warning(f"Rejected {files[i].filename}: {result}")
+                        predictions[i] = {"error": str(result)}
+                    elif isinstance(result, BaseException):
+                        raise result
+                    else:
+                        images.append(result)
+                        positions.append(i)
+                del decoded
+
+                # Perform batch inference, sharing forward passes with concurrent requests
+                items = [(image, top_k) for image in images]
+                batch_timings: Dict[str, float] = {}
+                results = await served.batch_scheduler.submit(
+                    items, batch_timings, PRIORITIES[priority], deadline
+                )
+                for stage, seconds in batch_timings.items():
+                    timer.add(stage, seconds)
+                for i, prediction in zip(positions, results):
+                    predictions[i] = prediction
+                    key = keys[i]
+                    if key is not None:
+                        prediction_cache.put(key, prediction)
+                images_processed += len(images)
+        finally:
+            if next_chunk is not None:
+                next_chunk.cancel()
+        if len(chunks) > 1:
+            metrics_aggregator.observe(
+                "inference.request_chunks", len(chunks), metric_tags, COUNT_BUCKETS
             )
 
         # Calculate and send metrics
         process_time = time.time() - start_time
-        send_metric(
-            "inference.process_time",
-            process_time,
-            MetricIntakeType.GAUGE,
-            [f"env:{DD_ENV}", f"model:{MODEL_PATH}"],
+        metrics_aggregator.observe("inference.process_time", process_time, metric_tags)
+        metrics_aggregator.increment("inference.images_processed", images_processed, metric_tags)
+        if images_processed < len(misses):
+            metrics_aggregator.increment(
+                "inference.decode_errors", len(misses) - images_processed, metric_tags
+            )
+
+        logger.info(
+            f"Successfully classified {images_processed} of {len(files)} image(s) for {rid}, "
+            f"{len(files) - len(misses)} served from cache"
         )
-        send_metric(
-            "inference.images_processed",
-            len(files),
-            MetricIntakeType.COUNT,
-            [f"env:{DD_ENV}", f"model:{MODEL_PATH}"],
+        remaining = time_remaining(deadline)
+        if remaining is not None and remaining < 0:
+            logger.warning(f"Request {rid} finished {-remaining * 1000:.0f}ms past its deadline")
+            metrics_aggregator.increment("inference.deadline_exceeded", 1, metric_tags)
+        with timer.stage("serialize"):
+            result = JSONResponse(
+                {"predictions": predictions},
+                headers={"X-Cache-Hits": str(len(files) - len(misses)), REQUEST_ID_HEADER: rid},
+            )
+        timer.record(metrics_aggregator, "inference.stage_duration", metric_tags)
+        result.headers["Server-Timing"] = timer.server_timing(
+            total=time.perf_counter() - received_at(request.scope)
         )
-
-        logger.info(f"Successfully classified {len(files)} image(s)")
-        return {"predictions": predictions}
-    except Exception as e:
-        logger.error(f"Error during classification: {str(e)}")
-        send_metric(
-            "inference.errors", 1, MetricIntakeType.COUNT, [f"env:{DD_ENV}", f"model:{MODEL_PATH}"]
+        return result
+    except DeadlineExceeded as e:
+        logger.warning(f"Dropped request {rid}: {e}")
+        metrics_aggregator.increment("inference.deadline_dropped", 1, metric_tags)
+        raise HTTPException(
+            status_code=504, detail=str(e), headers={DEADLINE_DROPPED_HEADER: "true"}
         )
+    except asyncio.CancelledError:
+        if not request.state.disconnected:
+            raise
+        task.uncancel()
+        logger.info(f"Client disconnected, dropped request {rid}")
+        metrics_aggregator.increment("inference.client_disconnects", 1, metric_tags)
+        # Nobody will read it, 499 is only for the access log
+        return Response(status_code=499)
+    except Exception as e:
+        logger.error(f"Error during classification of {rid}: {str(e)}")
+        metrics_aggregator.increment("inference.errors", 1, metric_tags)
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        disconnect_watcher.cancel()
+        registry.release(model)
+
+
+async def classify_streamed_image(
+    image: StreamImage,
+    name: str,
+    top_k: int,
+    bypass_cache: bool,
+    priority: str,
+    deadline: Optional[float],
+) -> Dict:
+    """Classify one image from a /classify/stream body, keeping its model resident while it runs."""
+    async with registry.use(name) as served:
+        return await classify_with_model(image, served, top_k, bypass_cache, priority, deadline)
+
+
+async def classify_with_model(
+    image: StreamImage,
+    served: ServedModel,
+    top_k: int,
+    bypass_cache: bool,
+    priority: str,
+    deadline: Optional[float],
+) -> Dict:
+    """Classify one streamed image through the cache and the model's batch scheduler."""
+    loop = asyncio.get_running_loop()
+    metric_tags = served.metric_tags
+    top_k = min(top_k, len(served.backend.labels))
+    key: Optional[str] = None
+    if prediction_cache.enabled:
+        [key] = await loop.run_in_executor(
+            decode_executor, cache_keys, [image.contents], top_k, served.identity
+        )
+        cached = None if bypass_cache else prediction_cache.get(key)
+        if cached is not None:
+            return cached
+
+    timer = StageTimer()
+    try:
+        check_deadline(deadline, "decoding")
+        with timer.stage("decode"):
+            decoded = await loop.run_in_executor(
+                decode_executor, decode_image, image.contents, served.backend.resizer.decode_size
+            )
+        [prediction] = await served.batch_scheduler.submit(
+            [(decoded, top_k)], timer.durations, PRIORITIES[priority], deadline
+        )
+    except ImageDecodeError as e:
+        logger.warning(f"Rejected streamed image {image.id}: {e}")
+        metrics_aggregator.increment("inference.decode_errors", 1, metric_tags)
+        return {"error": str(e)}
+    except DeadlineExceeded as e:
+        metrics_aggregator.increment("inference.deadline_dropped", 1, metric_tags)
+        return {"error": str(e)}
+    except Exception:
+        metrics_aggregator.increment("inference.errors", 1, metric_tags)
+        raise
+    timer.record(metrics_aggregator, "inference.stage_duration", metric_tags)
+    metrics_aggregator.increment("inference.images_processed", 1, metric_tags)
+    if key is not None:
+        prediction_cache.put(key, prediction)
+    return prediction
+
+
+@app.post("/classify/stream")
+@app.post("/models/{model:path}/classify/stream")
+async def classify_stream(
+    request: Request,
+    top_k: int = Query(1, ge=1, description="Number of labels to return per image"),
+):
+    """Classify a stream of images, answering with one NDJSON line per image as it is classified.
+
+    The body is NDJSON with a base64 `image` and optional `id` per line, or multipart/form-data
+    `files` parts. Each line of the response has the image's `index` in the stream, its `id` or
+    filename, and its prediction or `error`. The model is chosen as for /classify/.
+    """
+    name = model_name(request)
+    try:
+        registry.path(name)
+    except ModelNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except UnsupportedModel as e:
+        raise HTTPException(status_code=400, detail=f"Can't serve model {name}: {e}")
+    try:
+        images = iter_stream_images(request.headers.get("content-type", ""), request.stream())
+    except ValueError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    bypass_cache = should_bypass_cache(request)
+    rid = request_id(request.headers)
+    priority = parse_priority(request.headers)
+    deadline = parse_deadline(request.headers)
+    logger.info(f"Streaming classification request {rid} started")
+    return DuplexStreamingResponse(
+        stream_predictions(
+            images,
+            lambda image: classify_streamed_image(
+                image, name, top_k, bypass_cache, priority, deadline
+            ),
+        ),
+        headers={REQUEST_ID_HEADER: rid},
+    )
+
+
+@app.get("/metrics")
+async def metrics():
+    """Current metrics in the Prometheus text format, for scraping."""
+    return Response(metrics_aggregator.render_prometheus(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@app.get("/models")
+async def models():
+    """Models that can be requested, and the ones that are loaded."""
+    return {
+        "default": DEFAULT_MODEL,
+        "available": registry.available(),
+        "resident": list(registry.resident),
+    }
+
+
+@app.get("/stats")
+async def stats():
+    """Batch scheduler, model registry, prediction cache and startup statistics.
+
+    The top-level batch scheduler statistics are the default model's. Every resident model's are
+    under `registry`.
+    """
+    model_stats = registry.stats()
+    for name, entry in registry.resident.items():
+        model_stats["models"][name]["batching"] = entry.model.batch_scheduler.stats()
+    return {
+        **default_model.batch_scheduler.stats(),
+        "registry": model_stats,
+        "cache": prediction_cache.stats(),
+        "startup_seconds": startup_timings,
+    }
 
 
 @app.get("/health")
@@ -211,14 +759,47 @@ async def health():
     logger.info("Health check requested")
     pod_id = os.environ.get("HOSTNAME", "Unknown")
 
-    send_metric(
+    metrics_aggregator.increment(
         "inference.health_check",
         1,
-        MetricIntakeType.COUNT,
         [f"pod:{pod_id}", f"env:{DD_ENV}", f"service:{DD_SERVICE}", f"version:{DD_VERSION}"],
     )
 
-    return {"status": "healthy", "pod_id": pod_id, "model_device": DEVICE, "environment": DD_ENV}
+    return {
+        "status": "healthy",
+        "pod_id": pod_id,
+        "model_device": DEVICE,
+        "backend": default_model.backend.name,
+        "environment": DD_ENV,
+    }
+
+
+@app.get("/livez")
+async def livez():
+    """Liveness probe. Answers from memory only, so a slow dependency can't restart the pod."""
+    return {"status": "alive"}
+
+
+@app.get("/readyz")
+async def readyz(request: Request):
+    """Readiness probe. Not ready until the model is warmed up, or while the queue is too deep."""
+    queue_depth = sum(
+        entry.model.batch_scheduler.queue_depth for entry in registry.resident.values()
+    )
+    checks = {
+        "model_warmed": request.app.state.model_warmed,
+        "queue_below_threshold": queue_depth < READY_MAX_QUEUE_DEPTH,
+    }
+    ready = all(checks.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ready" if ready else "not_ready",
+            "checks": checks,
+            "queue_depth": queue_depth,
+            "worker": os.getpid(),
+        },
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,471 @@
+"""In-process metrics aggregation with batched, asynchronous delivery to Datadog.
+
+Request handlers only update in-memory counters, gauges and histograms. A background task sends
+everything recorded since the previous flush as one payload per interval over a reused client.
+The same cumulative values can also be scraped in the Prometheus text format.
+"""
+
+import asyncio
+import bisect
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from datadog_api_client import ApiClient
+from datadog_api_client import Configuration
+from datadog_api_client.v2.api.metrics_api import MetricsApi
+from datadog_api_client.v2.model.metric_intake_type import MetricIntakeType
+from datadog_api_client.v2.model.metric_payload import MetricPayload
+from datadog_api_client.v2.model.metric_point import MetricPoint
+from datadog_api_client.v2.model.metric_series import MetricSeries
+from starlette.types import ASGIApp
+from starlette.types import Receive
+from starlette.types import Scope
+from starlette.types import Send
+
+logger = logging.getLogger(__name__)
+
+METRICS_SINK = os.getenv("METRICS_SINK", "datadog")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "10"))
+METRICS_MAX_SERIES = int(os.getenv("METRICS_MAX_SERIES", "1000"))
+METRICS_MAX_PENDING_BATCHES = int(os.getenv("METRICS_MAX_PENDING_BATCHES", "6"))
+
+# Histogram bucket upper bounds, in the unit of the observed values (seconds for latencies)
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def count_buckets(limit: int) -> Tuple[float, ...]:
+    """Powers of two up to the first one that reaches `limit`, for count-valued histograms."""
+    buckets = [1.0]
+    while buckets[-1] < limit:
+        buckets.append(buckets[-1] * 2)
+    return tuple(buckets)
+
+
+SeriesKey = Tuple[str, Tuple[str, ...]]
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Sample(NamedTuple):
+    """A single aggregated value ready to be sent to a sink."""
+
+    name: str
+    type: str
+    value: float
+    tags: Tuple[str, ...]
+
+
+class Histogram:
+    """Fixed-bucket histogram, so memory stays constant however many values are observed."""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.interval_max = 0.0
+
+    def observe(self, value: float) -> None:
+        """Record one value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.interval_max = max(self.interval_max, value)
+
+    def quantile(self, q: float, counts: Optional[Sequence[int]] = None) -> float:
+        """Estimate the q-quantile as the upper bound of the bucket that contains it."""
+        counts = self.counts if counts is None else counts
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank:
+                break
+        return self.buckets[index] if index < len(self.buckets) else self.interval_max
+
+
+class MetricsAggregator:
+    """Thread-safe store of counters, gauges and histograms, flushed in batches to a sink.
+
+    Values are kept cumulatively; each flush sends the change since the previous flush. The number
+    of distinct series is capped at `max_series`, and updates to series beyond the cap are dropped
+    and counted in `metrics.dropped_updates`. Batches the sink fails to accept are retried on the
+    next flush, keeping at most `max_pending_batches` of them; older ones are dropped and counted
+    in `metrics.dropped_samples`.
+    """
+
+    def __init__(
+        self,
+        max_series: int = METRICS_MAX_SERIES,
+        max_pending_batches: int = METRICS_MAX_PENDING_BATCHES,
+    ):
+        self.max_series = max_series
+        self.lock = threading.Lock()
+        self.counters: Dict[SeriesKey, float] = {}
+        self.gauges: Dict[SeriesKey, float] = {}
+        self.histograms: Dict[SeriesKey, Histogram] = {}
+        self.flushed_counters: Dict[SeriesKey, float] = {}
+        self.flushed_histograms: Dict[SeriesKey, Tuple[List[int], int, float]] = {}
+        # Each batch keeps the time it was collected at, so a retry doesn't move its points
+        self.pending: Deque[Tuple[int, List[Sample]]] = deque()
+        self.max_pending_batches = max_pending_batches
+        self.dropped_updates = 0
+        self.dropped_samples = 0
+        self.task: Optional[asyncio.Task] = None
+        self.sink: Optional["Sink"] = None
+
+    def _admit(self, key: SeriesKey, table: dict) -> bool:
+        """Whether a new series fits under the cap. Must be called with the lock held."""
+        if key in table:
+            return True
+        if len(self.counters) + len(self.gauges) + len(self.histograms) < self.max_series:
+            return True
+        if self.dropped_updates == 0:
+            logger.warning(f"Metric series cap of {self.max_series} reached, dropping updates")
+        self.dropped_updates += 1
+        return False
+
+    def increment(self, name: str, value: float = 1, tags: Optional[List[str]] = None) -> None:
+        """Add to a counter."""
+        key = (name, tuple(sorted(tags or [])))
+        with self.lock:
+            if self._admit(key, self.counters):
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, tags: Optional[List[str]] = None) -> None:
+        """Set a gauge to its latest value."""
+        key = (name, tuple(sorted(tags or [])))
+        with self.lock:
+            if self._admit(key, self.gauges):
+                self.gauges[key] = value
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        tags: Optional[List[str]] = None,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        """Record a value in a histogram.
+
+        `buckets` only applies when the series is first seen; pass `count_buckets(...)` for series
+        that count things rather than time them.
+        """
+        key = (name, tuple(sorted(tags or [])))
+        with self.lock:
+            if self._admit(key, self.histograms):
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(buckets)
+                self.histograms[key].observe(value)
+
+    def collect(self) -> List[Sample]:
+        """Everything recorded since the previous call, as samples ready to send."""
+        samples: List[Sample] = []
+        with self.lock:
+            # Drops are reported like any other counter, outside the series cap
+            if self.dropped_updates:
+                self.counters[("metrics.dropped_updates", ())] = self.dropped_updates
+            if self.dropped_samples:
+                self.counters[("metrics.dropped_samples", ())] = self.dropped_samples
+
+            for (name, tags), total in self.counters.items():
+                delta = total - self.flushed_counters.get((name, tags), 0)
+                if delta:
+                    samples.append(Sample(name, "count", delta, tags))
+                self.flushed_counters[(name, tags)] = total
+
+            for (name, tags), value in self.gauges.items():
+                samples.append(Sample(name, "gauge", value, tags))
+
+            for key, histogram in self.histograms.items():
+                name, tags = key
+                previous_counts, previous_count, previous_sum = self.flushed_histograms.get(
+                    key, ([0] * len(histogram.counts), 0, 0.0)
+                )
+                count = histogram.count - previous_count
+                if count:
+                    counts = [
+                        now - before for now, before in zip(histogram.counts, previous_counts)
+                    ]
+                    samples.append(Sample(f"{name}.count", "count", count, tags))
+                    samples.append(
+                        Sample(f"{name}.avg", "gauge", (histogram.sum - previous_sum) / count, tags)
+                    )
+                    samples.append(Sample(f"{name}.max", "gauge", histogram.interval_max, tags))
+                    for q in (0.5, 0.95, 0.99):
+                        samples.append(
+                            Sample(
+                                f"{name}.p{int(q * 100)}",
+                                "gauge",
+                                histogram.quantile(q, counts),
+                                tags,
+                            )
+                        )
+                self.flushed_histograms[key] = (
+                    list(histogram.counts),
+                    histogram.count,
+                    histogram.sum,
+                )
+                histogram.interval_max = 0.0
+        return samples
+
+    def render_prometheus(self) -> str:
+        """Every series in the Prometheus text exposition format, from the cumulative values.
+
+        Scraping doesn't affect what is flushed to the sink. The lock is only held to copy the
+        values, so a scrape never stalls request handlers for longer than that.
+        """
+        with self.lock:
+            counters = list(self.counters.items())
+            gauges = list(self.gauges.items())
+            histograms = [
+                (key, histogram.buckets, list(histogram.counts), histogram.count, histogram.sum)
+                for key, histogram in self.histograms.items()
+            ]
+
+        lines: List[str] = []
+        declared = set()
+
+        def declare(name: str, metric_type: str) -> None:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} {metric_type}")
+
+        for (name, tags), value in sorted(counters):
+            metric = f"{prometheus_name(name)}_total"
+            declare(metric, "counter")
+            lines.append(f"{metric}{prometheus_labels(tags)} {value:g}")
+        for (name, tags), value in sorted(gauges):
+            metric = prometheus_name(name)
+            declare(metric, "gauge")
+            lines.append(f"{metric}{prometheus_labels(tags)} {value:g}")
+        for (name, tags), buckets, counts, count, total in sorted(histograms):
+            metric = prometheus_name(name)
+            declare(metric, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + [math.inf], counts):
+                cumulative += bucket_count
+                le = "+Inf" if math.isinf(bound) else f"{bound:g}"
+                labels = prometheus_labels(tags, f'le="{le}"')
+                lines.append(f"{metric}_bucket{labels} {cumulative}")
+            lines.append(f"{metric}_sum{prometheus_labels(tags)} {total:g}")
+            lines.append(f"{metric}_count{prometheus_labels(tags)} {count}")
+        lines.append("")
+        return "\n".join(lines)
+
+    async def flush(self) -> None:
+        """Send the current batch, plus any batches a previous flush failed to send."""
+        assert self.sink is not None
+        samples = self.collect()
+        if samples:
+            self.pending.append((int(time.time()), samples))
+        while len(self.pending) > self.max_pending_batches:
+            _, dropped = self.pending.popleft()
+            logger.warning(f"Dropping {len(dropped)} unsent metric(s)")
+            with self.lock:
+                self.dropped_samples += len(dropped)
+
+        while self.pending:
+            timestamp, batch = self.pending[0]
+            try:
+                await asyncio.to_thread(self.sink.send, batch, timestamp)
+            except Exception as e:
+                logger.error(f"Error sending {len(batch)} metric(s), will retry: {e}")
+                return
+            self.pending.popleft()
+
+    async def run(self, interval: float) -> None:
+        """Flush every `interval` seconds until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    def start(self, sink: "Sink", interval: float = METRICS_FLUSH_INTERVAL) -> None:
+        """Start flushing to `sink` on a background task."""
+        self.sink = sink
+        self.task = asyncio.create_task(self.run(interval))
+
+    async def stop(self) -> None:
+        """Stop the background task, flush what is left and close the sink."""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.sink is not None:
+            await self.flush()
+            self.sink.close()
+
+    def stats(self) -> Dict[str, int]:
+        """Size of the aggregator and how much it has had to drop."""
+        with self.lock:
+            return {
+                "series": len(self.counters) + len(self.gauges) + len(self.histograms),
+                "max_series": self.max_series,
+                "pending_batches": len(self.pending),
+                "dropped_updates": self.dropped_updates,
+                "dropped_samples": self.dropped_samples,
+            }
+
+
+def prometheus_name(name: str) -> str:
+    """A dotted metric name as a valid Prometheus name, e.g. `proxy.upstream.latency`."""
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+
+
+def prometheus_labels(tags: Tuple[str, ...], *extra: str) -> str:
+    """Datadog-style `key:value` tags as a Prometheus label set. Bare tags get the key `tag`."""
+    labels = []
+    for tag in tags:
+        key, _, value = tag.partition(":") if ":" in tag else ("tag", "", tag)
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        labels.append(f'{re.sub(r"[^a-zA-Z0-9_]", "_", key)}="{value}"')
+    labels.extend(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class StageTimer:
+    """How long each stage of one request took, for histograms and a Server-Timing header."""
+
+    def __init__(self) -> None:
+        self.durations: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time the block as the named stage, adding to any time already spent in it."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start_time)
+
+    def add(self, name: str, seconds: float) -> None:
+        """Add time measured elsewhere to a stage."""
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def record(self, aggregator: MetricsAggregator, name: str, tags: List[str]) -> None:
+        """Observe every stage in the `name` histogram, tagged with the stage."""
+        for stage, seconds in self.durations.items():
+            aggregator.observe(name, seconds, tags + [f"stage:{stage}"])
+
+    def server_timing(self, total: Optional[float] = None) -> str:
+        """The stages, and the whole request as `total` if given, as a Server-Timing value."""
+        durations = list(self.durations.items())
+        if total is not None:
+            durations.append(("total", total))
+        return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in durations)
+
+
+def received_at(scope: Scope) -> float:
+    """When RequestTimingMiddleware saw the request arrive, or now if it didn't run."""
+    return scope.get("state", {}).get("received_at", time.perf_counter())
+
+
+class RequestTimingMiddleware:
+    """Stamp each request with its arrival time, before the body is read and parsed.
+
+    Handlers only run once their parameters, including any multipart form, have been parsed. The
+    difference between this stamp and the handler starting is the time spent reading the request.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Record the arrival time in the request state and pass the request on."""
+        if scope["type"] == "http":
+            scope.setdefault("state", {})["received_at"] = time.perf_counter()
+        await self.app(scope, receive, send)
+
+
+class Sink:
+    """Destination for batches of samples."""
+
+    def send(self, samples: List[Sample], timestamp: int) -> None:
+        """Deliver one batch. Called from a worker thread, never on the event loop."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Release any resources held by the sink."""
+
+
+class DatadogSink(Sink):
+    """Submit each batch as one Datadog metrics payload over a reused API client."""
+
+    def __init__(self, configuration: Configuration):
+        self.api_client = ApiClient(configuration)
+        self.api = MetricsApi(self.api_client)
+
+    def send(self, samples: List[Sample], timestamp: int) -> None:
+        """Submit the batch to Datadog."""
+        metric_types = {"count": MetricIntakeType.COUNT, "gauge": MetricIntakeType.GAUGE}
+        payload = MetricPayload(
+            series=[
+                MetricSeries(
+                    metric=sample.name,
+                    type=metric_types[sample.type],
+                    points=[MetricPoint(timestamp=timestamp, value=float(sample.value))],
+                    tags=list(sample.tags),
+                )
+                for sample in samples
+            ]
+        )
+        self.api.submit_metrics(body=payload)
+        logger.info(f"Sent {len(samples)} metric(s) to Datadog")
+
+    def close(self) -> None:
+        """Close the API client's connection pool."""
+        self.api_client.close()
+
+
+class StubSink(Sink):
+    """Keep every batch in memory, for running and testing without Datadog."""
+
+    def __init__(self):
+        self.batches: List[List[Sample]] = []
+
+    def send(self, samples: List[Sample], timestamp: int) -> None:
+        """Record the batch."""
+        self.batches.append(samples)
+
+
+def create_sink(configuration: Configuration) -> Sink:
+    """Build the sink selected by METRICS_SINK."""
+    if METRICS_SINK == "stub":
+        return StubSink()
+    return DatadogSink(configuration)
@@ -0,0 +1,286 @@
+"""Models served side by side from one models directory, loaded on first use.
+
+Each model is named by its path under the models directory, e.g. `nateraw/food`. A model is loaded
+the first time a request asks for it, and stays resident while the resident models fit within a
+memory budget. When loading another model would exceed the budget, the least recently used models
+that aren't serving a request are evicted first.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from metrics import MetricsAggregator
+
+logger = logging.getLogger(__name__)
+
+MODEL_MEMORY_BUDGET_MB = float(os.getenv("MODEL_MEMORY_BUDGET_MB", "8192"))
+
+# A directory is a model if it has a Hugging Face config. Names are at most this many levels deep.
+MODEL_CONFIG_FILENAME = "config.json"
+MAX_MODEL_NAME_DEPTH = 3
+WEIGHTS_FILENAMES = ("model.safetensors", "pytorch_model.bin")
+
+
+class ModelNotFound(Exception):
+    """Raised for a model name that isn't a model directory under the models directory."""
+
+
+class ModelUnavailable(Exception):
+    """Raised when the models using up the memory budget are all serving requests."""
+
+
+def weights_bytes(model_path: str) -> int:
+    """Size of a checkpoint's weights on disk, as an estimate of its memory before it is loaded."""
+    sizes = [
+        os.path.getsize(os.path.join(model_path, filename))
+        for filename in WEIGHTS_FILENAMES
+        if os.path.exists(os.path.join(model_path, filename))
+    ]
+    return max(sizes, default=0)
+
+
+class ResidentModel:
+    """A loaded model, how much memory it holds and how it has been used."""
+
+    def __init__(self, name: str, path: str, model: Any, load_seconds: float, pinned: bool):
+        self.name = name
+        self.path = path
+        self.model = model
+        self.memory_bytes: int = model.memory_bytes
+        self.load_seconds = load_seconds
+        self.pinned = pinned
+        self.loaded_at = time.monotonic()
+        self.last_used = self.loaded_at
+        self.in_use = 0
+
+
+class ModelRegistry:
+    """Loads models by name on first use and keeps the resident ones within a memory budget.
+
+    `load(name, path)` loads a model and returns it, and `unload(model)` releases it. Loaded models
+    must have a `memory_bytes` attribute, which is what counts against `memory_budget_bytes`.
+    Concurrent requests for a model that isn't resident share one load. Pinned models, such as
+    one preloaded at startup, are never evicted.
+    """
+
+    def __init__(
+        self,
+        models_dir: str,
+        load: Callable[[str, str], Awaitable[Any]],
+        unload: Callable[[Any], Awaitable[None]],
+        memory_budget_bytes: int = int(MODEL_MEMORY_BUDGET_MB * 1024 * 1024),
+        metrics_aggregator: Optional[MetricsAggregator] = None,
+        tags: Optional[List[str]] = None,
+    ):
+        self.models_dir = os.path.realpath(models_dir)
+        self.load = load
+        self.unload = unload
+        self.memory_budget_bytes = memory_budget_bytes
+        self.metrics_aggregator = metrics_aggregator
+        self.tags = tags or []
+        self.resident: OrderedDict[str, ResidentModel] = OrderedDict()
+        self.loading: Dict[str, asyncio.Task] = {}
+        # Memory set aside for models that are being loaded, so concurrent loads can't overshoot
+        self.reserved_bytes = 0
+        self.usage: Dict[str, Dict[str, int]] = {}
+
+    def path(self, name: str) -> str:
+        """The model directory for `name`, or ModelNotFound if it isn't one."""
+        parts = name.strip("/").split("/")
+        if (
+            not name
+            or len(parts) > MAX_MODEL_NAME_DEPTH
+            or any(part in ("", ".", "..") for part in parts)
+        ):
+            raise ModelNotFound(f"Invalid model name {name!r}")
+        path = os.path.realpath(os.path.join(self.models_dir, *parts))
+        if os.path.commonpath([path, self.models_dir]) != self.models_dir or not os.path.isfile(
+            os.path.join(path, MODEL_CONFIG_FILENAME)
+        ):
+            raise ModelNotFound(f"No model named {name!r} in {self.models_dir}")
+        return path
+
+    def available(self) -> List[str]:
+        """Names of every model under the models directory."""
+        names = []
+        for root, dirs, files in os.walk(self.models_dir):
+            depth = os.path.relpath(root, self.models_dir).count(os.sep) + 1
+            if MODEL_CONFIG_FILENAME in files and root != self.models_dir:
+                names.append(os.path.relpath(root, self.models_dir).replace(os.sep, "/"))
+            if depth >= MAX_MODEL_NAME_DEPTH:
+                dirs.clear()
+        return sorted(names)
+
+    @property
+    def resident_bytes(self) -> int:
+        """Memory held by the resident models."""
+        return sum(entry.memory_bytes for entry in self.resident.values())
+
+    def add(
+        self, name: str, path: str, model: Any, load_seconds: float, pinned: bool = True
+    ) -> None:
+        """Register a model that was loaded elsewhere, e.g. before the event loop started."""
+        self.resident[name] = ResidentModel(name, path, model, load_seconds, pinned)
+        self.record_residency()
+
+    @asynccontextmanager
+    async def use(self, name: str) -> AsyncIterator[Any]:
+        """Load the model if needed and keep it from being evicted until the block exits."""
+        entry = await self.acquire(name)
+        try:
+            yield entry.model
+        finally:
+            self.release(entry)
+
+    async def acquire(self, name: str) -> ResidentModel:
+        """The resident model called `name`, loading it first if it isn't, marked as in use.
+
+        Every call must be paired with a `release()`, or the model can never be evicted.
+        """
+        name = name.strip("/")
+        loaded = False
+        while True:
+            entry = self.resident.get(name)
+            if entry is not None:
+                entry.in_use += 1
+                entry.last_used = time.monotonic()
+                self.resident.move_to_end(name)
+                self.count(entry, "misses" if loaded else "hits")
+                return entry
+            loaded = True
+            task = self.loading.get(name)
+            if task is None:
+                task = asyncio.create_task(self.load_resident(name))
+                self.loading[name] = task
+                task.add_done_callback(lambda _: self.loading.pop(name, None))
+            # Shielded, so a request that gives up doesn't abandon a load others are waiting for
+            await asyncio.shield(task)
+
+    def release(self, entry: ResidentModel) -> None:
+        """Mark a model acquired with `acquire()` as no longer in use by that caller."""
+        entry.in_use -= 1
+        entry.last_used = time.monotonic()
+
+    async def load_resident(self, name: str) -> None:
+        """Make room for a model, load it and add it to the resident models."""
+        path = self.path(name)
+        estimate = weights_bytes(path)
+        await self.make_room(name, estimate)
+        self.reserved_bytes += estimate
+        start_time = time.perf_counter()
+        try:
+            model = await self.load(name, path)
+        finally:
+            self.reserved_bytes -= estimate
+        load_seconds = time.perf_counter() - start_time
+
+        entry = ResidentModel(name, path, model, load_seconds, False)
+        self.resident[name] = entry
+        self.count(entry, "loads")
+        logger.info(
+            f"Loaded model {name} in {load_seconds:.2f}s, "
+            f"{entry.memory_bytes / 1024 / 1024:.1f} MiB"
+        )
+        if self.metrics_aggregator is not None:
+            self.metrics_aggregator.observe(
+                "inference.model.load_time", load_seconds, self.tags + [f"model:{path}"]
+            )
+        # The estimate can be off, so settle up once the real size is known
+        await self.make_room(name, 0)
+        self.record_residency()
+
+    async def make_room(self, name: str, needed_bytes: int) -> None:
+        """Evict least recently used models until `needed_bytes` more fit within the budget."""
+        while self.resident_bytes + self.reserved_bytes + needed_bytes > self.memory_budget_bytes:
+            victim = next(
+                (
+                    entry
+                    for entry in self.resident.values()
+                    if not entry.pinned and entry.in_use == 0 and entry.name != name
+                ),
+                None,
+            )
+            if victim is None:
+                if name in self.resident:
+                    logger.warning(
+                        f"Resident models use {self.resident_bytes / 1024 / 1024:.1f} MiB, over "
+                        f"the budget of {self.memory_budget_bytes / 1024 / 1024:.1f} MiB"
+                    )
+                    return
+                raise ModelUnavailable(
+                    f"Not enough memory to load {name}, every resident model is in use"
+                )
+            await self.evict(victim)
+
+    async def evict(self, entry: ResidentModel) -> None:
+        """Drop a resident model and release it."""
+        del self.resident[entry.name]
+        self.count(entry, "evictions")
+        logger.info(
+            f"Evicting model {entry.name}, {entry.memory_bytes / 1024 / 1024:.1f} MiB, idle for "
+            f"{time.monotonic() - entry.last_used:.0f}s"
+        )
+        self.record_residency()
+        await self.unload(entry.model)
+
+    async def aclose(self) -> None:
+        """Release every resident model."""
+        for task in list(self.loading.values()):
+            task.cancel()
+        while self.resident:
+            _, entry = self.resident.popitem()
+            await self.unload(entry.model)
+
+    def count(self, entry: ResidentModel, event: str) -> None:
+        """Count a hit, miss, load or eviction for a model."""
+        usage = self.usage.setdefault(
+            entry.name, {"hits": 0, "misses": 0, "loads": 0, "evictions": 0}
+        )
+        usage[event] += 1
+        if self.metrics_aggregator is not None:
+            self.metrics_aggregator.increment(
+                f"inference.model.{event}", 1, self.tags + [f"model:{entry.path}"]
+            )
+
+    def record_residency(self) -> None:
+        """Report how many models are resident and how much memory they hold."""
+        if self.metrics_aggregator is None:
+            return
+        self.metrics_aggregator.gauge("inference.model.resident", len(self.resident), self.tags)
+        self.metrics_aggregator.gauge(
+            "inference.model.resident_bytes", self.resident_bytes, self.tags
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        """The memory budget, and residency and usage counters for every model used so far."""
+        now = time.monotonic()
+        models: Dict[str, Dict[str, Any]] = {}
+        for name, usage in self.usage.items():
+            models[name] = {"resident": False, **usage}
+        for name, entry in self.resident.items():
+            models[name] = {
+                **models.get(name, {}),
+                "resident": True,
+                "pinned": entry.pinned,
+                "memory_mb": entry.memory_bytes / 1024 / 1024,
+                "load_seconds": entry.load_seconds,
+                "resident_seconds": now - entry.loaded_at,
+                "idle_seconds": now - entry.last_used,
+                "in_use": entry.in_use,
+            }
+        return {
+            "memory_budget_mb": self.memory_budget_bytes / 1024 / 1024,
+            "resident_mb": self.resident_bytes / 1024 / 1024,
+            "models": models,
+        }
@@ -0,0 +1,105 @@
+"""Content-addressed LRU cache of predictions, keyed by a hash of the image bytes."""
+
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from metrics import MetricsAggregator
+
+PREDICTION_CACHE_MAX_ENTRIES = int(os.getenv("PREDICTION_CACHE_MAX_ENTRIES", "10000"))
+PREDICTION_CACHE_MAX_BYTES = int(os.getenv("PREDICTION_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+PREDICTION_CACHE_TTL = float(os.getenv("PREDICTION_CACHE_TTL", "3600"))
+
+# Rough per-entry cost of the key, the dict, the OrderedDict node and the expiry timestamp
+ENTRY_OVERHEAD_BYTES = 400
+
+
+def cache_key(contents: bytes, model_identity: str) -> str:
+    """Hash image bytes together with the model that classifies them."""
+    digest = hashlib.blake2b(contents, digest_size=16)
+    digest.update(model_identity.encode())
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """LRU cache with a TTL and a memory bound, for the event loop thread only.
+
+    Entries are evicted least recently used first once either `max_entries` or `max_bytes` is
+    exceeded. Entries older than `ttl` seconds are treated as misses.
+    """
+
+    def __init__(
+        self,
+        metrics_aggregator: MetricsAggregator,
+        tags: Optional[List[str]] = None,
+        max_entries: int = PREDICTION_CACHE_MAX_ENTRIES,
+        max_bytes: int = PREDICTION_CACHE_MAX_BYTES,
+        ttl: float = PREDICTION_CACHE_TTL,
+    ):
+        self.metrics_aggregator = metrics_aggregator
+        self.tags = tags or []
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries: OrderedDict[str, Tuple[float, int, Dict[str, Any]]] = OrderedDict()
+        self.size_bytes = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the cache stores anything at all."""
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached prediction for `key`, or None on a miss."""
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] > self.ttl:
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.metrics_aggregator.increment("inference.cache.misses", 1, self.tags)
+            return None
+        self.entries.move_to_end(key)
+        self.metrics_aggregator.increment("inference.cache.hits", 1, self.tags)
+        return entry[2]
+
+    def put(self, key: str, prediction: Dict[str, Any]) -> None:
+        """Store a prediction, evicting the least recently used entries to stay within bounds."""
+        if not self.enabled:
+            return
+        if key in self.entries:
+            self._remove(key)
+        size = len(key) + len(json.dumps(prediction)) + ENTRY_OVERHEAD_BYTES
+        self.entries[key] = (time.monotonic(), size, prediction)
+        self.size_bytes += size
+
+        evicted = 0
+        while self.entries and (
+            len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes
+        ):
+            self._remove(next(iter(self.entries)))
+            evicted += 1
+        if evicted:
+            self.metrics_aggregator.increment("inference.cache.evictions", evicted, self.tags)
+        self.metrics_aggregator.gauge("inference.cache.entries", len(self.entries), self.tags)
+        self.metrics_aggregator.gauge("inference.cache.bytes", self.size_bytes, self.tags)
+
+    def _remove(self, key: str) -> None:
+        """Drop one entry and its size from the running total."""
+        _, size, _ = self.entries.pop(key)
+        self.size_bytes -= size
+
+    def stats(self) -> Dict[str, int]:
+        """Current size of the cache."""
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+        }
@@ -1,29 +1,66 @@
 """Proxy for forwarding image classification requests to a more powerful server."""
 
+import asyncio
+import math
 import os
+import random
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from typing import Dict
 from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
 
 import httpx
-from datadog_api_client import ApiClient
+import orjson
 from datadog_api_client import Configuration
-from datadog_api_client.v2.api.metrics_api import MetricsApi
-from datadog_api_client.v2.model.metric_intake_type import MetricIntakeType
-from datadog_api_client.v2.model.metric_payload import MetricPayload
-from datadog_api_client.v2.model.metric_point import MetricPoint
-from datadog_api_client.v2.model.metric_series import MetricSeries
 from ddtrace import config
 from ddtrace import patch_all
 from ddtrace.profiling import Profiler
 from fastapi import FastAPI
-from fastapi import File
 from fastapi import HTTPException
 from fastapi import Request
-from fastapi import UploadFile
+from fastapi import Response
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from pydantic import Field
+from pydantic import ValidationError
+from starlette.datastructures import UploadFile
+from starlette.requests import ClientDisconnect
 
-app = FastAPI()
+from concurrency_limiter import AdaptiveConcurrencyLimiter
+from concurrency_limiter import LimitExceeded
+from concurrency_limiter import Permit
+from decoding import downscale_image
+from hedging import Hedger
+from metrics import PROMETHEUS_CONTENT_TYPE
+from metrics import MetricsAggregator
+from metrics import RequestTimingMiddleware
+from metrics import StageTimer
+from metrics import create_sink
+from metrics import received_at
+from streaming import DuplexStreamingResponse
+from streaming import StreamImage
+from streaming import iter_stream_images
+from streaming import stream_predictions
+from tracing import DEADLINE_HEADER
+from tracing import MODEL_HEADER
+from tracing import PRIORITY_HEADER
+from tracing import REQUEST_ID_HEADER
+from tracing import deadline_dropped
+from tracing import format_deadline
+from tracing import parse_deadline
+from tracing import parse_priority
+from tracing import parse_server_timing
+from tracing import request_id
+from tracing import time_remaining
+from upstreams import LoadBalancer
+from upstreams import NoHealthyUpstream
+from upstreams import UpstreamPool
+from upstreams import UpstreamPools
 
 patch_all()
 config.env = os.getenv("DD_ENV", "production")
@@ -35,18 +72,85 @@ dd_config = Configuration()
 dd_config.server_variables["site"] = os.getenv("DD_SITE", "us5.datadoghq.com")
 dd_config.api_key["apiKeyAuth"] = os.getenv("DD_API_KEY")
 dd_config.api_key["appKeyAuth"] = os.getenv("DD_APP_KEY")
+metrics_aggregator = MetricsAggregator()
 
 POD_ID = os.environ.get("HOSTNAME", "Unknown")
 
+# Upstream selection. With INFERENCE_ENDPOINTS set the proxy load balances across them, otherwise
+# every request names its endpoint in the X-Inference-Endpoint header. With them set, the header is
+# ignored unless ALLOW_ENDPOINT_OVERRIDE turns it on for debugging, since it sends the request
+# anywhere the client likes and skips load balancing, hedging and retries.
+INFERENCE_ENDPOINTS = [
+    endpoint.strip()
+    for endpoint in os.getenv("INFERENCE_ENDPOINTS", "").split(",")
+    if endpoint.strip()
+]
+ALLOW_ENDPOINT_OVERRIDE = os.getenv("ALLOW_ENDPOINT_OVERRIDE", "false").lower() == "true"
+READY_MAX_IN_FLIGHT = int(os.getenv("READY_MAX_IN_FLIGHT", "200"))
+
+# Deadline for /classify/ requests that don't bring an earlier one in X-Request-Deadline
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "60.0"))
+
+# Fraction of upstream responses checked against the response schema, for debugging. The rest are
+# passed through to the client byte for byte.
+PROXY_VALIDATE_SAMPLE_RATE = float(os.getenv("PROXY_VALIDATE_SAMPLE_RATE", "0.0"))
+
+# Downscaling images before forwarding them, to save upstream bandwidth
+PROXY_RESIZE = os.getenv("PROXY_RESIZE", "false").lower() == "true"
+PROXY_RESIZE_MAX_SIDE = int(os.getenv("PROXY_RESIZE_MAX_SIDE", "448"))
+PROXY_RESIZE_QUALITY = int(os.getenv("PROXY_RESIZE_QUALITY", "90"))
+PROXY_RESIZE_WORKERS = int(os.getenv("PROXY_RESIZE_WORKERS", "2"))
+
+# Request body handling
+PROXY_STREAMING = os.getenv("PROXY_STREAMING", "false").lower() == "true"
+STREAM_BUFFER_CHUNKS = int(os.getenv("STREAM_BUFFER_CHUNKS", "8"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the upstream pools, limiter, load balancer and metrics flusher; close them on exit."""
+    app.state.upstream_pools = UpstreamPools(metrics_aggregator=metrics_aggregator)
+    app.state.concurrency_limiter = AdaptiveConcurrencyLimiter(
+        metrics_aggregator=metrics_aggregator
+    )
+    app.state.load_balancer = LoadBalancer(
+        INFERENCE_ENDPOINTS, app.state.upstream_pools, metrics_aggregator=metrics_aggregator
+    )
+    app.state.hedger = Hedger(metrics_aggregator=metrics_aggregator)
+    # Pillow releases the GIL while decoding, resizing and encoding, so threads run in parallel
+    app.state.resize_executor = ThreadPoolExecutor(
+        max_workers=PROXY_RESIZE_WORKERS, thread_name_prefix="resize"
+    )
+    metrics_aggregator.start(create_sink(dd_config))
+    app.state.load_balancer.start()
+    yield
+    await app.state.load_balancer.stop()
+    await app.state.upstream_pools.aclose()
+    await metrics_aggregator.stop()
+    app.state.resize_executor.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+app.add_middleware(RequestTimingMiddleware)
+
 
 # Pydantic models
-class PredictionResponse(BaseModel):
-    """Format for an individual prediction."""
+class LabelScore(BaseModel):
+    """A single label and its probability."""
 
     label: str
     score: float
 
 
+class PredictionResponse(BaseModel):
+    """Format for an individual prediction, or the reason the image couldn't be classified."""
+
+    label: Optional[str] = None
+    score: Optional[float] = None
+    top_k: Optional[List[LabelScore]] = None
+    error: Optional[str] = None
+
+
 class ClassificationResponse(BaseModel):
     """Response format for a series of images."""
 
@@ -61,40 +165,459 @@ class ProxyResponse(BaseModel):
     inference_endpoint: str
 
 
-@app.post("/classify/", response_model=ProxyResponse)
-async def proxy_classify(request: Request, files: List[UploadFile] = File(...)):
-    """Forwards image classification requests onto the inference server."""
-    print(f"Received request to /classify/ with {len(files)} files")
-    for file in files:
-        print(f"File: {file.filename}, Content-Type: {file.content_type}")
-
-    inference_endpoint = request.headers.get("X-Inference-Endpoint")
-    if not inference_endpoint:
-        raise HTTPException(status_code=400, detail="X-Inference-Endpoint header is required")
-
-    async with httpx.AsyncClient() as client:
-        try:
-            files_data = [
-                ("files", (file.filename, await file.read(), file.content_type)) for file in files
-            ]
-            response = await client.post(inference_endpoint, files=files_data, timeout=60.0)
-            response.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            print(f"HTTP Status Error: {e}")
-            raise HTTPException(status_code=e.response.status_code, detail=str(e))
-        except httpx.RequestError as e:
-            print(f"Request Error: {e}")
-            raise HTTPException(
-                status_code=500, detail=f"Error requesting {inference_endpoint}: {str(e)}"
+def splice_response(upstream_body: bytes, inference_endpoint: str) -> Response:
+    """Wrap the upstream's JSON body in a ProxyResponse without decoding it.
+
+    The upstream bytes are copied verbatim between the serialized `pod_id` and `inference_endpoint`
+    fields, so the response costs one concatenation instead of a parse, a Pydantic validation and
+    a re-encode. Both fields are also sent as headers, for clients that only want the metadata.
+    """
+    content = b"".join(
+        (
+            b'{"pod_id":',
+            orjson.dumps(POD_ID),
+            b',"original_response":',
+            upstream_body,
+            b',"inference_endpoint":',
+            orjson.dumps(inference_endpoint),
+            b"}",
+        )
+    )
+    return Response(
+        content=content,
+        media_type="application/json",
+        headers={"X-Pod-ID": POD_ID, "X-Inference-Endpoint": inference_endpoint},
+    )
+
+
+def validate_upstream_response(upstream_body: bytes, inference_endpoint: str) -> None:
+    """Validate a sampled upstream body against ClassificationResponse, counting misfits."""
+    try:
+        ClassificationResponse.model_validate_json(upstream_body)
+    except ValidationError as e:
+        print(f"Invalid response from {inference_endpoint}: {e}")
+        metrics_aggregator.increment(
+            "proxy.validation_errors", 1, [f"upstream:{httpx.URL(inference_endpoint).host}"]
+        )
+
+
+def stage_timer(request: Request) -> StageTimer:
+    """The StageTimer for this request, created on first use."""
+    timer = getattr(request.state, "stage_timer", None)
+    if timer is None:
+        timer = request.state.stage_timer = StageTimer()
+    return timer
+
+
+def start_request(request: Request, timeout: Optional[float]) -> None:
+    """Give the request an ID, deadline, priority class and model, kept to be forwarded upstream.
+
+    The deadline is the client's X-Request-Deadline, capped at `timeout` seconds from now. With no
+    `timeout`, only the client's deadline applies. The model is the one named in the path or the
+    X-Model header, or the inference server's default without either.
+    """
+    request.state.request_id = request_id(request.headers)
+    request.state.priority = parse_priority(request.headers)
+    request.state.model = request.path_params.get("model") or request.headers.get(MODEL_HEADER)
+    deadline = parse_deadline(request.headers)
+    if timeout is not None:
+        deadline = min(deadline or math.inf, time.time() + timeout)
+    request.state.deadline = deadline
+
+
+def upstream_headers(request: Request) -> Dict[str, str]:
+    """Headers carrying the request's ID, priority, model and deadline to the inference server."""
+    headers = {
+        REQUEST_ID_HEADER: request.state.request_id,
+        PRIORITY_HEADER: request.state.priority,
+    }
+    if request.state.model:
+        headers[MODEL_HEADER] = request.state.model
+    if request.state.deadline is not None:
+        headers[DEADLINE_HEADER] = format_deadline(request.state.deadline)
+    return headers
+
+
+def upstream_timeout(request: Request) -> Union[float, httpx._client.UseClientDefault]:
+    """Timeout for one upstream attempt: the time left before the deadline, if there is one."""
+    remaining = time_remaining(request.state.deadline)
+    if remaining is None:
+        return httpx.USE_CLIENT_DEFAULT
+    # httpx treats a zero timeout as none at all
+    return max(remaining, 0.001)
+
+
+def merge_upstream_timings(timer: StageTimer, response: httpx.Response) -> None:
+    """Add the inference server's stages to the request's, and the rest of its time as network.
+
+    The upstream's stages are prefixed with `inference.`. `network` is how long the attempt that
+    answered took, less the inference server's own total: connecting, sending and receiving.
+    """
+    upstream = parse_server_timing(response.headers.get("Server-Timing", ""))
+    inference_total = upstream.pop("total", None)
+    for stage, seconds in upstream.items():
+        timer.add(f"inference.{stage}", seconds)
+    if inference_total is not None:
+        timer.add("network", max(0.0, response.elapsed.total_seconds() - inference_total))
+
+
+async def read_body_into(request: Request, buffer: asyncio.Queue) -> None:
+    """Read the client's request body into a bounded queue, ending with a `None` sentinel."""
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await buffer.put(chunk)
+        await buffer.put(None)
+    except Exception as e:
+        await buffer.put(e)
+
+
+async def relay_body(buffer: asyncio.Queue) -> AsyncIterator[bytes]:
+    """Yield body chunks from the queue until the reader finishes or fails."""
+    while True:
+        chunk = await buffer.get()
+        if chunk is None:
+            return
+        if isinstance(chunk, Exception):
+            raise chunk
+        yield chunk
+
+
+async def forward_streaming(
+    request: Request, pool: UpstreamPool, inference_endpoint: str
+) -> httpx.Response:
+    """Pipe the multipart body to the upstream chunk by chunk without buffering the upload.
+
+    The client body is read into a queue of at most STREAM_BUFFER_CHUNKS chunks. When the upstream
+    falls behind the queue fills up and reading from the client pauses, so proxy memory stays
+    bounded regardless of upload size.
+    """
+    content_type = request.headers.get("content-type", "")
+    if not content_type.startswith("multipart/form-data"):
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data request body")
+
+    headers = {"content-type": content_type, **upstream_headers(request)}
+    if "content-length" in request.headers:
+        headers["content-length"] = request.headers["content-length"]
+
+    buffer: asyncio.Queue = asyncio.Queue(maxsize=STREAM_BUFFER_CHUNKS)
+    reader = asyncio.create_task(read_body_into(request, buffer))
+    try:
+        # The upload is read while it is sent, so reading counts towards the upstream stage
+        with stage_timer(request).stage("upstream"):
+            return await pool.post(
+                inference_endpoint,
+                params=request.query_params,
+                content=relay_body(buffer),
+                headers=headers,
+                timeout=upstream_timeout(request),
+            )
+    except ClientDisconnect:
+        raise HTTPException(status_code=400, detail="Client disconnected during upload")
+    finally:
+        reader.cancel()
+
+
+async def read_files(request: Request) -> List[Tuple]:
+    """Read every uploaded file into memory, downscaled if PROXY_RESIZE is set.
+
+    Because the body is in memory it can be sent more than once, so the request is hedged and
+    retried against other endpoints. It is read before the request takes a concurrency slot, so a
+    slow upload holds no slot and doesn't count towards the upstream's latency.
+    """
+    timer = stage_timer(request)
+    with timer.stage("read"):
+        form = await request.form()
+        files = [file for file in form.getlist("files") if isinstance(file, UploadFile)]
+        print(f"Received request to /classify/ with {len(files)} files")
+        if not files:
+            raise HTTPException(status_code=400, detail="No files provided for classification.")
+        for file in files:
+            print(f"File: {file.filename}, Content-Type: {file.content_type}")
+
+        files_data = [
+            ("files", (file.filename, await file.read(), file.content_type)) for file in files
+        ]
+    if PROXY_RESIZE:
+        with timer.stage("resize"):
+            files_data = await downscale_files(request, files_data)
+    return files_data
+
+
+async def forward_files(
+    request: Request, inference_endpoint: str, files_data: List[Tuple]
+) -> Tuple[str, httpx.Response]:
+    """POST files that are already in memory upstream, hedged and retried."""
+    timer = stage_timer(request)
+    upstream_pools = request.app.state.upstream_pools
+
+    async def send(endpoint: str) -> httpx.Response:
+        return await upstream_pools.get(endpoint).post(
+            endpoint,
+            params=request.query_params,
+            files=files_data,
+            headers=upstream_headers(request),
+            timeout=upstream_timeout(request),
+        )
+
+    with timer.stage("upstream"):
+        return await request.app.state.hedger.send(
+            inference_endpoint,
+            send,
+            lambda tried: alternative_endpoint(request, tried),
+            request.state.deadline,
+        )
+
+
+async def downscale_files(request: Request, files_data: List[Tuple]) -> List[Tuple]:
+    """Shrink and re-encode every file on the resize pool, recording bytes saved and CPU time."""
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(
+        *(
+            loop.run_in_executor(
+                request.app.state.resize_executor,
+                downscale_image,
+                contents,
+                PROXY_RESIZE_MAX_SIDE,
+                PROXY_RESIZE_QUALITY,
             )
+            for _, (_, contents, _) in files_data
+        )
+    )
+
+    downscaled = []
+    for (field, (filename, _, content_type)), (contents, resized, _) in zip(files_data, results):
+        downscaled.append((field, (filename, contents, "image/jpeg" if resized else content_type)))
+    bytes_in = sum(len(contents) for _, (_, contents, _) in files_data)
+    bytes_out = sum(len(contents) for contents, _, _ in results)
+    cpu_time = sum(cpu_time for _, _, cpu_time in results)
+    images_resized = sum(resized for _, resized, _ in results)
+    request.state.resize_stats = (bytes_in - bytes_out, cpu_time)
 
-    original_response = ClassificationResponse(**response.json())
-    proxy_response = ProxyResponse(
-        pod_id=POD_ID, original_response=original_response, inference_endpoint=inference_endpoint
+    metrics_aggregator.increment("proxy.resize.bytes_in", bytes_in)
+    metrics_aggregator.increment("proxy.resize.bytes_out", bytes_out)
+    metrics_aggregator.increment("proxy.resize.images_resized", images_resized)
+    metrics_aggregator.observe("proxy.resize.cpu_time", cpu_time)
+    print(
+        f"Downscaled {images_resized} of {len(files_data)} images from {bytes_in} to {bytes_out} "
+        f"bytes in {cpu_time * 1000:.1f}ms of CPU time"
     )
+    return downscaled
+
+
+def endpoint_override(request: Request) -> Optional[str]:
+    """The endpoint named in the X-Inference-Endpoint header, if it is to be used."""
+    override = request.headers.get("X-Inference-Endpoint")
+    if override and (ALLOW_ENDPOINT_OVERRIDE or not request.app.state.load_balancer.endpoints):
+        return override
+    return None
+
+
+def choose_endpoint(request: Request) -> str:
+    """The inference endpoint for this request: the override header if allowed, else balanced."""
+    load_balancer = request.app.state.load_balancer
+    override = endpoint_override(request)
+    if override:
+        return override
+    if not load_balancer.endpoints:
+        raise HTTPException(
+            status_code=400,
+            detail="X-Inference-Endpoint header is required when INFERENCE_ENDPOINTS is not set",
+        )
+    try:
+        return load_balancer.pick()
+    except NoHealthyUpstream as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+def alternative_endpoint(request: Request, tried: List[str]) -> Optional[str]:
+    """Another balanced endpoint to hedge or retry on. None for requests pinned by the header."""
+    load_balancer = request.app.state.load_balancer
+    if endpoint_override(request) or not load_balancer.endpoints:
+        return None
+    try:
+        return load_balancer.pick(exclude=tried)
+    except NoHealthyUpstream:
+        return None
+
+
+async def forward(
+    request: Request, permit: Permit, files_data: Optional[List[Tuple]] = None
+) -> Tuple[str, httpx.Response]:
+    """Forward the request to an inference endpoint, marking the permit dropped on upstream errors.
+
+    `files_data` are files already read into memory. Without them, the request body is streamed
+    upstream as it arrives. Requests whose deadline passed while they were queued are answered with
+    a 504 without being forwarded. A 504 from the inference server dropping the request for its
+    deadline doesn't count as an upstream error.
+    """
+    remaining = time_remaining(request.state.deadline)
+    if remaining is not None and remaining <= 0:
+        metrics_aggregator.increment("proxy.deadline_exceeded", 1, ["where:queue"])
+        raise HTTPException(status_code=504, detail="Request deadline exceeded before forwarding")
+    inference_endpoint = choose_endpoint(request)
+    try:
+        if files_data is not None:
+            inference_endpoint, response = await forward_files(
+                request, inference_endpoint, files_data
+            )
+        else:
+            pool = request.app.state.upstream_pools.get(inference_endpoint)
+            response = await forward_streaming(request, pool, inference_endpoint)
+        response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        print(f"HTTP Status Error: {e}")
+        if deadline_dropped(e.response.status_code, e.response.headers):
+            # The request was late, not the upstream at fault, so the limit stays as it is
+            metrics_aggregator.increment("proxy.deadline_exceeded", 1, ["where:inference"])
+        else:
+            permit.dropped = e.response.status_code >= 500
+        raise HTTPException(status_code=e.response.status_code, detail=str(e))
+    except httpx.TimeoutException as e:
+        print(f"Timeout Error: {e}")
+        permit.dropped = True
+        metrics_aggregator.increment("proxy.deadline_exceeded", 1, ["where:upstream"])
+        raise HTTPException(status_code=504, detail=f"Timed out waiting for {inference_endpoint}")
+    except httpx.RequestError as e:
+        print(f"Request Error: {e}")
+        permit.dropped = True
+        raise HTTPException(
+            status_code=500, detail=f"Error requesting {inference_endpoint}: {str(e)}"
+        )
+    return inference_endpoint, response
+
+
+# The handlers read the multipart body themselves, so it is described for the docs here
+CLASSIFY_OPENAPI_EXTRA = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "files": {
+                            "type": "array",
+                            "items": {"type": "string", "format": "binary"},
+                        }
+                    },
+                    "required": ["files"],
+                }
+            }
+        },
+    }
+}
+
+
+@app.post(
+    "/classify/",
+    response_model=ProxyResponse,
+    response_model_exclude_none=True,
+    openapi_extra=CLASSIFY_OPENAPI_EXTRA,
+)
+@app.post(
+    "/models/{model:path}/classify/",
+    response_model=ProxyResponse,
+    response_model_exclude_none=True,
+    openapi_extra=CLASSIFY_OPENAPI_EXTRA,
+)
+async def proxy_classify(request: Request):
+    """Forwards image classification requests onto the inference server.
+
+    The request's ID and deadline are passed upstream. The Server-Timing header of the response
+    merges the proxy's stages with the inference server's, so slow requests can be attributed to
+    the proxy, the network or the GPU server.
+    """
+    start_request(request, REQUEST_TIMEOUT)
+    timer = stage_timer(request)
+    timer.add("read", time.perf_counter() - received_at(request.scope))
+    files_data = None if PROXY_STREAMING else await read_files(request)
+    queued_at = time.perf_counter()
+    try:
+        async with request.app.state.concurrency_limiter.acquire() as permit:
+            timer.add("queue_wait", time.perf_counter() - queued_at)
+            inference_endpoint, response = await forward(request, permit, files_data)
+    except LimitExceeded as e:
+        print(f"Shedding request: {e}")
+        raise HTTPException(
+            status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)}
+        )
+
+    merge_upstream_timings(timer, response)
+    if random.random() < PROXY_VALIDATE_SAMPLE_RATE:
+        validate_upstream_response(response.content, inference_endpoint)
+    with timer.stage("serialize"):
+        proxy_response = splice_response(response.content, inference_endpoint)
+    resize_stats = getattr(request.state, "resize_stats", None)
+    if resize_stats is not None:
+        proxy_response.headers["X-Resize-Bytes-Saved"] = str(resize_stats[0])
+        proxy_response.headers["X-Resize-CPU-Ms"] = f"{resize_stats[1] * 1000:.1f}"
+    timer.record(metrics_aggregator, "proxy.stage_duration", [])
+    server_timing = timer.server_timing(total=time.perf_counter() - received_at(request.scope))
+    proxy_response.headers["Server-Timing"] = server_timing
+    proxy_response.headers[REQUEST_ID_HEADER] = request.state.request_id
+    print(f"Request {request.state.request_id} via {inference_endpoint}: {server_timing}")
     return proxy_response
 
 
+async def classify_streamed_image(request: Request, image: StreamImage) -> Dict:
+    """Forward one image from a /classify/stream body upstream as its own /classify/ request.
+
+    Every image is load balanced, limited, hedged and retried like a regular request. The
+    inference server batches the concurrent requests back together.
+    """
+    files_data = [("files", (image.id or "image", image.contents, image.content_type))]
+    if PROXY_RESIZE:
+        files_data = await downscale_files(request, files_data)
+    try:
+        async with request.app.state.concurrency_limiter.acquire() as permit:
+            _, response = await forward(request, permit, files_data)
+    except LimitExceeded as e:
+        return {"error": str(e)}
+    except HTTPException as e:
+        return {"error": e.detail}
+    return orjson.loads(response.content)["predictions"][0]
+
+
+@app.post("/classify/stream")
+@app.post("/models/{model:path}/classify/stream")
+async def proxy_classify_stream(request: Request):
+    """Classify a stream of images, answering with one NDJSON line per image as it is classified.
+
+    Takes the same NDJSON or multipart/form-data bodies as the inference server's /classify/stream.
+    """
+    try:
+        images = iter_stream_images(request.headers.get("content-type", ""), request.stream())
+    except ValueError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    # A stream can run for much longer than a single request, so only a client deadline applies
+    start_request(request, None)
+    # Fail before streaming if there is nowhere to send the images
+    choose_endpoint(request)
+    print(f"Streaming classification request {request.state.request_id} started")
+    return DuplexStreamingResponse(
+        stream_predictions(images, lambda image: classify_streamed_image(request, image)),
+        headers={"X-Pod-ID": POD_ID, REQUEST_ID_HEADER: request.state.request_id},
+    )
+
+
+@app.get("/metrics")
+async def metrics():
+    """Current metrics in the Prometheus text format, for scraping."""
+    return Response(metrics_aggregator.render_prometheus(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@app.get("/upstreams")
+async def upstreams(request: Request):
+    """Limiter, hedging and load balancer state, and connection pool statistics per upstream."""
+    return {
+        "concurrency": request.app.state.concurrency_limiter.stats(),
+        "hedging": request.app.state.hedger.stats(),
+        "load_balancer": request.app.state.load_balancer.stats(),
+        "pools": request.app.state.upstream_pools.stats(),
+    }
+
+
 class HealthResponse(BaseModel):
     """Response format for the health check endpoint."""
 
@@ -105,31 +628,47 @@ class HealthResponse(BaseModel):
 async def health():
     """Keep track of service health."""
     print("Health check requested")
-    metric = MetricPayload(
-        series=[
-            MetricSeries(
-                metric="proxy.health_check",
-                type=MetricIntakeType.COUNT,
-                points=[MetricPoint(timestamp=int(time.time()), value=1)],
-                tags=[
-                    f"pod:{POD_ID}",
-                    f"env:{config.env}",
-                    f"service:{config.service}",
-                    f"version:{config.version}",
-                ],
-            )
-        ]
+    metrics_aggregator.increment(
+        "proxy.health_check",
+        1,
+        [
+            f"pod:{POD_ID}",
+            f"env:{config.env}",
+            f"service:{config.service}",
+            f"version:{config.version}",
+        ],
     )
+    return HealthResponse(status="ok")
 
-    try:
-        with ApiClient(dd_config) as api_client:
-            response = MetricsApi(api_client).submit_metrics(body=metric)
-        print(f"Metric submitted successfully. Response: {response}")
-    except Exception as e:
-        print(f"Error submitting metric to Datadog: {e}")
-        print(f"Attempted to submit: {metric.to_dict()}")
 
-    return HealthResponse(status="ok")
+@app.get("/livez")
+async def livez():
+    """Liveness probe. Answers from memory only, so a slow dependency can't restart the pod."""
+    return {"status": "alive"}
+
+
+@app.get("/readyz")
+async def readyz(request: Request):
+    """Readiness probe. Not ready when every upstream is failing or too many requests are queued.
+
+    Only the upstreams in INFERENCE_ENDPOINTS are checked. Endpoints that clients name in the
+    X-Inference-Endpoint header say nothing about whether this proxy should get traffic, so
+    without configured upstreams there is no upstream check.
+    """
+    upstream_pools = getattr(request.app.state, "upstream_pools", None)
+    load_balancer = getattr(request.app.state, "load_balancer", None)
+    checks = {
+        "started": upstream_pools is not None,
+        "upstream_healthy": load_balancer is not None
+        and (not load_balancer.endpoints or bool(load_balancer.available())),
+        "in_flight_below_threshold": upstream_pools is not None
+        and upstream_pools.in_flight < READY_MAX_IN_FLIGHT,
+    }
+    ready = all(checks.values())
+    return ORJSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "not_ready", "checks": checks},
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,280 @@
+"""Bulk classification over a streamed request body, answered one NDJSON line per image.
+
+Clients send images either as NDJSON, one `{"id": ..., "image": "<base64>"}` object per line, or
+as a multipart/form-data body of `files` parts sent with chunked transfer encoding. Images are
+classified as they arrive, with at most `max_in_flight` parsed but unanswered at a time. Once that
+many are in flight the body stops being read, so memory stays bounded however many images are
+sent. Each result is written as soon as it is ready, tagged with the image's position in the
+stream, so results can come back out of order.
+"""
+
+import asyncio
+import base64
+import binascii
+import logging
+import os
+from typing import Any
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+
+import anyio
+import orjson
+from starlette.responses import StreamingResponse
+from starlette.types import Receive
+
+from decoding import MAX_IMAGE_BYTES
+
+try:
+    from python_multipart.multipart import MultipartParser
+    from python_multipart.multipart import parse_options_header
+except ImportError:  # python-multipart before 0.0.13
+    from multipart.multipart import MultipartParser
+    from multipart.multipart import parse_options_header
+
+logger = logging.getLogger(__name__)
+
+STREAM_MAX_IN_FLIGHT = int(os.getenv("STREAM_MAX_IN_FLIGHT", "64"))
+
+# Base64 takes 4 bytes for every 3, plus room for the id and the JSON around it
+MAX_LINE_BYTES = MAX_IMAGE_BYTES * 4 // 3 + 4096
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+class StreamImage:
+    """One image read from the stream, or the reason its record couldn't be read."""
+
+    def __init__(
+        self,
+        id: Optional[str],
+        contents: bytes = b"",
+        content_type: str = "application/octet-stream",
+        error: Optional[str] = None,
+    ):
+        self.id = id
+        self.contents = contents
+        self.content_type = content_type
+        self.error = error
+
+
+def parse_ndjson_line(line: bytes) -> StreamImage:
+    """Read one `{"id": ..., "image": "<base64>"}` record. Data URIs are accepted for `image`."""
+    try:
+        record = orjson.loads(line)
+    except orjson.JSONDecodeError as e:
+        return StreamImage(None, error=f"Invalid JSON: {e}")
+    if not isinstance(record, dict):
+        return StreamImage(None, error="Expected a JSON object")
+    image_id = record.get("id")
+    image_id = None if image_id is None else str(image_id)
+    payload = record.get("image")
+    if not isinstance(payload, str):
+        return StreamImage(image_id, error='Expected the image as a base64 string in "image"')
+    if payload.startswith("data:"):
+        payload = payload.partition(",")[2]
+    try:
+        return StreamImage(image_id, base64.b64decode(payload, validate=True))
+    except (binascii.Error, ValueError):
+        return StreamImage(image_id, error="Image is not valid base64")
+
+
+async def iter_ndjson_images(chunks: AsyncIterator[bytes]) -> AsyncIterator[StreamImage]:
+    """Split a byte stream into lines and parse each non-blank one as an image record.
+
+    A line longer than MAX_LINE_BYTES is skipped and reported as an error instead of buffered.
+    """
+    buffer = bytearray()
+    oversized = False
+    async for chunk in chunks:
+        buffer.extend(chunk)
+        while True:
+            newline = buffer.find(b"\n")
+            if newline == -1:
+                break
+            line = bytes(buffer[:newline])
+            del buffer[: newline + 1]
+            if oversized:
+                oversized = False
+                yield StreamImage(None, error=f"Line is longer than {MAX_LINE_BYTES} bytes")
+            elif line.strip():
+                yield parse_ndjson_line(line)
+        if len(buffer) > MAX_LINE_BYTES:
+            oversized = True
+            buffer.clear()
+    if oversized:
+        yield StreamImage(None, error=f"Line is longer than {MAX_LINE_BYTES} bytes")
+    elif buffer.strip():
+        yield parse_ndjson_line(bytes(buffer))
+
+
+async def iter_multipart_images(
+    chunks: AsyncIterator[bytes], boundary: bytes
+) -> AsyncIterator[StreamImage]:
+    """Yield each `files` part of a multipart body as soon as the part has been received.
+
+    Parts over MAX_IMAGE_BYTES are reported as errors without buffering the rest of their data.
+    """
+    parsed: List[StreamImage] = []
+    part: Dict[str, Any] = {}
+    header: Dict[str, bytes] = {}
+
+    def on_part_begin() -> None:
+        part.clear()
+        part.update(headers={}, data=bytearray(), oversized=False)
+
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        header["field"] = header.get("field", b"") + data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        header["value"] = header.get("value", b"") + data[start:end]
+
+    def on_header_end() -> None:
+        part["headers"][header.get("field", b"").lower()] = header.get("value", b"")
+        header.clear()
+
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        if part["oversized"]:
+            return
+        part["data"].extend(data[start:end])
+        if len(part["data"]) > MAX_IMAGE_BYTES:
+            part["oversized"] = True
+            part["data"] = bytearray()
+
+    def on_part_end() -> None:
+        _, options = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        if options.get(b"name") != b"files":
+            return
+        filename = options.get(b"filename")
+        image_id = filename.decode("latin-1") if filename is not None else None
+        if part["oversized"]:
+            error = f"File is larger than the {MAX_IMAGE_BYTES} byte limit"
+            parsed.append(StreamImage(image_id, error=error))
+            return
+        content_type = part["headers"].get(b"content-type", b"application/octet-stream")
+        parsed.append(StreamImage(image_id, bytes(part["data"]), content_type.decode("latin-1")))
+
+    parser = MultipartParser(
+        boundary,
+        {
+            "on_part_begin": on_part_begin,
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_part_data": on_part_data,
+            "on_part_end": on_part_end,
+        },
+    )
+    async for chunk in chunks:
+        parser.write(chunk)
+        while parsed:
+            yield parsed.pop(0)
+    parser.finalize()
+    while parsed:
+        yield parsed.pop(0)
+
+
+def iter_stream_images(
+    content_type: str, chunks: AsyncIterator[bytes]
+) -> AsyncIterator[StreamImage]:
+    """Parse the body according to its content type.
+
+    Raises ValueError for anything other than NDJSON or multipart/form-data with a boundary.
+    """
+    media_type, options = parse_options_header(content_type)
+    if media_type in (b"application/x-ndjson", b"application/jsonl"):
+        return iter_ndjson_images(chunks)
+    if media_type == b"multipart/form-data":
+        if not options.get(b"boundary"):
+            raise ValueError("Missing boundary in multipart/form-data content type")
+        return iter_multipart_images(chunks, options[b"boundary"])
+    raise ValueError(
+        f"Expected an {NDJSON_MEDIA_TYPE} or multipart/form-data request body, got {content_type!r}"
+    )
+
+
+def prediction_line(index: Optional[int], image_id: Optional[str], result: Dict) -> bytes:
+    """Serialize one result as an NDJSON line, led by the image's position and id."""
+    line: Dict[str, Any] = {"index": index}
+    if image_id is not None:
+        line["id"] = image_id
+    line.update(result)
+    return orjson.dumps(line) + b"\n"
+
+
+async def stream_predictions(
+    images: AsyncIterator[StreamImage],
+    classify: Callable[[StreamImage], Awaitable[Dict]],
+    max_in_flight: int = STREAM_MAX_IN_FLIGHT,
+) -> AsyncIterator[bytes]:
+    """Classify images as they are read and yield an NDJSON line for each, as soon as it is ready.
+
+    `classify` returns a prediction, or `{"error": ...}` for an image that couldn't be classified.
+    A slot is held from when an image is read until its line has been yielded, so a client that
+    stops reading the response also stops its upload. If the body itself can't be read, a final
+    line with an `error` and no `index` ends the stream.
+    """
+    lines: asyncio.Queue[Optional[bytes]] = asyncio.Queue()
+    slots = asyncio.Semaphore(max_in_flight)
+    tasks: Set[asyncio.Task] = set()
+
+    async def classify_one(index: int, image: StreamImage) -> None:
+        try:
+            result = await classify(image)
+        except Exception as e:
+            logger.error(f"Error classifying streamed image {index}: {e}")
+            result = {"error": str(e)}
+        await lines.put(prediction_line(index, image.id, result))
+
+    async def read_images() -> None:
+        index = 0
+        try:
+            async for image in images:
+                await slots.acquire()
+                if image.error is not None:
+                    await lines.put(prediction_line(index, image.id, {"error": image.error}))
+                else:
+                    task = asyncio.create_task(classify_one(index, image))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                index += 1
+            await asyncio.gather(*tasks)
+        except Exception as e:
+            logger.warning(f"Stopped reading the stream after {index} image(s): {e}")
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await lines.put(prediction_line(None, None, {"error": f"Could not read body: {e!r}"}))
+        await lines.put(None)
+
+    reader = asyncio.create_task(read_images())
+    try:
+        while True:
+            line = await lines.get()
+            if line is None:
+                return
+            yield line
+            slots.release()
+    finally:
+        reader.cancel()
+        for task in list(tasks):
+            task.cancel()
+
+
+class DuplexStreamingResponse(StreamingResponse):
+    """A StreamingResponse that is sent while the request body is still being read.
+
+    StreamingResponse watches for the client going away by reading from `receive`, which would
+    take request body chunks away from the handler. This one leaves `receive` to the request
+    body, which raises ClientDisconnect itself if the client goes away.
+    """
+
+    def __init__(self, content: AsyncIterator[bytes], **kwargs: Any):
+        kwargs.setdefault("media_type", NDJSON_MEDIA_TYPE)
+        super().__init__(content, **kwargs)
+
+    async def listen_for_disconnect(self, receive: Receive) -> None:
+        """Wait until the response has been sent, without touching `receive`."""
+        await anyio.sleep_forever()
@@ -0,0 +1,140 @@
+import os
+import tempfile
+import unittest
+import unittest.mock
+from types import SimpleNamespace
+from typing import Dict
+
+import torch
+from PIL import Image
+
+from backends import PYTORCH_WEIGHTS_FILENAME
+from backends import Backend
+from backends import ImageResizer
+from backends import OnnxBackend
+from backends import UnsupportedModel
+from backends import convert_to_safetensors
+
+BILINEAR = Image.Resampling.BILINEAR
+
+
+class TestImageResizer(unittest.TestCase):
+    def test_fixed_size(self) -> None:
+        """ViT-style processors resize straight to their width and height."""
+        processor = SimpleNamespace(size={"width": 224, "height": 224}, resample=BILINEAR)
+        resizer = ImageResizer.from_processor(processor)
+
+        self.assertEqual(resizer.input_size, (224, 224))
+        self.assertEqual(resizer(Image.new("RGB", (640, 480))).size, (224, 224))
+
+    def test_shortest_edge_with_crop_size(self) -> None:
+        """CLIP-style processors scale the shortest edge, then center crop to `crop_size`."""
+        processor = SimpleNamespace(
+            size={"shortest_edge": 256},
+            crop_size={"width": 224, "height": 224},
+            do_center_crop=True,
+            resample=BILINEAR,
+        )
+        resizer = ImageResizer.from_processor(processor)
+
+        self.assertEqual(resizer, ImageResizer(None, 256, (224, 224), BILINEAR))
+        self.assertEqual(resizer.decode_size, 256)
+        image = Image.new("RGB", (512, 256), "blue")
+        image.paste("red", (0, 0, 128, 256))
+        resized = resizer(image)
+        self.assertEqual(resized.size, (224, 224))
+        # The crop keeps the middle, so the red left quarter is cut off
+        self.assertEqual(resized.getpixel((0, 112)), (0, 0, 255))
+
+    def test_shortest_edge_with_crop_pct(self) -> None:
+        """ConvNeXt-style processors crop to the shortest edge after scaling it by 1 / crop_pct."""
+        processor = SimpleNamespace(size={"shortest_edge": 224}, crop_pct=0.875, resample=BILINEAR)
+        resizer = ImageResizer.from_processor(processor)
+
+        self.assertEqual(resizer, ImageResizer(None, 256, (224, 224), BILINEAR))
+        self.assertEqual(resizer(Image.new("RGB", (300, 600))).size, (224, 224))
+
+        processor.size = {"shortest_edge": 384}
+        self.assertEqual(ImageResizer.from_processor(processor).decode_size, 384)
+        self.assertEqual(
+            ImageResizer.from_processor(processor),
+            ImageResizer((384, 384), None, (384, 384), BILINEAR),
+        )
+
+    def test_variable_output_size_is_unsupported(self) -> None:
+        """A shortest edge without a crop gives every image its own size, which can't be batched."""
+        processor = SimpleNamespace(size={"shortest_edge": 224}, resample=BILINEAR)
+        with self.assertRaises(UnsupportedModel):
+            ImageResizer.from_processor(processor)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
+
+
+class TestPredict(unittest.TestCase):
+    def test_top_k(self) -> None:
+        """Items asking for top_k > 1 get their labels sorted by score, alongside the top-1."""
+        backend = Backend.__new__(Backend)
+        backend.labels = ["bibimbap", "french_toast", "waffles", "pancakes"]
+        backend.resizer = ImageResizer((8, 8), None, (8, 8), BILINEAR)
+        backend.logits = lambda pixels: torch.tensor(  # type: ignore
+            [[0.0, 3.0, 2.0, 1.0], [4.0, 0.0, 0.0, 1.0]]
+        )
+        image = Image.new("RGB", (16, 16))
+        timings: Dict[str, float] = {}
+
+        first, second = backend.predict([(image, 3), (image, 1)], timings)
+
+        self.assertEqual(set(first), {"label", "score", "top_k"})
+        self.assertEqual(first["label"], "french_toast")
+        self.assertEqual(
+            [entry["label"] for entry in first["top_k"]], ["french_toast", "waffles", "pancakes"]
+        )
+        scores = [entry["score"] for entry in first["top_k"]]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertEqual(first["score"], scores[0])
+        self.assertEqual(set(second), {"label", "score"})
+        self.assertEqual(second["label"], "bibimbap")
+        self.assertEqual(set(timings), {"preprocess", "forward", "postprocess"})
+
+
+class TestConvertToSafetensors(unittest.TestCase):
+    def test_read_only_model_directory(self) -> None:
+        """A model directory that can't be written to is left alone and signalled with None."""
+        with tempfile.TemporaryDirectory() as model_path:
+            torch.save(
+                {"weight": torch.ones(2)}, os.path.join(model_path, PYTORCH_WEIGHTS_FILENAME)
+            )
+            read_only = OSError(30, "Read-only file system")
+            with unittest.mock.patch("safetensors.torch.save_file", side_effect=read_only):
+                self.assertIsNone(convert_to_safetensors(model_path))
+            self.assertEqual(os.listdir(model_path), [PYTORCH_WEIGHTS_FILENAME])
+
+            safetensors_path = convert_to_safetensors(model_path)
+            self.assertIsNotNone(safetensors_path)
+            self.assertTrue(os.path.exists(safetensors_path))
+
+
+class TestOnnxExport(unittest.TestCase):
+    def test_read_only_model_directory(self) -> None:
+        """A graph that can't be exported next to the checkpoint goes to the cache directory."""
+        backend = OnnxBackend.__new__(OnnxBackend)
+        backend.model_path = "/models/org/name"
+        backend.image_size = (224, 224)
+        exported = []
+
+        def export_onnx(model: None, onnx_path: str, image_size: tuple) -> None:
+            if onnx_path.startswith(backend.model_path):
+                raise OSError(30, "Read-only file system")
+            exported.append(onnx_path)
+
+        with tempfile.TemporaryDirectory() as cache_dir, unittest.mock.patch.multiple(
+            "backends",
+            ONNX_CACHE_DIR=cache_dir,
+            load_pretrained=unittest.mock.Mock(),
+            export_onnx=export_onnx,
+        ):
+            self.assertIsNone(backend.load_model())
+            cache_path = os.path.join(cache_dir, "models--org--name", "model.onnx")
+            self.assertEqual((backend.onnx_path, exported), (cache_path, [cache_path]))
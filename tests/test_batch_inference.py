@@ -0,0 +1,116 @@
+import io
+import multiprocessing
+import os
+import tempfile
+import unittest
+import unittest.mock
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+import pyarrow.parquet as pq
+from datasets import ClassLabel
+from datasets import Dataset
+from datasets import Features
+from datasets import Image as ImageFeature
+from datasets import Value
+from PIL import Image
+
+import batch_inference
+from backends import ImageResizer
+
+COLORS = ["red", "green", "blue"]
+
+
+class ColorBackend:
+    """Stands in for the model, labelling each image by its dominant color channel."""
+
+    name = "color"
+    device = "cpu"
+    image_size = (8, 8)
+    resizer = ImageResizer((8, 8), None, (8, 8), Image.Resampling.BILINEAR)
+
+    def __init__(self) -> None:
+        self.batches: List[int] = []
+
+    def predict(self, items: List[Tuple[Image.Image, int]]) -> List[Dict[str, Any]]:
+        self.batches.append(len(items))
+        predictions = []
+        for image, _ in items:
+            channels = image.getpixel((0, 0))
+            predictions.append({"label": COLORS[channels.index(max(channels))], "score": 1.0})
+        return predictions
+
+
+def write_shard(path: str, colors: List[str]) -> None:
+    """Write a food101-style parquet shard with one solid-color JPEG per label."""
+    images = []
+    for color in colors:
+        output = io.BytesIO()
+        Image.new("RGB", (32, 32), color).save(output, format="JPEG")
+        images.append({"bytes": output.getvalue(), "path": None})
+    images[-1] = {"bytes": b"corrupt", "path": None}
+    features = Features(
+        {"image": ImageFeature(), "label": ClassLabel(names=COLORS), "note": Value("string")}
+    )
+    dataset = Dataset.from_dict(
+        {
+            "image": images,
+            "label": [COLORS.index(color) for color in colors],
+            "note": [""] * len(colors),
+        },
+        features=features,
+    )
+    dataset.to_parquet(path)
+
+
+class TestBatchInference(unittest.TestCase):
+    def setUp(self) -> None:
+        """Create a shard of 7 images, the last of them undecodable, and a decode pool."""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.shard = os.path.join(self.tmp.name, "validation-00000-of-00001.parquet")
+        write_shard(self.shard, ["red", "green", "blue", "red", "green", "blue", "red"])
+        self.output_dir = os.path.join(self.tmp.name, "predictions")
+        os.makedirs(self.output_dir)
+        self.pool = ProcessPoolExecutor(2, mp_context=multiprocessing.get_context("fork"))
+
+    def tearDown(self) -> None:
+        """Stop the pool and remove the files."""
+        self.pool.shutdown()
+        self.tmp.cleanup()
+
+    def test_shard_predictions_and_stats(self) -> None:
+        """Every row gets a prediction or an error, in order, and accuracy skips the errors."""
+        backend = ColorBackend()
+        stats = batch_inference.run_shard(
+            self.shard, backend, self.pool, self.output_dir, batch_size=3, prefetch=2, top_k=1
+        )
+
+        predictions_path, stats_path = batch_inference.output_paths(self.output_dir, self.shard)
+        table = pq.read_table(predictions_path).to_pydict()
+        self.assertEqual(table["row"], list(range(7)))
+        self.assertEqual(table["predicted_label"], table["label"][:6] + [None])
+        self.assertEqual(table["top_k_labels"][0], ["red"])
+        self.assertIsNotNone(table["error"][6])
+        self.assertEqual(backend.batches, [3, 3])
+        self.assertEqual((stats["images"], stats["errors"], stats["accuracy"]), (7, 1, 1.0))
+        self.assertEqual(pq.read_table(stats_path).to_pylist(), [stats])
+
+    def test_finished_shards_are_skipped(self) -> None:
+        """A rerun only rebuilds the summary for shards that already have stats."""
+        batch_inference.run_shard(self.shard, ColorBackend(), self.pool, self.output_dir, 3, 2, 1)
+
+        with unittest.mock.patch("batch_inference.create_backend") as create_backend:
+            batch_inference.main(
+                self.shard, self.output_dir, "model", "color", "cpu", 3, 1, 1, 1, False
+            )
+
+        create_backend.assert_not_called()
+        summary = pq.read_table(os.path.join(self.output_dir, "summary.parquet")).to_pylist()
+        self.assertEqual([row["shard"] for row in summary], [os.path.basename(self.shard)])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,155 @@
+import asyncio
+import threading
+import time
+import unittest
+from typing import List
+
+from batching import BatchResults
+from batching import BatchScheduler
+from batching import DeadlineExceeded
+from batching import split_into_chunks
+
+
+class TestBatchScheduler(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        """Start a scheduler around a fake model that records each batch it sees."""
+        self.batches: List[List[int]] = []
+
+        def run_batch(images: List[int]) -> List[int]:
+            self.batches.append(images)
+            return [image * 10 for image in images]
+
+        self.scheduler = BatchScheduler(run_batch, max_batch_size=4, max_wait_ms=20)
+        self.scheduler.start()
+
+    async def asyncTearDown(self) -> None:
+        """Stop the scheduler."""
+        await self.scheduler.stop()
+
+    async def test_concurrent_requests_share_a_batch(self) -> None:
+        """Images submitted concurrently are run in one forward pass and fanned back out."""
+        results = await asyncio.gather(
+            self.scheduler.submit([1]), self.scheduler.submit([2]), self.scheduler.submit([3])
+        )
+
+        self.assertEqual(results, [[10], [20], [30]])
+        self.assertEqual(self.batches, [[1, 2, 3]])
+
+    async def test_batches_are_capped_at_max_batch_size(self) -> None:
+        """A request larger than the max batch size is split across batches, in order."""
+        results = await self.scheduler.submit(list(range(10)))
+
+        self.assertEqual(results, [image * 10 for image in range(10)])
+        self.assertEqual([len(batch) for batch in self.batches], [4, 4, 2])
+        self.assertEqual(self.scheduler.stats()["images_processed"], 10)
+
+    async def test_stage_timings_reach_the_caller(self) -> None:
+        """Queue wait and the stage timings a batch reports are added to the caller's timings."""
+        self.scheduler.run_batch = lambda images: BatchResults(images, {"forward": 0.5})
+        timings = {"forward": 0.25}
+        results = await self.scheduler.submit([1, 2], timings)
+
+        self.assertEqual(results, [1, 2])
+        self.assertEqual(timings["forward"], 0.75)
+        self.assertGreaterEqual(timings["queue_wait"], 0.015)
+
+    async def test_batch_errors_reach_every_caller(self) -> None:
+        """A failing forward pass fails every request in that batch."""
+
+        def failing_batch(images: List[int]) -> List[int]:
+            raise ValueError("boom")
+
+        self.scheduler.run_batch = failing_batch
+        with self.assertRaises(ValueError):
+            await self.scheduler.submit([1, 2])
+
+
+class TestBatchOrdering(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        """Start a one-image-per-batch scheduler whose first batch blocks until released."""
+        self.batches: List[List[int]] = []
+        self.release = threading.Event()
+
+        def run_batch(images: List[int]) -> List[int]:
+            self.release.wait(timeout=5)
+            self.batches.append(images)
+            return images
+
+        self.scheduler = BatchScheduler(run_batch, max_batch_size=1, max_wait_ms=0)
+        self.scheduler.start()
+        self.blocker = asyncio.create_task(self.scheduler.submit([0]))
+        while not self.scheduler.in_flight:
+            await asyncio.sleep(0.001)
+
+    async def asyncTearDown(self) -> None:
+        """Stop the scheduler."""
+        self.release.set()
+        await self.scheduler.stop()
+
+    async def test_stopping_fails_batches_in_flight(self) -> None:
+        """Callers waiting on a batch that is running when the scheduler stops get an error."""
+        await self.scheduler.stop()
+
+        with self.assertRaisesRegex(RuntimeError, "stopped"):
+            await asyncio.wait_for(self.blocker, 1)
+
+    async def test_queue_is_ordered_by_priority_then_deadline(self) -> None:
+        """Queued images run most urgent class first, then earliest deadline, then arrival."""
+        now = time.time()
+        submissions = [
+            self.scheduler.submit([1], priority=2),
+            self.scheduler.submit([2], priority=1, deadline=now + 20),
+            self.scheduler.submit([3], priority=1, deadline=now + 10),
+            self.scheduler.submit([4], priority=0),
+            self.scheduler.submit([5], priority=1),
+        ]
+        tasks = [asyncio.create_task(submission) for submission in submissions]
+        await asyncio.sleep(0.01)
+        self.release.set()
+        await asyncio.gather(self.blocker, *tasks)
+
+        self.assertEqual(self.batches, [[0], [4], [3], [2], [5], [1]])
+
+    async def test_expired_images_are_not_run(self) -> None:
+        """Images whose deadline passed while queued fail without reaching the model."""
+        expired = asyncio.create_task(self.scheduler.submit([1], deadline=time.time() + 0.01))
+        await asyncio.sleep(0.02)
+        self.release.set()
+
+        with self.assertRaises(DeadlineExceeded):
+            await expired
+        await self.blocker
+        self.assertEqual(self.batches, [[0]])
+        self.assertEqual(self.scheduler.stats()["images_expired"], 1)
+
+    async def test_cancelled_requests_are_not_run(self) -> None:
+        """Cancelling a caller, as on a client disconnect, drops its queued images."""
+        cancelled = asyncio.create_task(self.scheduler.submit([1, 2]))
+        kept = asyncio.create_task(self.scheduler.submit([3]))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        self.release.set()
+
+        self.assertEqual(await kept, [3])
+        self.assertEqual(self.batches, [[0], [3]])
+
+
+class TestSplitIntoChunks(unittest.TestCase):
+    def test_chunks_are_capped_by_count_and_bytes(self) -> None:
+        """Chunks close at the item limit or before going over the byte budget, in order."""
+        sizes = [10, 10, 10, 10, 10, 50, 60, 10]
+
+        chunks = split_into_chunks(sizes, max_items=3, max_bytes=60)
+
+        self.assertEqual(chunks, [[0, 1, 2], [3, 4], [5], [6], [7]])
+
+    def test_oversized_item_gets_its_own_chunk(self) -> None:
+        """An item over the byte budget is still classified, alone."""
+        self.assertEqual(
+            split_into_chunks([5, 500, 5], max_items=8, max_bytes=100), [[0], [1], [2]]
+        )
+        self.assertEqual(split_into_chunks([], max_items=8, max_bytes=100), [])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
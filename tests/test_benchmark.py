@@ -0,0 +1,78 @@
+import asyncio
+import time
+import unittest
+
+import uvicorn
+
+from benchmark import LoadGenerator
+from benchmark import Result
+from benchmark import percentile
+from benchmark import summarize
+from fake_inference import create_app
+
+
+class TestSummary(unittest.TestCase):
+    def test_percentiles_and_errors(self) -> None:
+        """Percentiles use successful requests only, and failures are counted by status."""
+        results = [Result(0.0, (i + 1) / 1000, 200, None) for i in range(100)]
+        results += [Result(0.0, 5.0, 503, None), Result(0.0, 5.0, None, "ConnectError")]
+
+        summary = summarize(results, duration=2.0, images_per_request=4)
+
+        self.assertEqual(summary["successes"], 100)
+        self.assertEqual(summary["errors"], {"503": 1, "ConnectError": 1})
+        self.assertEqual(summary["images_per_second"], 200.0)
+        self.assertEqual(
+            [summary["latency_ms"][q] for q in ("p50", "p95", "p99", "max")], [50, 95, 99, 100]
+        )
+        self.assertEqual(sum(bucket["count"] for bucket in summary["histogram"]), 100)
+        self.assertEqual(percentile([], 50), 0.0)
+
+
+class TestLoadGenerator(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        """Start a fake inference server that serves one request at a time in 10ms."""
+        self.fake = create_app(service_time_ms=10, concurrency=1)
+        self.server = uvicorn.Server(
+            uvicorn.Config(self.fake, host="127.0.0.1", port=0, lifespan="off", log_level="warning")
+        )
+        self.task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/classify/"
+
+    async def asyncTearDown(self) -> None:
+        """Stop the server."""
+        self.server.should_exit = True
+        await self.task
+
+    def generator(self) -> LoadGenerator:
+        """A load generator sending two images per request to the fake server."""
+        return LoadGenerator(self.url, b"image", 2, {}, timeout=5, max_connections=10)
+
+    async def test_closed_loop_queues_behind_the_server(self) -> None:
+        """Four clients against a server with one slot see about four service times of latency."""
+        generator = self.generator()
+        duration = await generator.run(concurrency=4, rate=None, warmup=0.1, duration=0.5)
+
+        summary = summarize(generator.results, duration, 2)
+        self.assertEqual(summary["successes"], summary["requests"])
+        self.assertLess(summary["requests_per_second"], 110)
+        self.assertGreater(summary["latency_ms"]["p50"], 25)
+        # Requests sent while warming up reach the server but aren't recorded
+        self.assertGreater(self.fake.state.requests, summary["requests"])
+
+    async def test_open_loop_latency_is_measured_from_the_due_time(self) -> None:
+        """Arrivals faster than the server can serve build a queue that shows up in the latency."""
+        generator = self.generator()
+        start_time = time.perf_counter()
+        await generator.run(concurrency=1, rate=200, warmup=0, duration=0.3)
+
+        due_times = [result.due_at for result in generator.results]
+        self.assertTrue(all(start_time <= due_at for due_at in due_times))
+        self.assertGreater(max(result.latency for result in generator.results), 0.2)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,96 @@
+import asyncio
+import unittest
+import unittest.mock
+
+from concurrency_limiter import AdaptiveConcurrencyLimiter
+from concurrency_limiter import LimitExceeded
+
+
+class TestAdaptiveConcurrencyLimiter(unittest.IsolatedAsyncioTestCase):
+    async def hold(self, limiter: AdaptiveConcurrencyLimiter, release: asyncio.Event) -> None:
+        """Hold a slot until `release` is set."""
+        async with limiter.acquire():
+            await release.wait()
+
+    async def test_requests_over_the_limit_queue_then_run(self) -> None:
+        """Requests beyond the limit wait for a slot and are admitted when one frees up."""
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=2, min_limit=1, queue_timeout=1.0)
+        release = asyncio.Event()
+        holders = [asyncio.create_task(self.hold(limiter, release)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        self.assertEqual((limiter.in_flight, len(limiter.waiters)), (2, 1))
+
+        release.set()
+        await asyncio.gather(*holders)
+        self.assertEqual((limiter.in_flight, len(limiter.waiters)), (0, 0))
+
+    async def test_full_queue_is_rejected_with_429(self) -> None:
+        """Once the wait queue is full, new requests fail immediately with a Retry-After."""
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, min_limit=1, max_queue=1)
+        release = asyncio.Event()
+        holders = [asyncio.create_task(self.hold(limiter, release)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+
+        with self.assertRaises(LimitExceeded) as context:
+            async with limiter.acquire():
+                pass
+        self.assertEqual(context.exception.status_code, 429)
+        self.assertGreaterEqual(context.exception.retry_after, 1)
+        release.set()
+        await asyncio.gather(*holders)
+
+    async def test_queue_timeout_is_rejected_with_503(self) -> None:
+        """A request that waits longer than the queue timeout gives up its place and fails."""
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, min_limit=1, queue_timeout=0.02)
+        release = asyncio.Event()
+        holder = asyncio.create_task(self.hold(limiter, release))
+        await asyncio.sleep(0.01)
+
+        with self.assertRaises(LimitExceeded) as context:
+            async with limiter.acquire():
+                pass
+        self.assertEqual(context.exception.status_code, 503)
+        self.assertEqual(len(limiter.waiters), 0)
+        release.set()
+        await holder
+
+    async def test_slot_handed_over_at_timeout_is_passed_on(self) -> None:
+        """A slot that arrives as the wait times out isn't leaked by the request giving up."""
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, min_limit=1, queue_timeout=1.0)
+        release = asyncio.Event()
+        holder = asyncio.create_task(self.hold(limiter, release))
+        await asyncio.sleep(0.01)
+
+        async def hand_over_then_time_out(waiter: asyncio.Future, timeout: float) -> None:
+            release.set()
+            while not waiter.done():
+                await asyncio.sleep(0)
+            raise asyncio.TimeoutError
+
+        with unittest.mock.patch("asyncio.wait_for", hand_over_then_time_out):
+            with self.assertRaises(LimitExceeded):
+                async with limiter.acquire():
+                    pass
+        await holder
+        self.assertEqual((limiter.in_flight, len(limiter.waiters)), (0, 0))
+
+    async def test_limit_adapts_to_latency_and_failures(self) -> None:
+        """The limit creeps up while requests are fast and backs off when they slow or fail."""
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=10, min_limit=1)
+        for _ in range(20):
+            limiter.in_flight = 10
+            limiter.release(0.01, dropped=False)
+        grown = limiter.limit
+        self.assertGreater(grown, 10)
+
+        limiter.in_flight = 1
+        limiter.release(0.01 * 10, dropped=False)
+        self.assertAlmostEqual(limiter.limit, grown * 0.9)
+        limiter.last_decrease_at = 0.0
+        limiter.in_flight = 1
+        limiter.release(0.001, dropped=True)
+        self.assertAlmostEqual(limiter.limit, grown * 0.9 * 0.9)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import cpu_planner
+from cpu_planner import cpu_quota
+from cpu_planner import format_cores
+from cpu_planner import plan_workers
+
+
+class TestCpuPlanner(unittest.TestCase):
+    def test_cores_are_split_evenly_between_workers(self) -> None:
+        """Each worker gets its own slice, with a quarter of it kept for decoding."""
+        plans = plan_workers(2, list(range(16)), decode_cores=None, intra_op_threads=0)
+
+        self.assertEqual([plan.cores for plan in plans], [tuple(range(8)), tuple(range(8, 16))])
+        self.assertEqual(plans[0].inference_cores, tuple(range(6)))
+        self.assertEqual(plans[0].decode_cores, (6, 7))
+        self.assertEqual(plans[1].intra_op_threads, 6)
+        self.assertTrue(all(plan.pinned for plan in plans))
+        self.assertIn("cores 8-15 (inference 8-13, decode 14-15)", plans[1].describe())
+
+    def test_uneven_splits_and_more_workers_than_cores(self) -> None:
+        """Leftover cores go to the later workers, and surplus workers share cores."""
+        plans = plan_workers(3, list(range(10)), decode_cores=0, intra_op_threads=0)
+        self.assertEqual([len(plan.cores) for plan in plans], [3, 3, 4])
+        self.assertEqual(plans[2].decode_cores, plans[2].cores)
+
+        plans = plan_workers(4, [0, 1], decode_cores=None, intra_op_threads=0)
+        self.assertEqual([plan.cores for plan in plans], [(0,), (0,), (1,), (1,)])
+        self.assertEqual(plans[0].intra_op_threads, 1)
+        self.assertEqual(plans[0].decode_cores, (0,))
+
+    def test_a_cpu_quota_limits_threads_without_pinning(self) -> None:
+        """A quota below the visible cores plans for the quota's cores and pins nothing."""
+        plans = plan_workers(2, list(range(32)), quota=4.5, decode_cores=0, intra_op_threads=0)
+
+        self.assertEqual([plan.intra_op_threads for plan in plans], [2, 2])
+        self.assertFalse(any(plan.pinned for plan in plans))
+        self.assertIn("2 core(s), not pinned", plans[0].describe())
+
+    def test_cpu_quota(self) -> None:
+        """The cgroup v2 cpu.max file is read as a number of cores, or None without a limit."""
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "cpu.max")
+            with open(path, "w") as f:
+                f.write("250000 100000\n")
+            self.assertEqual(cpu_quota(path), 2.5)
+            with open(path, "w") as f:
+                f.write("max 100000\n")
+            self.assertIsNone(cpu_quota(path))
+        self.assertIsNone(cpu_quota(os.path.join(tempdir, "missing")))
+
+    def test_planning_is_only_automatic_without_a_gpu(self) -> None:
+        """CPU_PLAN=auto plans on CPU-only nodes, and true or false override the device check."""
+        for setting, gpu, expected in [
+            ("auto", False, True),
+            ("auto", True, False),
+            ("true", True, True),
+            ("false", False, False),
+        ]:
+            with unittest.mock.patch("cpu_planner.CPU_PLAN", setting), unittest.mock.patch(
+                "torch.cuda.is_available", return_value=gpu
+            ):
+                self.assertEqual(cpu_planner.enabled(), expected, msg=(setting, gpu))
+
+    def test_format_cores(self) -> None:
+        """Consecutive cores are collapsed into ranges."""
+        self.assertEqual(format_cores([3, 0, 1, 2, 8, 10, 11]), "0-3,8,10-11")
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
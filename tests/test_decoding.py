@@ -0,0 +1,57 @@
+import io
+import unittest
+
+from PIL import Image
+
+from decoding import decode_image
+from decoding import decoded_bytes
+from decoding import downscale_image
+
+
+def encode(image: Image.Image, format: str = "JPEG") -> bytes:
+    """Serialize an image to bytes."""
+    output = io.BytesIO()
+    image.save(output, format=format, quality=95)
+    return output.getvalue()
+
+
+class TestDecodedBytes(unittest.TestCase):
+    def test_estimate_matches_the_draft_decoded_image(self) -> None:
+        """The estimate is the size of what decode_image returns, without decoding any pixels."""
+        contents = encode(Image.new("RGB", (3000, 2000), "orange"))
+
+        image = decode_image(contents, 224)
+        self.assertEqual(decoded_bytes(contents, 224), image.width * image.height * 3)
+        self.assertLess(decoded_bytes(contents, 224), 3000 * 2000 * 3)
+
+    def test_undecodable_upload_needs_no_memory(self) -> None:
+        """Uploads that will be rejected don't count against the memory budget."""
+        self.assertEqual(decoded_bytes(b"not an image"), 0)
+
+
+class TestDownscaleImage(unittest.TestCase):
+    def test_large_image_is_shrunk_to_the_max_side(self) -> None:
+        """A large photo comes back as a smaller JPEG, keeping its aspect ratio."""
+        gradient = Image.linear_gradient("L").resize((3000, 2000)).convert("RGB")
+        contents = encode(gradient)
+
+        downscaled, resized, cpu_time = downscale_image(contents, max_side=448, quality=90)
+
+        self.assertTrue(resized)
+        self.assertLess(len(downscaled), len(contents))
+        self.assertEqual(Image.open(io.BytesIO(downscaled)).size, (448, 299))
+        self.assertGreater(cpu_time, 0)
+
+    def test_small_jpeg_is_passed_through(self) -> None:
+        """An image already within the limit is forwarded byte for byte."""
+        contents = encode(Image.new("RGB", (300, 200), "orange"))
+
+        self.assertEqual(downscale_image(contents, 448, 90)[:2], (contents, False))
+
+    def test_undecodable_upload_is_passed_through(self) -> None:
+        """Bytes that aren't an image are left for the inference server to reject."""
+        self.assertEqual(downscale_image(b"not an image", 448, 90)[:2], (b"not an image", False))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -6,6 +6,9 @@ import unittest
 
 import requests
 
+READY_TIMEOUT = 120
+WORKERS = 2
+
 
 class TestGunicornCUDAInference(unittest.TestCase):
     server_process: subprocess.Popen | None = None
@@ -25,18 +28,43 @@ class TestGunicornCUDAInference(unittest.TestCase):
         cls.server_process = subprocess.Popen(
             [
                 "gunicorn",
+                "--config",
+                "gunicorn_inference.conf.py",
                 "inference:app",
                 "--worker-class",
                 "uvicorn.workers.UvicornWorker",
                 "--workers",
-                "2",
+                str(WORKERS),
                 "--bind",
                 "0.0.0.0:8000",
             ],
             env=env,
             cwd="/workspace",  # Set the working directory to /workspace
         )
-        time.sleep(10)  # Wait for the server to start and load the model
+        cls.wait_until_ready()
+
+    @classmethod
+    def wait_until_ready(cls) -> None:
+        """Poll the readiness probe until every worker has loaded and warmed up the model.
+
+        Each probe lands on any one worker, so this waits until every worker's PID has answered
+        ready at least once.
+        """
+        deadline = time.monotonic() + READY_TIMEOUT
+        ready_workers = set()
+        while time.monotonic() < deadline:
+            if cls.server_process and cls.server_process.poll() is not None:
+                raise RuntimeError("Server exited before it became ready")
+            try:
+                response = requests.get("http://0.0.0.0:8000/readyz", timeout=1)
+                if response.status_code == 200:
+                    ready_workers.add(response.json()["worker"])
+            except requests.RequestException:
+                pass
+            if len(ready_workers) == WORKERS:
+                return
+            time.sleep(0.2)
+        raise RuntimeError(f"Server was not ready after {READY_TIMEOUT}s")
 
     @classmethod
     def tearDownClass(cls) -> None:
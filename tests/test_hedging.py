@@ -0,0 +1,121 @@
+import asyncio
+import time
+import unittest
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import httpx
+
+from hedging import Hedger
+from hedging import RetryBudget
+from tracing import DEADLINE_DROPPED_HEADER
+
+
+class TestRetryBudget(unittest.TestCase):
+    def test_budget_is_a_fraction_of_requests(self) -> None:
+        """Retries are allowed in proportion to deposits, and not beyond."""
+        budget = RetryBudget(ratio=0.5, min_per_second=0.0, max_tokens=10)
+        budget.tokens = 0
+        for _ in range(4):
+            budget.deposit()
+
+        self.assertEqual([budget.withdraw() for _ in range(3)], [True, True, False])
+
+
+class TestHedger(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        """Two fake endpoints whose latency and response status each test sets."""
+        self.latency: Dict[str, float] = {"a": 0.0, "b": 0.0}
+        self.outcome: Dict[str, object] = {"a": 200, "b": 200}
+        self.cancelled: List[str] = []
+
+    async def send(self, endpoint: str) -> httpx.Response:
+        """Answer after the endpoint's latency, with its status or exception."""
+        try:
+            await asyncio.sleep(self.latency[endpoint])
+        except asyncio.CancelledError:
+            self.cancelled.append(endpoint)
+            raise
+        outcome = self.outcome[endpoint]
+        if isinstance(outcome, Exception):
+            raise outcome
+        if isinstance(outcome, httpx.Response):
+            return outcome
+        return httpx.Response(outcome, json={"endpoint": endpoint})
+
+    def alternative(self, tried: List[str]) -> Optional[str]:
+        """Whichever endpoint hasn't been tried yet."""
+        remaining = [endpoint for endpoint in ("a", "b") if endpoint not in tried]
+        return remaining[0] if remaining else None
+
+    async def test_slow_request_is_hedged_and_the_loser_cancelled(self) -> None:
+        """After the hedge delay a second endpoint is tried and the first answer wins."""
+        hedger = Hedger(hedge=True, min_delay=0.01, min_samples=1)
+        hedger.latencies.observe(0.01)
+        self.latency["a"] = 1.0
+
+        endpoint, response = await hedger.send("a", self.send, self.alternative)
+
+        self.assertEqual((endpoint, response.status_code), ("b", 200))
+        self.assertEqual(self.cancelled, ["a"])
+        self.assertEqual((hedger.counts["hedges"], hedger.counts["hedge_wins"]), (1, 1))
+
+    async def test_connection_error_is_retried_on_another_endpoint(self) -> None:
+        """A failed connection is retried elsewhere while the budget allows."""
+        hedger = Hedger(max_retries=1)
+        self.outcome["a"] = httpx.ConnectError("refused")
+
+        endpoint, response = await hedger.send("a", self.send, self.alternative)
+
+        self.assertEqual((endpoint, response.status_code), ("b", 200))
+        self.assertEqual(hedger.counts["retries"], 1)
+
+    async def test_exhausted_budget_stops_retries(self) -> None:
+        """With no tokens left the original failure is returned without a retry."""
+        hedger = Hedger(max_retries=1, budget=RetryBudget(min_per_second=0.0))
+        hedger.budget.tokens = 0
+        self.outcome["a"] = 503
+
+        endpoint, response = await hedger.send("a", self.send, self.alternative)
+
+        self.assertEqual((endpoint, response.status_code), ("a", 503))
+        self.assertEqual(hedger.counts["budget_exhausted"], 1)
+
+    async def test_other_errors_are_not_retried(self) -> None:
+        """Only connection errors and 502, 503 and 504 are worth another attempt."""
+        hedger = Hedger(max_retries=1)
+        self.outcome["a"] = 500
+
+        endpoint, response = await hedger.send("a", self.send, self.alternative)
+
+        self.assertEqual((endpoint, response.status_code), ("a", 500))
+        self.assertEqual(hedger.counts["retries"], 0)
+
+    async def test_deadline_drops_are_not_retried(self) -> None:
+        """A 504 marked as a deadline drop is returned as is, since a retry would be late too."""
+        hedger = Hedger(max_retries=1)
+        self.outcome["a"] = httpx.Response(504, headers={DEADLINE_DROPPED_HEADER: "true"})
+
+        endpoint, response = await hedger.send("a", self.send, self.alternative)
+
+        self.assertEqual((endpoint, response.status_code), ("a", 504))
+        self.assertEqual(hedger.counts["retries"], 0)
+
+    async def test_nothing_is_retried_or_hedged_after_the_deadline(self) -> None:
+        """Once the request's deadline has passed, its failure or slow attempt is left alone."""
+        hedger = Hedger(hedge=True, min_delay=0.01, min_samples=1, max_retries=1)
+        hedger.latencies.observe(0.01)
+        self.latency["a"] = 0.05
+        self.outcome["a"] = 503
+
+        endpoint, response = await hedger.send(
+            "a", self.send, self.alternative, deadline=time.time() - 1
+        )
+
+        self.assertEqual((endpoint, response.status_code), ("a", 503))
+        self.assertEqual((hedger.counts["hedges"], hedger.counts["retries"]), (0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,108 @@
+import asyncio
+import unittest
+from typing import List
+
+import uvicorn
+from fastapi import FastAPI
+
+from fake_inference import create_app
+from metrics import MetricsAggregator
+from upstreams import LoadBalancer
+from upstreams import NoHealthyUpstream
+from upstreams import UpstreamPools
+
+FILES = [("files", ("image.jpg", b"not really a jpeg", "image/jpeg"))]
+
+
+class TestLoadBalancer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        """Start two fake inference servers on free ports."""
+        self.servers: List[uvicorn.Server] = []
+        self.tasks: List[asyncio.Task] = []
+        self.fakes = [create_app(service_time_ms=5), create_app(service_time_ms=5)]
+        self.endpoints = [await self.serve(fake) for fake in self.fakes]
+        self.pools = UpstreamPools()
+
+    async def asyncTearDown(self) -> None:
+        """Close the pools and stop the servers."""
+        await self.pools.aclose()
+        for server in self.servers:
+            server.should_exit = True
+        await asyncio.gather(*self.tasks)
+
+    async def serve(self, app: FastAPI) -> str:
+        """Run `app` on a free port and return its classify URL."""
+        server = uvicorn.Server(
+            uvicorn.Config(app, host="127.0.0.1", port=0, lifespan="off", log_level="warning")
+        )
+        self.servers.append(server)
+        self.tasks.append(asyncio.create_task(server.serve()))
+        while not server.started:
+            await asyncio.sleep(0.01)
+        port = server.servers[0].sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/classify/"
+
+    async def classify(self, load_balancer: LoadBalancer) -> None:
+        """Forward one request to whichever endpoint the load balancer picks."""
+        endpoint = load_balancer.pick()
+        response = await self.pools.get(endpoint).post(endpoint, files=FILES)
+        response.raise_for_status()
+
+    async def test_least_outstanding_spreads_concurrent_requests(self) -> None:
+        """Concurrent requests are split evenly between equally fast endpoints."""
+        load_balancer = LoadBalancer(self.endpoints, self.pools, policy="least_outstanding")
+        await asyncio.gather(*(self.classify(load_balancer) for _ in range(20)))
+
+        self.assertEqual([fake.state.requests for fake in self.fakes], [10, 10])
+
+    async def test_peak_ewma_prefers_the_faster_endpoint(self) -> None:
+        """Requests go to the endpoint with the lower latency once both have been tried."""
+        self.fakes[1].state.service_time_ms = 200
+        load_balancer = LoadBalancer(self.endpoints, self.pools, policy="peak_ewma")
+        # Connect to both first, so the slower first response isn't taken as the peak latency
+        for endpoint in self.endpoints:
+            pool = self.pools.get(endpoint)
+            await pool.post(endpoint, files=FILES)
+            pool.ewma_latency = 0.0
+        for fake in self.fakes:
+            fake.state.requests = 0
+        for _ in range(10):
+            await self.classify(load_balancer)
+
+        fast, slow = (fake.state.requests for fake in self.fakes)
+        self.assertGreater(fast, 4 * slow)
+
+    async def test_failing_endpoint_is_ejected_and_readmitted(self) -> None:
+        """An endpoint failing its readiness checks gets no traffic until it passes them again."""
+        aggregator = MetricsAggregator()
+        load_balancer = LoadBalancer(self.endpoints, self.pools, metrics_aggregator=aggregator)
+        self.fakes[1].state.ready = False
+        await load_balancer.check_all()
+        self.assertEqual(len(load_balancer.available()), 2)
+        await load_balancer.check_all()
+        self.assertEqual(load_balancer.available(), [self.endpoints[0]])
+        self.assertEqual({load_balancer.pick() for _ in range(10)}, {self.endpoints[0]})
+        self.assertEqual(
+            aggregator.counters[("proxy.upstream.ejections", ("upstream:127.0.0.1",))], 1
+        )
+        self.assertTrue(self.pools.get(self.endpoints[1]).stats()["ejected"])
+
+        self.fakes[1].state.ready = True
+        await load_balancer.check_all()
+        await load_balancer.check_all()
+        self.assertEqual(len(load_balancer.available()), 2)
+
+    async def test_no_healthy_endpoint(self) -> None:
+        """Picking fails once every endpoint has been ejected."""
+        load_balancer = LoadBalancer(self.endpoints, self.pools)
+        for fake in self.fakes:
+            fake.state.ready = False
+        for _ in range(2):
+            await load_balancer.check_all()
+
+        with self.assertRaises(NoHealthyUpstream):
+            load_balancer.pick()
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
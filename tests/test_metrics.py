@@ -0,0 +1,163 @@
+import asyncio
+import unittest
+import unittest.mock
+
+from metrics import MetricsAggregator
+from metrics import StageTimer
+from metrics import StubSink
+from metrics import count_buckets
+
+
+class TestMetricsAggregator(unittest.IsolatedAsyncioTestCase):
+    async def test_flush_sends_one_batch_of_deltas(self) -> None:
+        """Counters are summed in memory and each flush sends only what changed since the last."""
+        aggregator = MetricsAggregator()
+        sink = StubSink()
+        aggregator.sink = sink
+
+        for _ in range(5):
+            aggregator.increment("requests", tags=["env:test"])
+        aggregator.gauge("queue_depth", 3)
+        await aggregator.flush()
+        aggregator.increment("requests", 2, tags=["env:test"])
+        await aggregator.flush()
+
+        self.assertEqual(len(sink.batches), 2)
+        first = {sample.name: sample for sample in sink.batches[0]}
+        self.assertEqual(first["requests"].value, 5)
+        self.assertEqual(first["requests"].tags, ("env:test",))
+        self.assertEqual(first["queue_depth"].value, 3)
+        second = {sample.name: sample.value for sample in sink.batches[1]}
+        self.assertEqual(second["requests"], 2)
+
+    async def test_histogram_summary(self) -> None:
+        """Histograms are flushed as count, average, max and percentile series."""
+        aggregator = MetricsAggregator()
+        sink = StubSink()
+        aggregator.sink = sink
+
+        for value in [0.002] * 98 + [0.2, 0.4]:
+            aggregator.observe("latency", value)
+        await aggregator.flush()
+
+        samples = {sample.name: sample.value for sample in sink.batches[0]}
+        self.assertEqual(samples["latency.count"], 100)
+        self.assertEqual(samples["latency.p50"], 0.0025)
+        self.assertEqual(samples["latency.p99"], 0.25)
+        self.assertEqual(samples["latency.max"], 0.4)
+
+    async def test_count_histogram_buckets(self) -> None:
+        """Count-valued series get power-of-two buckets instead of the latency ones."""
+        aggregator = MetricsAggregator()
+        sink = StubSink()
+        aggregator.sink = sink
+
+        self.assertEqual(count_buckets(32), (1, 2, 4, 8, 16, 32))
+        for value in [3] * 50 + [12] * 49 + [32]:
+            aggregator.observe("batch_size", value, buckets=count_buckets(32))
+        await aggregator.flush()
+
+        samples = {sample.name: sample.value for sample in sink.batches[0]}
+        self.assertEqual(samples["batch_size.p50"], 4)
+        self.assertEqual(samples["batch_size.p99"], 16)
+        self.assertEqual(samples["batch_size.max"], 32)
+
+    async def test_series_over_the_cap_are_dropped_and_counted(self) -> None:
+        """Updates to new series beyond the cap are dropped, and the drops are reported."""
+        aggregator = MetricsAggregator(max_series=2)
+        sink = StubSink()
+        aggregator.sink = sink
+
+        for i in range(5):
+            aggregator.increment(f"series_{i}")
+        await aggregator.flush()
+
+        samples = {sample.name: sample.value for sample in sink.batches[0]}
+        self.assertIn("series_0", samples)
+        self.assertNotIn("series_4", samples)
+        self.assertEqual(samples["metrics.dropped_updates"], 3)
+
+    async def test_failed_batches_are_retried_then_dropped(self) -> None:
+        """Batches the sink rejects are kept for the next flush, up to a bounded backlog."""
+        aggregator = MetricsAggregator(max_pending_batches=2)
+        sink = StubSink()
+        sink.send = unittest.mock.Mock(side_effect=ConnectionError("offline"))  # type: ignore
+        aggregator.sink = sink
+
+        for _ in range(4):
+            aggregator.increment("requests")
+            await aggregator.flush()
+        self.assertEqual(aggregator.stats()["pending_batches"], 2)
+        self.assertEqual(aggregator.stats()["dropped_samples"], 2)
+
+    async def test_retried_batches_keep_their_timestamp(self) -> None:
+        """A batch sent on a later flush is stamped with the time it was collected, not resent."""
+        aggregator = MetricsAggregator()
+        sink = StubSink()
+        outcomes = [ConnectionError("offline"), None, None]
+        sink.send = unittest.mock.Mock(side_effect=outcomes)  # type: ignore
+        aggregator.sink = sink
+
+        with unittest.mock.patch("time.time", return_value=1000):
+            aggregator.increment("requests")
+            await aggregator.flush()
+        with unittest.mock.patch("time.time", return_value=1010):
+            aggregator.increment("requests")
+            await aggregator.flush()
+
+        timestamps = [call.args[1] for call in sink.send.call_args_list]
+        self.assertEqual(timestamps, [1000, 1000, 1010])
+
+    async def test_background_flush(self) -> None:
+        """The background task flushes on its interval and once more on stop."""
+        aggregator = MetricsAggregator()
+        sink = StubSink()
+        aggregator.start(sink, interval=0.01)
+        aggregator.increment("requests")
+        await asyncio.sleep(0.05)
+        aggregator.increment("requests")
+        await aggregator.stop()
+
+        total = sum(sample.value for batch in sink.batches for sample in batch)
+        self.assertEqual(total, 2)
+
+
+class TestPrometheus(unittest.TestCase):
+    def test_render_prometheus(self) -> None:
+        """Series render cumulatively, with tags as labels and cumulative histogram buckets."""
+        aggregator = MetricsAggregator()
+        aggregator.increment("inference.errors", 2, ["service:inference"])
+        aggregator.gauge("inference.queue_depth", 3)
+        for value in (0.002, 0.002, 0.2):
+            aggregator.observe("inference.stage_duration", value, ["stage:decode"])
+        aggregator.collect()
+
+        lines = aggregator.render_prometheus().splitlines()
+        self.assertIn("# TYPE inference_errors_total counter", lines)
+        self.assertIn('inference_errors_total{service="inference"} 2', lines)
+        self.assertIn("inference_queue_depth 3", lines)
+        self.assertIn("# TYPE inference_stage_duration histogram", lines)
+        self.assertIn('inference_stage_duration_bucket{stage="decode",le="0.0025"} 2', lines)
+        self.assertIn('inference_stage_duration_bucket{stage="decode",le="0.25"} 3', lines)
+        self.assertIn('inference_stage_duration_bucket{stage="decode",le="+Inf"} 3', lines)
+        self.assertIn('inference_stage_duration_count{stage="decode"} 3', lines)
+
+    def test_stage_timer(self) -> None:
+        """Stages add up, are observed with a stage tag and render as a Server-Timing header."""
+        aggregator = MetricsAggregator()
+        timer = StageTimer()
+        timer.add("decode", 0.001)
+        timer.add("decode", 0.002)
+        with timer.stage("forward"):
+            pass
+        timer.record(aggregator, "stage_duration", ["service:test"])
+
+        self.assertEqual(set(timer.durations), {"decode", "forward"})
+        self.assertTrue(timer.server_timing().startswith("decode;dur=3.00, forward;dur="))
+        self.assertEqual(
+            aggregator.histograms[("stage_duration", ("service:test", "stage:decode"))].count, 1
+        )
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
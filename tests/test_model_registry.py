@@ -0,0 +1,120 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from typing import List
+
+from metrics import MetricsAggregator
+from model_registry import MODEL_CONFIG_FILENAME
+from model_registry import WEIGHTS_FILENAMES
+from model_registry import ModelNotFound
+from model_registry import ModelRegistry
+from model_registry import ModelUnavailable
+
+
+class FakeModel:
+    """Stands in for a loaded model, with the memory it would hold."""
+
+    def __init__(self, name: str, memory_bytes: int):
+        self.name = name
+        self.memory_bytes = memory_bytes
+
+
+class TestModelRegistry(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        """Lay out three models in a temporary models directory, each with 100 bytes of weights."""
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.models_dir = self.tempdir.name
+        for name in ("org/a", "org/b", "org/c"):
+            os.makedirs(os.path.join(self.models_dir, name))
+            with open(os.path.join(self.models_dir, name, MODEL_CONFIG_FILENAME), "w") as f:
+                f.write("{}")
+            with open(os.path.join(self.models_dir, name, WEIGHTS_FILENAMES[0]), "wb") as f:
+                f.write(bytes(100))
+        self.loads: List[str] = []
+        self.unloads: List[str] = []
+        self.load_delay = 0.0
+
+        async def load(name: str, path: str) -> FakeModel:
+            self.loads.append(name)
+            await asyncio.sleep(self.load_delay)
+            return FakeModel(name, 100)
+
+        async def unload(model: FakeModel) -> None:
+            self.unloads.append(model.name)
+
+        self.aggregator = MetricsAggregator()
+        self.registry = ModelRegistry(
+            self.models_dir,
+            load,
+            unload,
+            memory_budget_bytes=250,
+            metrics_aggregator=self.aggregator,
+        )
+
+    async def asyncTearDown(self) -> None:
+        """Remove the models directory."""
+        self.tempdir.cleanup()
+
+    async def test_models_are_loaded_on_first_use(self) -> None:
+        """The first use loads the model, and later uses hit the resident one."""
+        async with self.registry.use("org/a") as model:
+            self.assertEqual(model.name, "org/a")
+        async with self.registry.use("/org/a/"):
+            pass
+
+        self.assertEqual(self.loads, ["org/a"])
+        self.assertEqual(self.registry.available(), ["org/a", "org/b", "org/c"])
+        usage = self.registry.stats()["models"]["org/a"]
+        self.assertEqual((usage["loads"], usage["misses"], usage["hits"]), (1, 1, 1))
+        path = os.path.join(os.path.realpath(self.models_dir), "org", "a")
+        self.assertEqual(self.aggregator.counters[("inference.model.hits", (f"model:{path}",))], 1)
+
+    async def test_least_recently_used_model_is_evicted(self) -> None:
+        """Loading a model that doesn't fit the budget evicts the least recently used one."""
+        for name in ("org/a", "org/b", "org/a", "org/c"):
+            async with self.registry.use(name):
+                pass
+
+        self.assertEqual(self.unloads, ["org/b"])
+        self.assertEqual(list(self.registry.resident), ["org/a", "org/c"])
+        self.assertLessEqual(self.registry.resident_bytes, 250)
+
+    async def test_models_in_use_and_pinned_models_are_not_evicted(self) -> None:
+        """A model serving a request or pinned at startup stays, and a new one can't be loaded."""
+        self.registry.add("org/a", self.registry.path("org/a"), FakeModel("org/a", 100), 1.0)
+        async with self.registry.use("org/b"):
+            with self.assertRaises(ModelUnavailable):
+                async with self.registry.use("org/c"):
+                    pass
+        async with self.registry.use("org/c"):
+            pass
+
+        self.assertEqual(self.unloads, ["org/b"])
+        self.assertEqual(list(self.registry.resident), ["org/a", "org/c"])
+
+    async def test_concurrent_requests_share_one_load(self) -> None:
+        """Requests for a model that is still loading wait for that load instead of starting one."""
+        self.load_delay = 0.02
+
+        async def classify() -> str:
+            async with self.registry.use("org/a") as model:
+                return model.name
+
+        names = await asyncio.gather(*(classify() for _ in range(5)))
+
+        self.assertEqual(names, ["org/a"] * 5)
+        self.assertEqual(self.loads, ["org/a"])
+        self.assertEqual(self.registry.resident["org/a"].in_use, 0)
+
+    async def test_unknown_and_invalid_names_are_not_found(self) -> None:
+        """Names outside the models directory or without a model config are rejected."""
+        for name in ("org/missing", "org", "../etc", "org/./a", "", "a/b/c/d"):
+            with self.assertRaises(ModelNotFound, msg=name):
+                async with self.registry.use(name):
+                    pass
+        self.assertEqual(self.loads, [])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,53 @@
+import unittest
+import unittest.mock
+
+from metrics import MetricsAggregator
+from prediction_cache import PredictionCache
+from prediction_cache import cache_key
+
+
+class TestPredictionCache(unittest.TestCase):
+    def setUp(self) -> None:
+        """Create a small cache with its own metrics."""
+        self.metrics = MetricsAggregator()
+        self.cache = PredictionCache(self.metrics, max_entries=2, ttl=60)
+
+    def test_keys_depend_on_bytes_and_model(self) -> None:
+        """Identical bytes share a key per model, and different models never collide."""
+        self.assertEqual(cache_key(b"image", "model-a"), cache_key(b"image", "model-a"))
+        self.assertNotEqual(cache_key(b"image", "model-a"), cache_key(b"image", "model-b"))
+        self.assertNotEqual(cache_key(b"image", "model-a"), cache_key(b"other", "model-a"))
+
+    def test_least_recently_used_entry_is_evicted(self) -> None:
+        """Reading an entry protects it from eviction."""
+        self.cache.put("a", {"label": "pho"})
+        self.cache.put("b", {"label": "ramen"})
+        self.cache.get("a")
+        self.cache.put("c", {"label": "sushi"})
+
+        self.assertEqual(self.cache.get("a"), {"label": "pho"})
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.metrics.counters[("inference.cache.evictions", ())], 1)
+        self.assertEqual(self.metrics.counters[("inference.cache.hits", ())], 2)
+        self.assertEqual(self.metrics.counters[("inference.cache.misses", ())], 1)
+
+    def test_expired_entries_are_misses(self) -> None:
+        """Entries older than the TTL are not served."""
+        with unittest.mock.patch("prediction_cache.time.monotonic", return_value=0):
+            self.cache.put("a", {"label": "pho"})
+        with unittest.mock.patch("prediction_cache.time.monotonic", return_value=61):
+            self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_memory_bound(self) -> None:
+        """The cache evicts entries to stay under its byte budget."""
+        cache = PredictionCache(self.metrics, max_entries=100, max_bytes=1000)
+        for i in range(10):
+            cache.put(str(i), {"label": "pho", "score": 0.5})
+
+        self.assertLessEqual(cache.stats()["bytes"], 1000)
+        self.assertEqual(cache.get("9"), {"label": "pho", "score": 0.5})
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,355 @@
+import asyncio
+import os
+import unittest
+import unittest.mock
+from types import SimpleNamespace
+from typing import AsyncIterator
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+from fastapi import Response
+from fastapi.responses import JSONResponse
+
+import fake_inference
+import proxy
+from concurrency_limiter import AdaptiveConcurrencyLimiter
+from hedging import Hedger
+from tracing import DEADLINE_DROPPED_HEADER
+from upstreams import UPSTREAM_UNHEALTHY_AFTER
+from upstreams import LoadBalancer
+from upstreams import UpstreamPools
+
+FILES = [("files", ("image.jpg", b"not really a jpeg", "image/jpeg"))]
+BOUNDARY = "proxy-test-boundary"
+
+
+def multipart_body(files: dict) -> bytes:
+    """Encode files as a multipart/form-data body with BOUNDARY."""
+    parts = [
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="files"; filename="{name}"\r\n'
+        f"Content-Type: image/jpeg\r\n\r\n".encode() + data + b"\r\n"
+        for name, data in files.items()
+    ]
+    return b"".join(parts) + f"--{BOUNDARY}--\r\n".encode()
+
+
+class TestProxyDeadlineDrops(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        """Point the proxy at an inference server that drops every request for its deadline."""
+        self.requests = 0
+        upstream = FastAPI()
+
+        @upstream.post("/classify/")
+        async def classify():
+            self.requests += 1
+            return JSONResponse(
+                status_code=504,
+                content={"detail": "Deadline passed 5ms before forward"},
+                headers={DEADLINE_DROPPED_HEADER: "true"},
+            )
+
+        self.server = uvicorn.Server(
+            uvicorn.Config(upstream, host="127.0.0.1", port=0, lifespan="off", log_level="warning")
+        )
+        self.task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.endpoint = f"http://127.0.0.1:{port}/classify/"
+
+        state = proxy.app.state
+        state.upstream_pools = UpstreamPools()
+        state.concurrency_limiter = AdaptiveConcurrencyLimiter()
+        state.load_balancer = LoadBalancer([self.endpoint], state.upstream_pools)
+        state.hedger = Hedger(max_retries=1)
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=proxy.app), base_url="http://proxy"
+        )
+
+    async def asyncTearDown(self) -> None:
+        """Close the clients and stop the inference server."""
+        await self.client.aclose()
+        await proxy.app.state.upstream_pools.aclose()
+        self.server.should_exit = True
+        await self.task
+
+    async def test_deadline_drops_leave_the_upstream_healthy_and_the_limit_unchanged(self) -> None:
+        """A 504 marked as a deadline drop is passed on without retries, errors or backoff."""
+        limiter = proxy.app.state.concurrency_limiter
+        limit = limiter.limit
+        for _ in range(UPSTREAM_UNHEALTHY_AFTER + 1):
+            response = await self.client.post("/classify/", files=FILES)
+            self.assertEqual(response.status_code, 504)
+
+        pool = proxy.app.state.upstream_pools.get(self.endpoint)
+        self.assertEqual((pool.errors, pool.consecutive_errors), (0, 0))
+        self.assertTrue(pool.healthy)
+        self.assertEqual(proxy.app.state.load_balancer.available(), [self.endpoint])
+        self.assertEqual(limiter.limit, limit)
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(proxy.app.state.hedger.counts["retries"], 0)
+        self.assertEqual(self.requests, UPSTREAM_UNHEALTHY_AFTER + 1)
+
+    async def test_endpoint_header_is_ignored_with_configured_upstreams(self) -> None:
+        """X-Inference-Endpoint can't send a request past the configured upstreams by default."""
+        response = await self.client.post(
+            "/classify/",
+            files=FILES,
+            headers={"X-Inference-Endpoint": "http://127.0.0.1:9/classify/"},
+        )
+
+        self.assertEqual(response.status_code, 504)
+        self.assertEqual(self.requests, 1)
+
+
+class TestProxyResponses(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        """Point the proxy at an inference server that answers with `self.upstream_body`."""
+        self.upstream_body = b'{"predictions":[{"label":"french_toast","score":0.9}]}'
+        upstream = FastAPI()
+
+        @upstream.post("/classify/")
+        async def classify():
+            return Response(content=self.upstream_body, media_type="application/json")
+
+        self.server = uvicorn.Server(
+            uvicorn.Config(upstream, host="127.0.0.1", port=0, lifespan="off", log_level="warning")
+        )
+        self.task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.endpoint = f"http://127.0.0.1:{port}/classify/"
+
+        state = proxy.app.state
+        state.upstream_pools = UpstreamPools()
+        state.concurrency_limiter = AdaptiveConcurrencyLimiter()
+        state.load_balancer = LoadBalancer([self.endpoint], state.upstream_pools)
+        state.hedger = Hedger(max_retries=1)
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=proxy.app), base_url="http://proxy"
+        )
+
+    async def asyncTearDown(self) -> None:
+        """Close the clients and stop the inference server."""
+        await self.client.aclose()
+        await proxy.app.state.upstream_pools.aclose()
+        self.server.should_exit = True
+        await self.task
+
+    def validation_errors(self) -> float:
+        """How many upstream bodies from the test server failed validation so far."""
+        key = ("proxy.validation_errors", ("upstream:127.0.0.1",))
+        return proxy.metrics_aggregator.counters.get(key, 0)
+
+    async def test_spliced_response_parses_as_a_proxy_response(self) -> None:
+        """The spliced body is a valid ProxyResponse, with its metadata repeated as headers."""
+        self.upstream_body = (
+            b'{"predictions":[{"label":"french_toast","score":0.9,"top_k":'
+            b'[{"label":"french_toast","score":0.9},{"label":"waffles","score":0.05}]},'
+            b'{"error":"cannot identify image file"}]}'
+        )
+
+        response = await self.client.post("/classify/", files=FILES)
+
+        self.assertEqual(response.status_code, 200)
+        parsed = proxy.ProxyResponse.model_validate_json(response.content)
+        self.assertEqual(parsed.pod_id, proxy.POD_ID)
+        self.assertEqual(parsed.inference_endpoint, self.endpoint)
+        self.assertEqual(
+            parsed.original_response.model_dump_json(exclude_none=True).encode(),
+            self.upstream_body,
+        )
+        self.assertEqual(response.headers["X-Pod-ID"], proxy.POD_ID)
+        self.assertEqual(response.headers["X-Inference-Endpoint"], self.endpoint)
+
+    async def test_malformed_upstream_body_is_counted_when_sampled(self) -> None:
+        """Sampled upstream bodies that don't fit the schema are counted, and still passed on."""
+        self.upstream_body = b'{"predictions":[{"label":"french_toast","score":"high"}]}'
+        errors = self.validation_errors()
+
+        with unittest.mock.patch("proxy.PROXY_VALIDATE_SAMPLE_RATE", 0.0):
+            await self.client.post("/classify/", files=FILES)
+        self.assertEqual(self.validation_errors(), errors)
+
+        with unittest.mock.patch("proxy.PROXY_VALIDATE_SAMPLE_RATE", 1.0):
+            response = await self.client.post("/classify/", files=FILES)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.validation_errors(), errors + 1)
+
+
+class TestProxyStreaming(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        """Point a streaming proxy at a fake inference server that records the bodies it reads."""
+        self.bodies = []
+        upstream = fake_inference.create_app(service_time_ms=0)
+
+        async def recording_upstream(scope, receive, send):
+            chunks = []
+
+            async def recording_receive():
+                message = await receive()
+                if message["type"] == "http.request":
+                    chunks.append(message.get("body", b""))
+                return message
+
+            try:
+                await upstream(scope, recording_receive, send)
+            finally:
+                self.bodies.append(b"".join(chunks))
+
+        # A client disconnecting fails the upstream's form parsing, which uvicorn logs as an error
+        self.server = uvicorn.Server(
+            uvicorn.Config(
+                recording_upstream, host="127.0.0.1", port=0, lifespan="off", log_level="critical"
+            )
+        )
+        self.task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.endpoint = f"http://127.0.0.1:{port}/classify/"
+
+        state = proxy.app.state
+        state.upstream_pools = UpstreamPools()
+        state.concurrency_limiter = AdaptiveConcurrencyLimiter()
+        state.load_balancer = LoadBalancer([self.endpoint], state.upstream_pools)
+        state.hedger = Hedger(max_retries=1)
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=proxy.app), base_url="http://proxy"
+        )
+        streaming = unittest.mock.patch("proxy.PROXY_STREAMING", True)
+        streaming.start()
+        self.addCleanup(streaming.stop)
+
+    async def asyncTearDown(self) -> None:
+        """Close the clients and stop the inference server."""
+        await self.client.aclose()
+        await proxy.app.state.upstream_pools.aclose()
+        self.server.should_exit = True
+        await self.task
+
+    async def test_multipart_body_is_relayed_intact(self) -> None:
+        """The upload reaches the inference server byte for byte, however it was chunked."""
+        body = multipart_body({"a.jpg": os.urandom(300_000), "b.jpg": os.urandom(200_000)})
+
+        async def upload() -> AsyncIterator[bytes]:
+            for start in range(0, len(body), 65_536):
+                yield body[start : start + 65_536]
+
+        response = await self.client.post(
+            "/classify/",
+            content=upload(),
+            headers={"Content-Type": f"multipart/form-data; boundary={BOUNDARY}"},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["original_response"]["predictions"]), 2)
+        self.assertEqual(self.bodies, [body])
+        self.assertEqual(proxy.app.state.concurrency_limiter.in_flight, 0)
+
+    async def test_reading_pauses_while_the_upstream_falls_behind(self) -> None:
+        """No more of the upload is read than the buffer holds until the upstream catches up."""
+        chunks = [bytes([i]) * 1024 for i in range(20)]
+        read = []
+
+        async def stream() -> AsyncIterator[bytes]:
+            for chunk in chunks:
+                read.append(chunk)
+                yield chunk
+
+        buffer: asyncio.Queue = asyncio.Queue(maxsize=4)
+        reader = asyncio.create_task(proxy.read_body_into(SimpleNamespace(stream=stream), buffer))
+        await asyncio.sleep(0.05)
+        # Four chunks are buffered and a fifth waits for room
+        self.assertEqual(len(read), 5)
+
+        relayed = [chunk async for chunk in proxy.relay_body(buffer)]
+        await reader
+        self.assertEqual(relayed, chunks)
+
+    async def test_client_disconnect_mid_upload(self) -> None:
+        """A client that goes away mid-upload gets a 400, without blaming the upstream."""
+        messages = [
+            {"type": "http.request", "body": multipart_body({"a.jpg": b"x" * 1024})[:512]},
+            {"type": "http.disconnect"},
+        ]
+        messages[0]["more_body"] = True
+        sent = []
+
+        async def receive() -> dict:
+            return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+        async def send(message: dict) -> None:
+            sent.append(message)
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "POST",
+            "scheme": "http",
+            "path": "/classify/",
+            "raw_path": b"/classify/",
+            "root_path": "",
+            "query_string": b"",
+            "headers": [
+                (b"host", b"proxy"),
+                (b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode()),
+            ],
+            "client": ("127.0.0.1", 12345),
+            "server": ("proxy", 80),
+        }
+        await proxy.app(scope, receive, send)
+
+        self.assertEqual(sent[0]["status"], 400)
+        self.assertIn(b"Client disconnected", sent[1]["body"])
+        self.assertEqual(proxy.app.state.concurrency_limiter.in_flight, 0)
+        pool = proxy.app.state.upstream_pools.get(self.endpoint)
+        self.assertEqual((pool.errors, pool.healthy), (0, True))
+
+
+class TestProxyReadiness(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        """A started proxy whose upstreams each test configures."""
+        self.pools = UpstreamPools()
+        proxy.app.state.upstream_pools = self.pools
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=proxy.app), base_url="http://proxy"
+        )
+
+    async def asyncTearDown(self) -> None:
+        """Close the clients."""
+        await self.client.aclose()
+        await self.pools.aclose()
+
+    def mark_unhealthy(self, endpoint: str) -> None:
+        """Fail enough requests to the endpoint to mark it unhealthy."""
+        for _ in range(UPSTREAM_UNHEALTHY_AFTER):
+            self.pools.get(endpoint).record_error()
+
+    async def test_client_supplied_endpoints_dont_affect_readiness(self) -> None:
+        """Without configured upstreams, a failing X-Inference-Endpoint origin leaves it ready."""
+        proxy.app.state.load_balancer = LoadBalancer([], self.pools)
+        self.mark_unhealthy("http://client-supplied:8000/classify/")
+
+        response = await self.client.get("/readyz")
+
+        self.assertEqual(response.status_code, 200)
+
+    async def test_not_ready_when_every_configured_upstream_fails(self) -> None:
+        """With configured upstreams, readiness follows theirs."""
+        endpoint = "http://inference:8000/classify/"
+        proxy.app.state.load_balancer = LoadBalancer([endpoint], self.pools)
+        self.assertEqual((await self.client.get("/readyz")).status_code, 200)
+
+        self.mark_unhealthy(endpoint)
+        response = await self.client.get("/readyz")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.json()["checks"]["upstream_healthy"])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,123 @@
+import asyncio
+import base64
+import unittest
+from typing import AsyncIterator
+from typing import Dict
+from typing import List
+
+import httpx
+import orjson
+
+from streaming import StreamImage
+from streaming import iter_stream_images
+from streaming import stream_predictions
+
+
+async def chunked(data: bytes, size: int) -> AsyncIterator[bytes]:
+    """Yield `data` in pieces of `size` bytes, like a request body arriving over the network."""
+    for start in range(0, len(data), size):
+        yield data[start : start + size]
+
+
+async def collect(images: AsyncIterator[StreamImage]) -> List[StreamImage]:
+    """Read every image from a stream."""
+    return [image async for image in images]
+
+
+class TestStreamParsing(unittest.IsolatedAsyncioTestCase):
+    async def test_ndjson_records_split_across_chunks(self) -> None:
+        """Lines are reassembled across chunk boundaries and bad records become errors."""
+        body = b"\n".join(
+            [
+                orjson.dumps({"id": "a", "image": base64.b64encode(b"first").decode()}),
+                b"",
+                b"not json",
+                orjson.dumps({"id": 2, "image": "data:image/jpeg;base64,c2Vjb25k"}),
+                orjson.dumps({"id": "c", "image": "%%%"}),
+            ]
+        )
+
+        images = await collect(iter_stream_images("application/x-ndjson", chunked(body, 7)))
+
+        self.assertEqual([image.id for image in images], ["a", None, "2", "c"])
+        self.assertEqual(images[0].contents, b"first")
+        self.assertEqual(images[2].contents, b"second")
+        self.assertIn("Invalid JSON", images[1].error)
+        self.assertEqual(images[3].error, "Image is not valid base64")
+
+    async def test_multipart_parts_are_yielded_as_they_arrive(self) -> None:
+        """Each `files` part is read from a chunked multipart body, other fields are ignored."""
+        request = httpx.Request(
+            "POST",
+            "http://test/",
+            data={"note": "ignored"},
+            files=[
+                ("files", ("one.jpg", b"1" * 5000, "image/jpeg")),
+                ("files", ("two.png", b"2", "image/png")),
+            ],
+        )
+        body = request.read()
+
+        images = await collect(
+            iter_stream_images(request.headers["content-type"], chunked(body, 1000))
+        )
+
+        self.assertEqual([image.id for image in images], ["one.jpg", "two.png"])
+        self.assertEqual([image.content_type for image in images], ["image/jpeg", "image/png"])
+        self.assertEqual(images[0].contents, b"1" * 5000)
+
+    def test_unsupported_content_type_is_rejected(self) -> None:
+        """Bodies that are neither NDJSON nor multipart are refused before reading them."""
+        with self.assertRaises(ValueError):
+            iter_stream_images("text/plain", chunked(b"", 1))
+
+
+class TestStreamPredictions(unittest.IsolatedAsyncioTestCase):
+    async def test_results_stream_as_ready_with_bounded_concurrency(self) -> None:
+        """Faster images are answered first, and no more than `max_in_flight` run at once."""
+        running: List[str] = []
+        peak = 0
+
+        async def classify(image: StreamImage) -> Dict:
+            nonlocal peak
+            running.append(image.id or "")
+            peak = max(peak, len(running))
+            await asyncio.sleep(0.05 if image.id == "slow" else 0.001)
+            running.remove(image.id or "")
+            return {"label": image.contents.decode()}
+
+        async def images() -> AsyncIterator[StreamImage]:
+            yield StreamImage("slow", b"a")
+            yield StreamImage(None, error="bad record")
+            for i in range(5):
+                yield StreamImage(str(i), b"b")
+
+        lines = [
+            orjson.loads(line)
+            async for line in stream_predictions(images(), classify, max_in_flight=3)
+        ]
+
+        self.assertEqual(sorted(line["index"] for line in lines), list(range(7)))
+        self.assertEqual(lines[-1], {"index": 0, "id": "slow", "label": "a"})
+        self.assertIn({"index": 1, "error": "bad record"}, lines)
+        self.assertLessEqual(peak, 3)
+
+    async def test_unreadable_body_ends_the_stream_with_an_error(self) -> None:
+        """A body that fails part way still answers the images before the failure."""
+
+        async def images() -> AsyncIterator[StreamImage]:
+            yield StreamImage("ok", b"a")
+            raise ValueError("truncated")
+
+        async def classify(image: StreamImage) -> Dict:
+            return {"label": "french_toast"}
+
+        lines = [orjson.loads(line) async for line in stream_predictions(images(), classify)]
+
+        self.assertEqual(lines[0], {"index": 0, "id": "ok", "label": "french_toast"})
+        self.assertIsNone(lines[1]["index"])
+        self.assertIn("truncated", lines[1]["error"])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
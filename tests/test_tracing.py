@@ -0,0 +1,74 @@
+import time
+import unittest
+
+import httpx
+
+from fake_inference import create_app
+from tracing import DEADLINE_HEADER
+from tracing import PRIORITY_HEADER
+from tracing import REQUEST_ID_HEADER
+from tracing import format_deadline
+from tracing import parse_deadline
+from tracing import parse_priority
+from tracing import parse_server_timing
+from tracing import request_id
+from tracing import time_remaining
+
+
+class TestTracing(unittest.TestCase):
+    def test_request_id(self) -> None:
+        """A well-formed ID from the caller is kept, anything else gets a fresh one."""
+        self.assertEqual(request_id({REQUEST_ID_HEADER: "abc-123"}), "abc-123")
+        generated = request_id({REQUEST_ID_HEADER: "bad id\r\n"})
+        self.assertRegex(generated, "^[0-9a-f]{32}$")
+        self.assertNotEqual(request_id({}), request_id({}))
+
+    def test_deadline(self) -> None:
+        """Deadlines round-trip through the header, and invalid ones are ignored."""
+        deadline = time.time() + 5
+        parsed = parse_deadline({DEADLINE_HEADER: format_deadline(deadline)})
+        assert parsed is not None
+        self.assertAlmostEqual(parsed, deadline, places=2)
+        remaining = time_remaining(parsed)
+        assert remaining is not None
+        # The header is rounded to the millisecond
+        self.assertTrue(4 < remaining <= 5.001)
+        self.assertIsNone(parse_deadline({DEADLINE_HEADER: "soon"}))
+        self.assertIsNone(parse_deadline({}))
+        self.assertIsNone(time_remaining(None))
+
+    def test_priority(self) -> None:
+        """Known priority classes are kept, anything else is normal."""
+        self.assertEqual(parse_priority({PRIORITY_HEADER: " High"}), "high")
+        self.assertEqual(parse_priority({PRIORITY_HEADER: "urgent"}), "normal")
+        self.assertEqual(parse_priority({}), "normal")
+
+    def test_parse_server_timing(self) -> None:
+        """Durations are read in seconds, skipping entries without one."""
+        timings = parse_server_timing('decode;dur=12.5, cache;desc="hit", forward;dur="30", total')
+        self.assertEqual(timings, {"decode": 0.0125, "forward": 0.03})
+        self.assertEqual(parse_server_timing(""), {})
+
+
+class TestFakeInferenceTiming(unittest.IsolatedAsyncioTestCase):
+    async def test_request_id_is_echoed_with_stage_timings(self) -> None:
+        """The fake server answers like the real one, with the request ID and Server-Timing."""
+        app = create_app(service_time_ms=20, concurrency=1)
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://fake"
+        ) as client:
+            response = await client.post(
+                "/classify/",
+                files=[("files", ("a.jpg", b"image", "image/jpeg"))],
+                headers={REQUEST_ID_HEADER: "trace-1"},
+            )
+
+        self.assertEqual(response.headers[REQUEST_ID_HEADER], "trace-1")
+        timings = parse_server_timing(response.headers["Server-Timing"])
+        self.assertEqual(set(timings), {"queue_wait", "forward", "total"})
+        self.assertGreaterEqual(timings["forward"], 0.019)
+        self.assertGreaterEqual(timings["total"], timings["forward"])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
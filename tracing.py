@@ -0,0 +1,83 @@
+"""Request IDs, deadlines and stage timings carried between the proxy and the inference server.
+
+The proxy gives every request an ID and an absolute deadline, and forwards both upstream in the
+X-Request-ID and X-Request-Deadline headers, along with the client's X-Request-Priority class and
+the X-Model it asked for. The inference server answers with its own stage breakdown in a
+Server-Timing header, which the proxy merges into the request's timing record. When it drops a
+request whose deadline passed, it marks its 504 with X-Deadline-Dropped.
+"""
+
+import re
+import time
+import uuid
+from typing import Dict
+from typing import Mapping
+from typing import Optional
+
+REQUEST_ID_HEADER = "X-Request-ID"
+# Unix time, in seconds, after which the client no longer wants an answer. An absolute time stays
+# correct across hops without each one subtracting its own share, as long as clocks are in sync.
+DEADLINE_HEADER = "X-Request-Deadline"
+PRIORITY_HEADER = "X-Request-Priority"
+# Name of the model to classify with, relative to the inference server's models directory
+MODEL_HEADER = "X-Model"
+# Set by the inference server on a 504 for a request it dropped because its deadline passed, so the
+# proxy can tell a late request from a failing upstream
+DEADLINE_DROPPED_HEADER = "X-Deadline-Dropped"
+
+# Priority classes, most urgent first. The inference server runs queued images in this order.
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+DEFAULT_PRIORITY = "normal"
+
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+
+def request_id(headers: Mapping[str, str]) -> str:
+    """The caller's request ID if it sent a well-formed one, otherwise a new one."""
+    value = headers.get(REQUEST_ID_HEADER, "")
+    return value if REQUEST_ID_PATTERN.match(value) else uuid.uuid4().hex
+
+
+def parse_deadline(headers: Mapping[str, str]) -> Optional[float]:
+    """The deadline the caller sent, or None if it sent none or an invalid one."""
+    try:
+        deadline = float(headers.get(DEADLINE_HEADER, ""))
+    except ValueError:
+        return None
+    return deadline if deadline > 0 else None
+
+
+def parse_priority(headers: Mapping[str, str]) -> str:
+    """The caller's priority class, or DEFAULT_PRIORITY if it sent none or an unknown one."""
+    priority = headers.get(PRIORITY_HEADER, "").strip().lower()
+    return priority if priority in PRIORITIES else DEFAULT_PRIORITY
+
+
+def format_deadline(deadline: float) -> str:
+    """A deadline as an X-Request-Deadline header value, to the millisecond."""
+    return f"{deadline:.3f}"
+
+
+def time_remaining(deadline: Optional[float]) -> Optional[float]:
+    """Seconds until the deadline, negative once it has passed, or None without one."""
+    return None if deadline is None else deadline - time.time()
+
+
+def deadline_dropped(status_code: int, headers: Mapping[str, str]) -> bool:
+    """Whether an upstream response is the inference server dropping a request past its deadline."""
+    return status_code == 504 and DEADLINE_DROPPED_HEADER in headers
+
+
+def parse_server_timing(value: str) -> Dict[str, float]:
+    """Durations, in seconds, from a Server-Timing header. Entries without a `dur` are skipped."""
+    timings: Dict[str, float] = {}
+    for entry in value.split(","):
+        name, *params = (part.strip() for part in entry.split(";"))
+        for param in params:
+            key, _, duration = param.partition("=")
+            if name and key.strip() == "dur":
+                try:
+                    timings[name] = float(duration.strip('" ')) / 1000
+                except ValueError:
+                    pass
+    return timings
@@ -0,0 +1,352 @@
+"""Connection pools for the inference servers the proxy forwards to, and load balancing across them.
+
+Each upstream origin gets one long-lived HTTP client. The load balancer picks one of the configured
+inference endpoints for every request. It uses the power of two choices: it samples two healthy
+endpoints and sends the request to the less loaded one. It also probes every endpoint's readiness
+on a background task and ejects the ones that keep failing.
+"""
+
+import asyncio
+import logging
+import math
+import os
+import random
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+
+import httpx
+
+from metrics import MetricsAggregator
+from tracing import deadline_dropped
+
+logger = logging.getLogger(__name__)
+
+# Upstream connection pool configuration
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30.0"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() == "true"
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "60.0"))
+UPSTREAM_MAX_POOLS = int(os.getenv("UPSTREAM_MAX_POOLS", "16"))
+UPSTREAM_UNHEALTHY_AFTER = int(os.getenv("UPSTREAM_UNHEALTHY_AFTER", "5"))
+UPSTREAM_UNHEALTHY_COOLDOWN = float(os.getenv("UPSTREAM_UNHEALTHY_COOLDOWN", "10.0"))
+
+# Load balancing configuration
+LOAD_BALANCING_POLICY = os.getenv("LOAD_BALANCING_POLICY", "peak_ewma")
+PEAK_EWMA_DECAY = float(os.getenv("PEAK_EWMA_DECAY", "10.0"))
+HEALTH_CHECK_PATH = os.getenv("HEALTH_CHECK_PATH", "/readyz")
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "5.0"))
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "2.0"))
+HEALTH_CHECK_UNHEALTHY_THRESHOLD = int(os.getenv("HEALTH_CHECK_UNHEALTHY_THRESHOLD", "2"))
+HEALTH_CHECK_HEALTHY_THRESHOLD = int(os.getenv("HEALTH_CHECK_HEALTHY_THRESHOLD", "2"))
+
+POLICIES = ("least_outstanding", "peak_ewma")
+
+
+class NoHealthyUpstream(Exception):
+    """Raised when every configured inference endpoint is ejected or failing."""
+
+
+class UpstreamPool:
+    """Long-lived HTTP client for a single upstream origin, plus usage statistics."""
+
+    def __init__(self, origin: str, metrics_aggregator: Optional[MetricsAggregator] = None):
+        self.origin = origin
+        self.metrics_aggregator = metrics_aggregator
+        self.metric_tags = [f"upstream:{httpx.URL(origin).host}"]
+        self.transport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+            ),
+            http2=UPSTREAM_HTTP2,
+        )
+        self.client = httpx.AsyncClient(transport=self.transport, timeout=UPSTREAM_TIMEOUT)
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.consecutive_errors = 0
+        self.last_error_at = 0.0
+        self.total_latency = 0.0
+        self.ewma_latency = 0.0
+        self.ewma_updated_at = time.monotonic()
+        # Set for configured endpoints, which are never evicted and are actively health checked
+        self.pinned = False
+        self.ejected = False
+        self.check_failures = 0
+        self.check_successes = 0
+
+    async def post(self, url: str, **kwargs: Any) -> httpx.Response:
+        """POST to the upstream over the pooled client, recording latency and errors.
+
+        A request the upstream dropped because its deadline passed is neither an error nor a
+        latency sample, since it says nothing about the upstream's health.
+        """
+        self.requests += 1
+        self.in_flight += 1
+        start_time = time.perf_counter()
+        try:
+            response = await self.client.post(url, **kwargs)
+        except httpx.RequestError:
+            self.record_error()
+            raise
+        finally:
+            self.in_flight -= 1
+            latency = time.perf_counter() - start_time
+            self.total_latency += latency
+            if self.metrics_aggregator is not None:
+                self.metrics_aggregator.observe("proxy.upstream.latency", latency, self.metric_tags)
+
+        if response.status_code < 500:
+            self.consecutive_errors = 0
+            self.record_latency(latency)
+        elif not deadline_dropped(response.status_code, response.headers):
+            self.record_error()
+        return response
+
+    def record_error(self) -> None:
+        """Count a failed request towards marking the upstream unhealthy."""
+        self.errors += 1
+        self.consecutive_errors += 1
+        self.last_error_at = time.monotonic()
+
+    def record_latency(self, latency: float) -> None:
+        """Update the peak-EWMA latency estimate.
+
+        A slower response than the current estimate replaces it outright, so an upstream that
+        slows down is avoided immediately. Faster responses only pull the estimate down gradually,
+        with a time constant of PEAK_EWMA_DECAY seconds.
+        """
+        now = time.monotonic()
+        if latency > self.ewma_latency:
+            self.ewma_latency = latency
+        else:
+            weight = math.exp(-(now - self.ewma_updated_at) / PEAK_EWMA_DECAY)
+            self.ewma_latency = self.ewma_latency * weight + latency * (1 - weight)
+        self.ewma_updated_at = now
+
+    @property
+    def latency_estimate(self) -> float:
+        """Peak-EWMA latency, decayed for the time since the last response.
+
+        Without this an upstream that had one slow response would keep its high estimate, and so
+        never be picked again to replace it with a faster one.
+        """
+        idle = time.monotonic() - self.ewma_updated_at
+        return self.ewma_latency * math.exp(-idle / PEAK_EWMA_DECAY)
+
+    @property
+    def healthy(self) -> bool:
+        """Whether the upstream is answering health checks and requests without repeated failures.
+
+        An upstream that failed requests is given another chance after UPSTREAM_UNHEALTHY_COOLDOWN
+        seconds, so a proxy that stopped receiving traffic because it was not ready can recover.
+        An ejected upstream stays out until it passes its health checks again.
+        """
+        if self.ejected:
+            return False
+        if self.consecutive_errors < UPSTREAM_UNHEALTHY_AFTER:
+            return True
+        return time.monotonic() - self.last_error_at > UPSTREAM_UNHEALTHY_COOLDOWN
+
+    def stats(self) -> Dict[str, Any]:
+        """Snapshot of request counters and connection usage for this upstream."""
+        # httpx doesn't expose its connection pool, so report none if its internals change
+        connections = getattr(getattr(self.transport, "_pool", None), "connections", [])
+        completed = self.requests - self.in_flight
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "healthy": self.healthy,
+            "ejected": self.ejected,
+            "avg_latency_ms": (self.total_latency / completed * 1000) if completed else 0.0,
+            "ewma_latency_ms": self.ewma_latency * 1000,
+            "connections": len(connections),
+            "idle_connections": sum(1 for c in connections if c.is_idle()),
+            "http2": UPSTREAM_HTTP2,
+        }
+
+    async def aclose(self) -> None:
+        """Close every connection held by this pool."""
+        await self.client.aclose()
+
+
+class UpstreamPools:
+    """App-lifetime registry of connection pools, one per upstream origin."""
+
+    def __init__(
+        self,
+        max_pools: int = UPSTREAM_MAX_POOLS,
+        metrics_aggregator: Optional[MetricsAggregator] = None,
+    ):
+        self.max_pools = max_pools
+        self.metrics_aggregator = metrics_aggregator
+        self.pools: OrderedDict[str, UpstreamPool] = OrderedDict()
+
+    def get(self, url: str) -> UpstreamPool:
+        """Return the pool for the origin of `url`, creating it on first use."""
+        parsed = httpx.URL(url)
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        origin = f"{parsed.scheme}://{parsed.host}:{port}"
+        if origin in self.pools:
+            self.pools.move_to_end(origin)
+            return self.pools[origin]
+
+        if len(self.pools) >= self.max_pools:
+            self._evict_idle()
+        pool = UpstreamPool(origin, self.metrics_aggregator)
+        self.pools[origin] = pool
+        logger.info(f"Opened upstream pool for {origin}")
+        return pool
+
+    def _evict_idle(self) -> None:
+        """Drop the least recently used pool that has no requests in flight and isn't pinned."""
+        for origin, pool in self.pools.items():
+            if pool.in_flight == 0 and not pool.pinned:
+                del self.pools[origin]
+                logger.info(f"Evicting upstream pool for {origin}")
+                asyncio.get_running_loop().create_task(pool.aclose())
+                return
+
+    @property
+    def in_flight(self) -> int:
+        """Requests currently being forwarded, across all upstreams."""
+        return sum(pool.in_flight for pool in self.pools.values())
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per-upstream pool statistics."""
+        return {origin: pool.stats() for origin, pool in self.pools.items()}
+
+    async def aclose(self) -> None:
+        """Close all pools."""
+        for pool in self.pools.values():
+            await pool.aclose()
+        self.pools.clear()
+
+
+class LoadBalancer:
+    """Chooses one of a fixed set of inference endpoints for each request.
+
+    `least_outstanding` sends each request to the endpoint with the fewest requests in flight.
+    `peak_ewma` multiplies that count by the endpoint's peak-EWMA latency, so a slow or
+    overloaded GPU server gets proportionally less traffic. Either way, only two randomly sampled
+    healthy endpoints are compared, which keeps several proxy replicas from all piling onto the
+    same "best" endpoint at once.
+    """
+
+    def __init__(
+        self,
+        endpoints: List[str],
+        pools: UpstreamPools,
+        policy: str = LOAD_BALANCING_POLICY,
+        metrics_aggregator: Optional[MetricsAggregator] = None,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(
+                f"Unknown load balancing policy {policy!r}, expected one of {POLICIES}"
+            )
+        self.endpoints = endpoints
+        self.pools = pools
+        self.policy = policy
+        self.metrics_aggregator = metrics_aggregator
+        self.task: Optional[asyncio.Task] = None
+        for endpoint in endpoints:
+            pools.get(endpoint).pinned = True
+
+    def load(self, endpoint: str) -> float:
+        """Cost of sending one more request to `endpoint`, lower is better."""
+        pool = self.pools.get(endpoint)
+        if self.policy == "least_outstanding":
+            return pool.in_flight
+        return pool.latency_estimate * (pool.in_flight + 1)
+
+    def available(self) -> List[str]:
+        """Endpoints that are neither ejected nor failing requests."""
+        return [endpoint for endpoint in self.endpoints if self.pools.get(endpoint).healthy]
+
+    def pick(self, exclude: Sequence[str] = ()) -> str:
+        """Choose the endpoint for the next request, other than those in `exclude`."""
+        candidates = [endpoint for endpoint in self.available() if endpoint not in exclude]
+        if not candidates:
+            raise NoHealthyUpstream(
+                f"None of the {len(self.endpoints)} inference endpoints is healthy"
+                + (f" apart from {', '.join(exclude)}" if exclude else "")
+            )
+        if len(candidates) == 1:
+            return candidates[0]
+        # Ties, e.g. endpoints without latency samples yet, go to the one with fewer in flight
+        first, second = random.sample(candidates, 2)
+        first_cost = (self.load(first), self.pools.get(first).in_flight)
+        second_cost = (self.load(second), self.pools.get(second).in_flight)
+        return first if first_cost <= second_cost else second
+
+    async def check(self, endpoint: str) -> None:
+        """Probe one endpoint, ejecting or readmitting it after enough results in a row."""
+        pool = self.pools.get(endpoint)
+        try:
+            response = await pool.client.get(
+                pool.origin + HEALTH_CHECK_PATH, timeout=HEALTH_CHECK_TIMEOUT
+            )
+            passed = response.status_code == 200
+        except httpx.HTTPError:
+            passed = False
+
+        if passed:
+            pool.check_failures = 0
+            pool.check_successes += 1
+            if pool.ejected and pool.check_successes >= HEALTH_CHECK_HEALTHY_THRESHOLD:
+                pool.ejected = False
+                pool.consecutive_errors = 0
+                logger.info(f"Readmitting {endpoint} after {pool.check_successes} passed checks")
+        else:
+            pool.check_successes = 0
+            pool.check_failures += 1
+            if not pool.ejected and pool.check_failures >= HEALTH_CHECK_UNHEALTHY_THRESHOLD:
+                pool.ejected = True
+                logger.warning(f"Ejecting {endpoint} after {pool.check_failures} failed checks")
+                if self.metrics_aggregator is not None:
+                    self.metrics_aggregator.increment(
+                        "proxy.upstream.ejections", 1, pool.metric_tags
+                    )
+
+    async def check_all(self) -> None:
+        """Probe every endpoint concurrently."""
+        await asyncio.gather(*(self.check(endpoint) for endpoint in self.endpoints))
+        if self.metrics_aggregator is not None:
+            self.metrics_aggregator.gauge("proxy.upstream.healthy", len(self.available()))
+
+    async def run(self, interval: float) -> None:
+        """Health check every `interval` seconds until cancelled."""
+        while True:
+            await self.check_all()
+            await asyncio.sleep(interval)
+
+    def start(self, interval: float = HEALTH_CHECK_INTERVAL) -> None:
+        """Start health checking on a background task, if there are endpoints to check."""
+        if self.endpoints:
+            self.task = asyncio.create_task(self.run(interval))
+
+    async def stop(self) -> None:
+        """Stop the health check task."""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Policy and endpoint availability."""
+        return {
+            "policy": self.policy,
+            "endpoints": self.endpoints,
+            "available": self.available(),
+        }